@@ -1,4 +1,4 @@
-import re
+import time
 from datetime import datetime, timedelta
 
 import numpy as np
@@ -18,6 +18,7 @@ from src.analysis.setting import REPORT_DIR, TABLE_STYLE, COLOR_RULE, PERCENT_FO
 from src.analysis.utils import histogram
 from src.api import get_peak_start_date, get_price, get_roll_yield
 from src.data.future.setting import CODE2NAME_MAP
+from src.util import read_cursor
 
 # from src.util import count_percentile
 
@@ -27,32 +28,28 @@ log = LogHandler('analysis.log')
 def get_instrument_symbols(by='amount', threshold=1e9, instrument='future'):
     """
     根据流动性选择交易品种，30天内的平均值作为选择标准，由于节假日原因，取平均的数据个数可能不一样。
-    :param instrument:
-    :param by:过滤的因子
+    从 index_latest 中每个 symbol 一条记录计算，不需要读取和排序 index 的历史数据
+    :param instrument: 'future' 只选择主力合约
+    :param by:过滤的因子 'amount', 'volume', 'openInt'
     :param threshold:过滤的阈值
-    :return:
+    :return: list of symbol 按过滤因子从大到小排列
     """
-    # conn = connect_mongo(db='quote', username=DATA_ANALYST, password=ANALYST_PWD)
+    since = datetime.today() - timedelta(30)  # 选取30天内有交易的品种
+    recent = {'$filter': {'input': '$recent', 'as': 'bar', 'cond': {'$gt': ['$$bar.datetime', since]}}}
 
     pipeline = [
         {
             '$match': {
                 'datetime': {
-                    '$gt': datetime.today() - timedelta(30)  # 选取30天内有交易的品种
+                    '$gt': since
                 }
             }
         }, {
-            '$sort': {
-                'datetime': DESCENDING
-            }
-        }, {
-            '$group': {
-                '_id': '$symbol',
-                'datetime': {
-                    '$first': '$datetime'
-                },
+            '$project': {
+                '_id': 0,
+                'symbol': 1,
                 by: {
-                    '$avg': '$' + by
+                    '$avg': {'$map': {'input': recent, 'as': 'bar', 'in': '$$bar.' + by}}
                 }
             }
         }, {
@@ -69,196 +66,191 @@ def get_instrument_symbols(by='amount', threshold=1e9, instrument='future'):
     ]
 
     match_stage = pipeline[0]['$match']
-    cursor = conn['index']
+    cursor = conn['index_latest']
     if instrument == 'future':
-        match_stage['symbol'] = {'$regex': re.compile(r"88$")}
-    else:
-        pass
+        match_stage['series'] = '88'
 
     symbol_list = list(cursor.aggregate(pipeline))
     # 剔除某一天超过阈值的
     if len(symbol_list) == 0:
         log.info('None of snapshot dates return!')
         return symbol_list
-    return [symbol['_id'] for symbol in symbol_list]
-    # return symbol_list
+    return [symbol['symbol'] for symbol in symbol_list]
 
 
 def get_last_price(symbol=None, instrument='index', frequency='d', fields='close'):
     """
-        获取最新的行情数据
-    :param symbol: 合约代码，symbol, symbol list, 只支持同种类。获取tick数据时，只支持单个symbol
-    :param instrument:   行情数据类型 ['future', 'option', 'stock', 'bond', 'convertible'] 以及 index
-    :param frequency:   历史数据的频率, 默认为'd', 只支持日线级别以上数据。'5m'代表5分钟线。可支持期货tick级别数据获取，此时频率为'tick'
+        获取最新的行情数据，从每个 symbol 只有一条记录的 index_latest 读取
+    :param symbol: 合约代码，symbol, symbol list, 只支持同种类。None 返回所有主力合约
+    :param instrument:   行情数据类型，目前只有 index 维护了最新行情，其他类型抛出 ValueError
+    :param frequency:   历史数据的频率, 默认为'd', 只支持日线级别以上数据。
     :param fields:      字段名称
-    :return:
-        传入一个symbol，多个fields，函数会返回一个pandas DataFrame
-        传入一个symbol，一个field，函数会返回pandas Series
-        传入多个symbol，一个field，函数会返回一个pandas DataFrame
-        传入多个symbol，函数会返回一个multiIndex DataFrame
+    :return: pd.DataFrame columns=['symbol', 'datetime', 'close', 'amount'] 按成交金额从大到小排列
     """
-    # 连接数据库
-    # conn = connect_mongo(db='quote', username=DATA_ANALYST, password=ANALYST_PWD)
+    if instrument != 'index':
+        raise ValueError('Last price of {} is not supported, only index has a latest collection.'.format(instrument))
 
-    cursor = conn[instrument]
-
-    pipeline = [
-        {
-            '$match': {
-                'symbol': {
-                    '$regex': re.compile(r"88$")
-                }
-            }
-        }, {
-            '$sort': {
-                'datetime': DESCENDING
-            }
-        }, {
-            '$group': {
-                '_id': '$symbol',
-                'datetime': {
-                    '$first': '$datetime'
-                },
-                'close': {
-                    '$first': '$close'
-                },
-                'amount': {
-                    '$first': '$amount'
-                }
-            }
-        }, {
-            '$sort': {
-                'amount': DESCENDING
-            }
-        }
-    ]
+    cursor = conn[instrument + '_latest']
 
-    match_stage = pipeline[0]['$match']
+    filter_dict = {}
     if isinstance(symbol, list):
-        match_stage['symbol'] = {'$in': symbol}
+        filter_dict['symbol'] = {'$in': symbol}
     elif isinstance(symbol, str):
-        match_stage['symbol'] = symbol
+        filter_dict['symbol'] = symbol
     else:
-        log.debug('Search all instruments snapshot start datetime!')
+        filter_dict['series'] = '88'
+        log.debug('Search all instruments last price!')
 
-    last_prices = cursor.aggregate(pipeline)
+    projection = {'_id': 0, 'symbol': 1, 'datetime': 1, 'close': 1, 'amount': 1}
+    last_prices = cursor.find(filter_dict, projection=projection).sort('amount', DESCENDING)
 
-    last_prices_df = pd.DataFrame(list(last_prices))
-    last_prices_df.rename(columns={'_id': 'symbol'}, inplace=True)
-    return last_prices_df
+    return read_cursor(last_prices, projection=projection)
 
 
-def get_future_snapshot(symbol=None, instrument='index', threshold=1e9):
-    if symbol is None:
-        symbol = get_instrument_symbols(by='amount', threshold=threshold)
-
-    start_df = get_peak_start_date(symbol=symbol)
-
-    start_df['start_date'] = start_df['start_date'].fillna(datetime(1970, 1, 1))
+# 展期收益率使用的指数，77 交割月合约 88 主力合约 99 远月合约
+YIELD_SERIES = {'77': 'deliver', '88': 'domain', '99': 'far_month'}
 
-    # price status
-    # columns = ['name', 'percentile', 'wave_rt',
-    #            'amount', 'close', 'highest', 'lowest',
-    #            'contract', 'start_date', 'datetime']
+SNAPSHOT_COLUMNS = ['name', 'wave_rt', 'amount', 'close', 'highest', 'lowest', 'contract', 'start_date', 'datetime',
+                    'domain_basis', 'far_month_basis', 'deliver_basis', 'nearby_yield', 'far_month_yield']
 
-    snapshot_df = pd.DataFrame()
 
-    index_cursor = conn[instrument]
-
-    for row in start_df.itertuples():
-        symbol, start_date = row.symbol, row.start_date
-        filter_dict = {
-            'symbol': symbol,
-            'datetime': {
-                '$gte': start_date
-            }
-        }
-
-        hq = index_cursor.find(filter_dict).sort([('datetime', DESCENDING)])
-
-        hq_df = pd.DataFrame(list(hq))
-
-        hq_df = hq_df[hq_df['low'] > 0]  # 历史成交量可能为0，没有成交价格
-
-        last_hq = hq_df.iloc[0]
-
-        code = last_hq['code']
-        snapshot_df.loc[code, 'name'] = CODE2NAME_MAP.get(code, code)
-
-        close = last_hq['close']
-        highest = hq_df['high'].max()
-        lowest = hq_df['low'].min()
-        snapshot_df.loc[code, 'wave_rt'] = (close - lowest) / (highest - lowest)
+def _get_wave_status(cursor, start_df):
+    """
+    一次聚合查询所有品种从分析起点开始的最高价、最低价和最新行情
+    :param cursor: index collection
+    :param start_df: pd.DataFrame columns=['symbol', 'start_date']
+    :return: pd.DataFrame index=code
+    """
+    conditions = [{'symbol': row.symbol, 'datetime': {'$gte': row.start_date.to_pydatetime()}}
+                  for row in start_df.itertuples()]
+    pipeline = [
+        {'$match': {'$or': conditions, 'low': {'$gt': 0}}},  # 历史成交量可能为0，没有成交价格
+        {'$sort': {'datetime': DESCENDING}},
+        {'$group': {'_id': '$symbol',
+                    'code': {'$first': '$code'},
+                    'datetime': {'$first': '$datetime'},
+                    'close': {'$first': '$close'},
+                    'amount': {'$first': '$amount'},
+                    'contract': {'$first': '$contract'},
+                    'highest': {'$max': '$high'},
+                    'lowest': {'$min': '$low'}}}
+    ]
+    status_df = read_cursor(cursor.aggregate(pipeline, allowDiskUse=True))
+    if status_df.empty:
+        return status_df
 
-        snapshot_df.loc[code, 'amount'] = last_hq['amount'] / 1e8
-        snapshot_df.loc[code, 'close'] = close
-        snapshot_df.loc[code, 'highest'] = highest
-        snapshot_df.loc[code, 'lowest'] = lowest
-        snapshot_df.loc[code, 'contract'] = last_hq['contract']
-        snapshot_df.loc[code, 'start_date'] = start_date
-        start_date = snapshot_df.loc[code, 'datetime'] = last_hq['datetime']
+    start_dates = start_df.set_index('symbol')['start_date']
+    status_df['start_date'] = status_df['_id'].map(start_dates)
+    status_df['name'] = status_df['code'].map(lambda x: CODE2NAME_MAP.get(x, x))
+    status_df['wave_rt'] = (status_df['close'] - status_df['lowest']) / (status_df['highest'] - status_df['lowest'])
+    status_df['amount'] = status_df['amount'] / 1e8
+    return status_df.drop(columns='_id').set_index('code')
 
-        filter_dict = {
-            'symbol': {"$regex": "^" + code + "[7-9]{2}$"},
-            'datetime': {
-                '$gte': start_date
-            }
-        }
 
-        projection = {
-            "_id": 0,
-            "symbol": 1,
-            "datetime": 1,
-            "close": 1
-        }
+def _get_roll_yield_status(cursor, last_dates):
+    """
+    一次查询所有品种最新交易日的交割月、主力、远月价格和现货价格，计算基差和展期收益率
+    :param cursor: index collection
+    :param last_dates: pd.Series index=code values=最新交易日
+    :return: pd.DataFrame index=code
+    """
+    codes = last_dates.index.to_list()
+    start = last_dates.min().to_pydatetime()
+
+    symbols = [code + series for code in codes for series in YIELD_SERIES]
+    projection = {'_id': 0, 'symbol': 1, 'datetime': 1, 'close': 1}
+    hq = cursor.find({'symbol': {'$in': symbols}, 'datetime': {'$gte': start}}, projection=projection)
+    hq_df = read_cursor(hq, projection=projection)
+
+    projection = {'_id': 0, 'code': 1, 'datetime': 1, 'spot': 1}
+    spot = conn['spot_price'].find({'code': {'$in': codes}, 'datetime': {'$gte': start}}, projection=projection)
+    spot_df = read_cursor(spot, projection=projection)
+
+    if hq_df.empty:
+        return pd.DataFrame(index=last_dates.index)
+
+    hq_df['code'] = hq_df['symbol'].str[:-2]
+    hq_df['series'] = hq_df['symbol'].str[-2:].map(YIELD_SERIES)
+    hq_df = hq_df[hq_df['datetime'] >= hq_df['code'].map(last_dates)]
+    yield_df = hq_df.pivot_table(index=['code', 'datetime'], columns='series', values='close', aggfunc='last')
+    yield_df = yield_df.reindex(columns=list(YIELD_SERIES.values()))
+
+    incomplete = yield_df.index.get_level_values('code')[yield_df.isna().any(axis=1).values].unique()
+    if len(incomplete):
+        log.warning('{} hq data are not enough!'.format(incomplete.to_list()))
+
+    # 有现货价格的品种只使用现货和期货价格都存在的交易日
+    if not spot_df.empty:
+        spot_df = spot_df[spot_df['datetime'] >= spot_df['code'].map(last_dates)]
+    if spot_df.empty:
+        yield_df['spot'] = np.nan
+    else:
+        spot_df = spot_df.drop_duplicates(['code', 'datetime'], keep='last').set_index(['code', 'datetime'])
+        yield_df = yield_df.join(spot_df['spot'], how='left')
+        has_spot = yield_df.index.get_level_values('code').isin(spot_df.index.get_level_values('code'))
+        yield_df = yield_df[~has_spot | yield_df.notna().all(axis=1)]
 
-        # 只需要取最后一天的数据
-        hq = index_cursor.find(filter_dict, projection=projection)
+    last_df = yield_df.sort_index().groupby(level='code').tail(1).reset_index(level='datetime', drop=True)
+    for name in ['deliver', 'domain', 'far_month']:
+        last_df[name + '_basis'] = last_df[name] / last_df['spot'] - 1
+    last_df['nearby_yield'] = last_df['domain'] / last_df['deliver'] - 1
+    last_df['far_month_yield'] = last_df['far_month'] / last_df['domain'] - 1
+    return last_df
 
-        hq_df = pd.DataFrame(list(hq))
-        hq_df = hq_df.pivot(index='datetime', columns='symbol', values='close')
 
-        if len(hq_df.columns) != 3:
-            log.warning('{} hq data are not enough!'.format(code))
+def get_future_snapshot(symbol=None, instrument='index', threshold=1e9):
+    """
+    所有品种的价格位置、基差和展期收益率，每个 collection 只查询一次，各指标按列计算
+    :param symbol: symbol list，None 按成交金额选择品种
+    :param instrument: 'index'
+    :param threshold: 成交金额的阈值
+    :return: pd.DataFrame index=code 按 wave_rt 排序，attrs['timings'] 记录各阶段耗时
+    """
+    timings = {}
+    begin = time.perf_counter()
+    if symbol is None:
+        symbol = get_instrument_symbols(by='amount', threshold=threshold)
 
-        spot_cursor = conn['spot_price']
-        filter_dict = {"code": code,
-                       'datetime': {
-                           '$gte': start_date
-                       }}
-        projection = {"_id": 0, "datetime": 1, "spot": 1}
-        spot = spot_cursor.find(filter_dict, projection=projection)
-        spot_df = pd.DataFrame(list(spot))
-        if spot_df.empty:
-            yield_df = hq_df
-            yield_df.columns = ['deliver', 'domain', 'far_month']
-            yield_df['deliver_basis'] = np.nan
-        else:
-            spot_df.set_index('datetime', inplace=True)
-            yield_df = pd.concat([spot_df, hq_df], axis=1)
-            yield_df = yield_df.dropna()
-            yield_df.columns = ['spot', 'deliver', 'domain', 'far_month']
-            yield_df['deliver_basis'] = (yield_df['deliver'] / yield_df['spot'] - 1)
-            yield_df['domain_basis'] = (yield_df['domain'] / yield_df['spot'] - 1)
-            yield_df['far_month_basis'] = (yield_df['far_month'] / yield_df['spot'] - 1)
+    start_df = get_peak_start_date(symbol=symbol)
+    start_df['start_date'] = start_df['start_date'].fillna(datetime(1970, 1, 1))
+    timings['start_date'] = time.perf_counter() - begin
 
-            last_yield = yield_df.iloc[-1]
+    index_cursor = conn[instrument]
 
-            snapshot_df.loc[code, 'domain_basis'] = last_yield['domain_basis']
-            snapshot_df.loc[code, 'far_month_basis'] = last_yield['far_month_basis']
+    begin = time.perf_counter()
+    status_df = _get_wave_status(index_cursor, start_df)
+    timings['wave'] = time.perf_counter() - begin
+    if status_df.empty:
+        log.info('None of snapshot hq return!')
+        return pd.DataFrame(columns=SNAPSHOT_COLUMNS)
 
-        yield_df['nearby_yield'] = (yield_df['domain'] / yield_df['deliver'] - 1)
-        yield_df['far_month_yield'] = (yield_df['far_month'] / yield_df['domain'] - 1)
+    begin = time.perf_counter()
+    yield_df = _get_roll_yield_status(index_cursor, status_df['datetime'])
+    timings['roll_yield'] = time.perf_counter() - begin
 
-        last_yield = yield_df.iloc[-1]
+    snapshot_df = status_df.join(yield_df.drop(columns=['deliver', 'domain', 'far_month', 'spot'], errors='ignore'))
+    snapshot_df = snapshot_df.reindex(columns=SNAPSHOT_COLUMNS)
+    snapshot_df.sort_values(by='wave_rt', inplace=True)
 
-        snapshot_df.loc[code, 'deliver_basis'] = last_yield['deliver_basis']
+    timings['total'] = sum(timings.values())
+    snapshot_df.attrs['timings'] = timings
+    log.info('Snapshot of {} symbols in {:.3f}s: {}'.format(
+        len(snapshot_df), timings['total'], {key: round(value, 3) for key, value in timings.items()}))
+    return snapshot_df
 
-        snapshot_df.loc[code, 'nearby_yield'] = last_yield['nearby_yield']
-        snapshot_df.loc[code, 'far_month_yield'] = last_yield['far_month_yield']
 
-    snapshot_df.sort_values(by='wave_rt', inplace=True)
-    return snapshot_df
+def benchmark_snapshot(threshold=1e11, repeat=5):
+    """
+    测量 get_future_snapshot 的延迟
+    :param threshold: 成交金额的阈值
+    :param repeat: 运行次数
+    :return: pd.DataFrame 每次运行各阶段的耗时，最后两行为平均值和最小值
+    """
+    timings = [get_future_snapshot(threshold=threshold).attrs['timings'] for _ in range(repeat)]
+    timing_df = pd.DataFrame(timings)
+    timing_df.loc['mean'] = timing_df.mean()
+    timing_df.loc['min'] = timing_df.iloc[:-1].min()
+    return timing_df
 
 
 def generate_future_report():
@@ -428,6 +420,7 @@ if __name__ == '__main__':
     # block_status_df.to_excel(writer, sheet_name='block_status')
     # roll_yield_df.to_excel(writer, sheet_name='roll_yield')
     # print(last_price_df)
+    # print(benchmark_snapshot())
     code = 'I'
     start_date = datetime(2016, 11, 24)
     generate_future_detail_report(code=code, start_date=start_date)
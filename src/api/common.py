@@ -1,12 +1,11 @@
 # -*- coding: utf-8 -*-
-import re
 from datetime import datetime
 
 import pandas as pd
 from pymongo import ASCENDING, DESCENDING
 
 from src.api import conn
-from src.util import connect_mongo
+from src.util import connect_mongo, read_cursor, read_history, get_synced_dates
 from src.api.cons import FREQ
 from src.setting import DATA_ANALYST, ANALYST_PWD
 from log import LogHandler
@@ -67,38 +66,112 @@ def get_price(symbol=None, instrument='index', start_date=None, end_date=None, f
 
     cursor = conn[instrument]
 
-    filter_dict = {}
     if isinstance(symbol, list):
-        filter_dict['symbol'] = {'$in': symbol}
+        symbols = symbol
     elif isinstance(symbol, str):
-        filter_dict['symbol'] = symbol
+        symbols = [symbol]
     else:
+        symbols = None
         log.debug('Return all commodities hq!')
 
-    if start_date is not None:
-        filter_dict['datetime'] = {'$gte': start_date}
-
-    if end_date is not None:
-        if 'datetime' in filter_dict:
-            filter_dict['datetime']['$lte'] = end_date
-        else:
-            filter_dict['datetime'] = {'$lte': end_date}
+    def datetime_filter(start):
+        date_dict = {}
+        if start is not None:
+            date_dict['$gte'] = start
+        if end_date is not None:
+            date_dict['$lte'] = end_date
+        return date_dict
 
     project_dict = {'_id': 0}
+    columns = None
     if isinstance(fields, str):
         project_dict.update({'datetime': 1, fields: 1, 'symbol': 1})
+        columns = [fields]
     elif isinstance(fields, list):
         project_dict['datetime'] = 1
         project_dict.update({x: 1 for x in fields})
         project_dict['symbol'] = 1
+        columns = fields
+
+    # 本地已经同步的历史数据直接读取，Mongo 只查询同步截止时间之后的数据
+    synced = get_synced_dates(instrument)
+    history_df = None
+    if synced:
+        history_df = read_history(instrument, symbols=symbols, start=start_date, end=end_date, columns=columns)
+
+    if history_df is None:
+        filter_dict = {}
+        if symbols is not None:
+            filter_dict['symbol'] = {'$in': symbols} if isinstance(symbol, list) else symbol
+        date_dict = datetime_filter(start_date)
+        if date_dict:
+            filter_dict['datetime'] = date_dict
+    elif symbols is not None:
+        filters = []
+        for x in symbols:
+            start = synced.get(x)
+            if start is None or (start_date is not None and start_date > start):
+                start = start_date
+            filter_dict = {'symbol': x}
+            date_dict = datetime_filter(start)
+            if date_dict:
+                filter_dict['datetime'] = date_dict
+            filters.append(filter_dict)
+        filter_dict = filters[0] if len(filters) == 1 else {'$or': filters}
+    else:
+        # 没有同步的 symbol 不限制开始时间，已经同步的 symbol 只查询最早的同步截止时间之后的数据
+        start = min(synced.values())
+        if start_date is not None and start_date > start:
+            start = start_date
+        unsynced_dict = {'symbol': {'$nin': list(synced)}}
+        date_dict = datetime_filter(start_date)
+        if date_dict:
+            unsynced_dict['datetime'] = date_dict
+        filter_dict = {'$or': [unsynced_dict, {'datetime': datetime_filter(start)}]}
 
     hq = cursor.find(filter_dict, project_dict).sort([("datetime", ASCENDING)])
 
     # Expand the cursor and construct the DataFrame
-    hq_df = pd.DataFrame(list(hq))
+    hq_df = read_cursor(hq, projection=project_dict)
+
+    if history_df is not None:
+        if symbols is None and not hq_df.empty:  # 去掉本地已经有的数据
+            synced_dates = hq_df['symbol'].map(synced)
+            hq_df = hq_df[synced_dates.isna() | (hq_df['datetime'] >= synced_dates)]
+        hq_df = pd.concat([history_df, hq_df], ignore_index=True, sort=False)
+        hq_df = hq_df.sort_values(['datetime', 'symbol'], kind='mergesort').reset_index(drop=True)
+
     return hq_df
 
 
+def get_symbols(series=None, code=None, market=None, active_since=None):
+    """
+        从 symbol 维度表获取指数代码
+    :param series:  指数类型 '00' 持仓量加权 '11' 成交量加权 '77' 交割月 '88' 主力 '99' 远月，str or list
+    :param code:    品种代码，str or list
+    :param market:  交易所
+    :param active_since: datetime 最后交易日不早于该日期
+    :return: list of symbol
+    """
+    filter_dict = {}
+    for key, value in (('series', series), ('code', code)):
+        if isinstance(value, (list, tuple)):
+            filter_dict[key] = {'$in': list(value)}
+        elif value is not None:
+            filter_dict[key] = value
+
+    if market is not None:
+        filter_dict['market'] = market
+
+    if active_since is not None:
+        filter_dict['last_date'] = {'$gte': active_since}
+
+    symbols = conn['symbol'].distinct('symbol', filter_dict)
+    if not symbols:
+        log.warning('No symbol found in symbol table: {}'.format(filter_dict))
+    return symbols
+
+
 def get_blocks(symbol=None, start_date=None, end_date=None, frequency='d'):
     """
         获取行情数据
@@ -143,7 +216,7 @@ def get_blocks(symbol=None, start_date=None, end_date=None, frequency='d'):
     blocks = cursor.find(filter_dict, project_dict).sort('start_date', ASCENDING)
 
     # Expand the cursor and construct the DataFrame
-    block_df = pd.DataFrame(list(blocks))
+    block_df = read_cursor(blocks, projection=project_dict)
     return block_df
 
 
@@ -191,7 +264,7 @@ def get_segments(symbol=None, start_date=None, end_date=None, frequency='d'):
     segments = cursor.find(filter_dict, project_dict).sort('datetime', ASCENDING)
 
     # Expand the cursor and construct the DataFrame
-    segment_df = pd.DataFrame(list(segments))
+    segment_df = read_cursor(segments, projection=project_dict)
     return segment_df
 
 
@@ -213,9 +286,6 @@ def get_peak_start_date(symbol=None, frequency='m', peak_type=None, skip=1):
     pipeline = [
         {
             '$match': {
-                'symbol': {
-                    '$regex': re.compile(r"88$")
-                },
                 'frequency': FREQ.index(frequency),
                 'sn': 0
             }
@@ -253,11 +323,13 @@ def get_peak_start_date(symbol=None, frequency='m', peak_type=None, skip=1):
     elif isinstance(symbol, str):
         match_stage['symbol'] = symbol
     else:
+        # 没有指定合约时才查询所有连续合约
+        match_stage['symbol'] = {'$in': get_symbols(series='88')}
         log.debug('Search all instruments snapshot start datetime!')
 
     dates = cursor.aggregate(pipeline)
 
-    dates_df = pd.DataFrame(list(dates))
+    dates_df = read_cursor(dates)
 
     if isinstance(symbol, list):
         return dates_df
@@ -4,7 +4,8 @@ import pandas as pd
 from datetime import datetime
 
 from src.api import conn
-from src.util import connect_mongo
+from src.api.common import get_price
+from src.util import connect_mongo, read_cursor
 from log import LogHandler
 
 log = LogHandler('api.log')
@@ -37,9 +38,10 @@ def get_dominant(code, start_date=None, end_date=None):
         else:
             filter_dict['datetime'] = {'$lte': end_date}
 
-    contract = cursor.find(filter_dict, {'_id': 0, 'datetime': 1, 'contract': 1})
+    projection = {'_id': 0, 'datetime': 1, 'contract': 1}
+    contract = cursor.find(filter_dict, projection)
 
-    contract_df = pd.DataFrame(list(contract))
+    contract_df = read_cursor(contract, projection=projection)
 
     contract_df.set_index('datetime', inplace=True)
 
@@ -64,9 +66,10 @@ def get_contracts(code, date=None):
 
     filter_dict = {'code': code, 'datetime': date}
 
-    contract = cursor.find(filter_dict, {'_id': 0, 'symbol': 1})
+    projection = {'_id': 0, 'symbol': 1}
+    contract = cursor.find(filter_dict, projection)
 
-    return pd.DataFrame(list(contract))
+    return read_cursor(contract, projection=projection)
 
 
 def get_member_rank(symbol, trading_date, rank_by):
@@ -108,34 +111,15 @@ def get_roll_yield(code=None, start_date=datetime(1970, 1, 1), end_date=None):
     :return:
     """
     assert isinstance(code, str)
-    index_cursor = conn['index']
-    filter_dict = {
-        'symbol': {"$regex": "^" + code + "[7-9]{2}$"},
-        'datetime': {
-            '$gte': start_date
-        }
-    }
-
-    if end_date:
-        filter_dict['datetime']['$lte'] = end_date
-
-    projection = {
-        "_id": 0,
-        "symbol": 1,
-        "datetime": 1,
-        "close": 1
-    }
-
-    hq = index_cursor.find(filter_dict, projection=projection)
-
-    hq_df = pd.DataFrame(list(hq))
+    symbols = [code + '77', code + '88', code + '99']
+    hq_df = get_price(symbols, instrument='index', start_date=start_date, end_date=end_date, fields=['close'])
     hq_df = hq_df.pivot(index='datetime', columns='symbol', values='close')
 
     spot_cursor = conn['spot_price']
     filter_dict = {"code": code}
     projection = {"_id": 0, "datetime": 1, "spot": 1}
     spot = spot_cursor.find(filter_dict, projection=projection)
-    spot_df = pd.DataFrame(list(spot))
+    spot_df = read_cursor(spot, projection=projection)
 
     name = {'deliver': code + '77',
             'domain': code + '88',
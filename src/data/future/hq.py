@@ -1,25 +1,35 @@
 # -*- coding: utf-8 -*-
 import json
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
 
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne, ReplaceOne
+from pymongo.errors import PyMongoError
 
 from src.data import conn
+from src.setting import DATA_COLLECTOR, COLLECTOR_PWD, BUILD_WORKERS
 from src.data.setting import TRADE_BEGIN_DATE
 from src.data.future.setting import NAME2CODE_MAP, COLUMNS_MAP
 from src.data.future.utils import get_download_file_index, move_data_files, get_exist_files, \
     split_symbol
-from src.data.setting import RAW_HQ_DIR, INSTRUMENT_TYPE
-from src.util import get_post_text, get_html_text
+from src.data.setting import RAW_HQ_DIR, INSTRUMENT_TYPE, DOWNLOAD_WORKERS, DOWNLOAD_RETRIES, DOWNLOAD_INTERVAL, \
+    INSERT_BATCH_DAYS, LATEST_WINDOW_DAYS, LATEST_RECENT_FIELDS
+from src.data.schema import UNIQUE_KEYS, ensure_unique_index
+from src.util import get_post_text, get_html_text, download_concurrently, NO_DATA, Crawler, read_cursor, connect_mongo, \
+    upsert_many
 from log import LogHandler
 
 # TIME_WAITING = 1
 log = LogHandler('data.log')
 
+# 下载行情的客户端不自动重试，重试和等待由 download_concurrently 统一处理，每次重试都经过交易所的限速
+hq_crawler = Crawler()
+
 # ----------------------------------download data from web-----------------
 def is_data_empty(data):
     """
@@ -39,6 +49,15 @@ def is_data_empty(data):
         return False
 
 
+def is_download_error(data):
+    """
+    判断下载是否出错，连接错误返回 None，服务器错误返回 5xx 状态码，需要重试
+    :param data: pd.DataFrame or str or int
+    :return: True 下载出错，False 下载成功，数据可能为空
+    """
+    return data is None or (isinstance(data, int) and data >= 500)
+
+
 def download_cffex_hq_by_date(date: datetime, category=0):
     """
     获取中国金融期货交易所交易所日交易数据 datetime(2010, 4, 30)
@@ -56,7 +75,7 @@ def download_cffex_hq_by_date(date: datetime, category=0):
     url_template = 'http://www.cffex.com.cn/fzjy/mrhq/{}/{}/{}_1.csv'
     url = url_template.format(date.strftime('%Y%m'), date.strftime('%d'), date.strftime('%Y%m%d'))
 
-    return get_html_text(url)
+    return get_html_text(url, client=hq_crawler)
 
 
 def download_czce_hq_by_date(date: datetime, category=0):
@@ -76,7 +95,7 @@ def download_czce_hq_by_date(date: datetime, category=0):
 
     :param date: datetime
     :param category: 行情类型, 0期货 或 1期权
-    :return pd.DataFrame
+    :return pd.DataFrame，下载出错时返回 None
 
     """
     assert date <= datetime.today()
@@ -101,7 +120,10 @@ def download_czce_hq_by_date(date: datetime, category=0):
     else:
         return pd.DataFrame()
 
-    text = get_html_text(url)
+    text = get_html_text(url, client=hq_crawler)
+
+    if is_download_error(text):
+        return None
 
     if is_data_empty(text):
         return ret
@@ -141,7 +163,7 @@ def download_shfe_hq_by_date(date: datetime, category=0):
                     'http://www.shfe.com.cn/data/dailydata/option/kx/kx{}.dat']
     url = url_template[category].format(date.strftime('%Y%m%d'))
 
-    return get_html_text(url)
+    return get_html_text(url, client=hq_crawler)
 
 
 def download_dce_hq_by_date(date: datetime, code='all', category=0):
@@ -173,7 +195,7 @@ def download_dce_hq_by_date(date: datetime, code='all', category=0):
                  'month': date.month - 1,
                  'day': date.day,
                  'exportFlag': 'txt'}
-    return get_post_text(url, form_data)
+    return get_post_text(url, form_data, client=hq_crawler)
 
 
 def download_hq_by_date(date, file_path, market='dce', category=0):
@@ -183,7 +205,7 @@ def download_hq_by_date(date, file_path, market='dce', category=0):
     :param file_path: 存储文件的地址
     :param market: 交易所代码
     :param category: 0:期货 1：期权
-    :return: pd.DataFrame
+    :return: True 下载成功，NO_DATA 交易所当天没有数据，False 下载出错需要重试
     """
     assert category in [0, 1]
     assert market in ['dce', 'czce', 'shfe', 'cffex']
@@ -196,11 +218,14 @@ def download_hq_by_date(date, file_path, market='dce', category=0):
     data = get_exchange_hq_func[market](date, category=category)
     date_str = date.strftime('%Y%m%d')
 
-    if is_data_empty(data):
+    if is_download_error(data):
         log.warning('{} {} data:{} is not downloaded! '.format(market, date_str, category))
-        # time.sleep(np.random.rand() * TIME_WAITING * 3)
         return False
 
+    if is_data_empty(data):
+        log.info('{} {} data:{} is empty, no trading on this day.'.format(market, date_str, category))
+        return NO_DATA
+
     if market == 'czce':
         data.to_csv(file_path, encoding='gb2312')
     else:
@@ -209,14 +234,13 @@ def download_hq_by_date(date, file_path, market='dce', category=0):
     return True
 
 
-def download_hq_by_dates(market, start, category=0):
+def get_download_hq_tasks(market, start, category=0):
     """
-    根据日期连续下载交易所日交易数据
-    :param start:
-    :param market:
+    计算某个交易所需要下载的日交易数据
+    :param market: 交易所代码
+    :param start: 从某个交易日开始下载数据
     :param category: 行情类型, 0期货 或 1期权
-    :return True False: 说明不用下载数据
-
+    :return: list of (market, name, func, args) download_concurrently 的任务列表
     """
     assert category in [0, 1]
     assert market in ['dce', 'czce', 'shfe', 'cffex']
@@ -225,19 +249,49 @@ def download_hq_by_dates(market, start, category=0):
 
     file_index = get_download_file_index(target, start=start)
 
-    if file_index.empty:
-        return False
-
+    tasks = []
     for dt in file_index:
-        print('{} downloading {} {} hq:{} data!'.format(
-            datetime.now().strftime('%H:%M:%S'), market, dt.strftime('%Y-%m-%d'), category))
         date_str = dt.strftime('%Y%m%d')
         file_path = target / '{}.day'.format(date_str)
-        download_hq_by_date(dt, file_path, market, category)
-        # time.sleep(np.random.rand() * TIME_WAITING)
+        name = '{} hq:{}'.format(date_str, category)
+        tasks.append((market, name, download_hq_by_date, (dt, file_path, market, category)))
+
+    return tasks
+
+
+def download_hq_by_markets(starts, category=0, workers=DOWNLOAD_WORKERS):
+    """
+    多个交易所同时下载日交易数据，每个交易所按 DOWNLOAD_INTERVAL 限速
+    :param starts: dict {market: start} 各交易所开始下载的日期
+    :param category: 行情类型, 0期货 或 1期权
+    :param workers: 下载线程数
+    :return True False: 说明不用下载数据
+    """
+    tasks = []
+    for market, start in starts.items():
+        tasks += get_download_hq_tasks(market, start, category)
+
+    if len(tasks) == 0:
+        return False
+
+    download_concurrently(tasks, DOWNLOAD_INTERVAL, workers=workers, retries=DOWNLOAD_RETRIES)
+    log.info('Crawler latency by host:\n{}'.format(hq_crawler.get_stats()))
     return True
 
 
+def download_hq_by_dates(market, start, category=0, workers=DOWNLOAD_WORKERS):
+    """
+    根据日期连续下载交易所日交易数据
+    :param start:
+    :param market:
+    :param category: 行情类型, 0期货 或 1期权
+    :param workers: 下载线程数
+    :return True False: 说明不用下载数据
+
+    """
+    return download_hq_by_markets({market: start}, category, workers=workers)
+
+
 def convert_deliver(symbol, date):
     """
     从合约代码中提取交割月份数据
@@ -561,40 +615,137 @@ def transfer_shfe_option_hq(date, file_path, columns_map):
     return hq_df
 
 
-def insert_hq_to_mongo():
+TRANSFER_HQ_FUNC = (
+    {
+        'cffex': transfer_cffex_future_hq,
+        'czce': transfer_czce_future_hq,
+        'shfe': transfer_shfe_future_hq,
+        'dce': transfer_dce_future_hq
+    },
+    {
+        'czce': transfer_czce_option_hq,
+        'shfe': transfer_shfe_option_hq,
+        'dce': transfer_dce_option_hq
+    }
+)
+
+
+def _transfer_hq_file(market, category, date, file_path):
+    """
+    转换单个原始数据文件，可以在子进程中运行
+    :return: (date, file_path, pd.DataFrame)，转换失败时 DataFrame 为 None
+    """
+    columns_map = COLUMNS_MAP[INSTRUMENT_TYPE[category]][market].copy()
+    try:
+        df = TRANSFER_HQ_FUNC[category][market](date, file_path, columns_map)
+    except Exception:
+        log.exception('Transform {} {} {} error.'.format(market, INSTRUMENT_TYPE[category], file_path.name))
+        df = None
+    return date, file_path, None if df is None or df.empty else df
+
+
+def _write_hq_batch(cursor, market, batch):
+    """
+    按唯一键批量 upsert 多天的数据，重复运行不会产生重复记录
+    写入成功后才移动原始数据文件
+    :param batch: list of (date, file_path, pd.DataFrame)
+    :return: int 写入的记录数，失败时返回 0
+    """
+    records = []
+    for _, _, df in batch:
+        records += df.to_dict('records')
+
+    try:
+        upsert_many(cursor, records, UNIQUE_KEYS[cursor.name])
+    except PyMongoError as e:
+        log.error('{} {} insert {} files failure: {!r}'.format(
+            market, cursor.name, len(batch), e))
+        return 0
+
+    for _, file_path, _ in batch:
+        move_data_files(file_path)
+    return len(records)
+
+
+def insert_hq_files(market, category, file_df, workers=BUILD_WORKERS, batch_days=INSERT_BATCH_DAYS):
+    """
+    多进程转换原始数据文件，按 batch_days 天合并为一次无序批量写入
+    :param market: 交易所
+    :param category: 0 期货 1 期权
+    :param file_df: pd.DataFrame index=datetime, columns=['filepath']
+    :param workers: 转换文件的进程数
+    :param batch_days: 每次写入包含的交易日数
+    :return: dict {'files': n, 'rows': n, 'failure': [file name], 'seconds': t}
+    """
+    t = INSTRUMENT_TYPE[category]
+    cursor = conn[t]
+    stat = {'files': 0, 'rows': 0, 'failure': [], 'seconds': 0.}
+    ensure_unique_index(t)
+
+    tasks = [(market, category, row.Index, row.filepath) for row in file_df.itertuples()]
+    if len(tasks) == 0:
+        return stat
+
+    begin = time.perf_counter()
+    if workers > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+        results = executor.map(_transfer_hq_file, *zip(*tasks), chunksize=4)
+    else:
+        executor = None
+        results = (_transfer_hq_file(*task) for task in tasks)
+
+    def flush(batch):
+        rows = _write_hq_batch(cursor, market, batch)
+        if rows:
+            stat['files'] += len(batch)
+            stat['rows'] += rows
+        else:
+            stat['failure'] += [file_path.name for _, file_path, _ in batch]
+
+    try:
+        batch = []
+        for date, file_path, df in results:
+            if df is None:
+                log.error('Transform {} {} {} data failure, please check program.'.format(market, t, date))
+                stat['failure'].append(file_path.name)
+                continue
+
+            batch.append((date, file_path, df))
+            if len(batch) >= batch_days:
+                flush(batch)
+                batch = []
+
+        if batch:
+            flush(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    stat['seconds'] = time.perf_counter() - begin
+    return stat
+
+
+def insert_hq_to_mongo(workers=BUILD_WORKERS):
     """
     下载数据文件，插入mongo数据库
-    :return:
+    :param workers: 转换原始数据文件的进程数
+    :return: pd.DataFrame index=(market, category) columns=['files', 'rows', 'failure', 'seconds', 'rows/s', 'files/s']
     """
     category = [0, 1]
     market = ['dce', 'czce', 'shfe', 'cffex']
 
-    transfer_exchange_hq_func = [
-        {
-            'cffex': transfer_cffex_future_hq,
-            'czce': transfer_czce_future_hq,
-            'shfe': transfer_shfe_future_hq,
-            'dce': transfer_dce_future_hq
-        },
-        {
-            'czce': transfer_czce_option_hq,
-            'shfe': transfer_shfe_option_hq,
-            'dce': transfer_dce_option_hq
-        }
-    ]
-
+    summary = {}
     for c in category:
         t = INSTRUMENT_TYPE[c]
         cursor = conn[t]
+
+        # 各交易所同时下载更新行情的原始数据
+        starts = {}
         for m in market:
-            if m == 'cffex' and c == 1:
-                print("cffex has no option trading.")
+            if m not in TRANSFER_HQ_FUNC[c]:
+                print("{} has no option trading.".format(m))
                 continue
 
-            # if m in ['dce', 'czce', 'shfe'] or c == 1:
-            #     print("debug.")
-            #     continue
-            # 下载更新行情的原始数据
             filer_dict = {"market": m}
             projection = {"_id": 0, "datetime": 1}
 
@@ -603,62 +754,327 @@ def insert_hq_to_mongo():
                 start = TRADE_BEGIN_DATE[m][c]
             else:
                 start = start['datetime'] + timedelta(1)
-            download_hq_by_dates(m, start, c)
+            starts[m] = start
 
+        download_hq_by_markets(starts, c)
+
+        for m, start in starts.items():
             # 需要导入数据库的原始数据文件
-            # file_df = get_insert_mongo_files(m, c, start=start)
             file_df = get_exist_files(RAW_HQ_DIR[c] / m)
-            file_df = file_df[start:]
+            file_df = file_df[start:] if not file_df.empty else file_df
 
             if file_df.empty:
                 print('{} {} hq is updated before!'.format(m, t))
                 continue
-            columns_map = COLUMNS_MAP[t][m].copy()
-            for row in file_df.itertuples():
-                df = transfer_exchange_hq_func[c][m](row.Index, row.filepath, columns_map)
-                if df.empty:
-                    log.error("Transform {} {} {}data failure, please check program.".format(m, t, row.Index))
-                    continue
-                result = cursor.insert_many(df.to_dict('records'))
-                if result:
-                    print('{} {} {} insert success.'.format(m, t, row.filepath.name))
-                    move_data_files(row.filepath)
-                else:
-                    print('{} {} {} insert failure.'.format(m, t, row.filepath.name))
-            print('{} {} hq is updated now!'.format(m, t))
+
+            stat = insert_hq_files(m, c, file_df.sort_index(), workers=workers)
+            summary[(m, t)] = stat
+            print('{} {} hq is updated now! {} files, {} rows in {:.1f}s, {} failure.'.format(
+                m, t, stat['files'], stat['rows'], stat['seconds'], len(stat['failure'])))
+
+    if not summary:
+        return None
+
+    summary_df = pd.DataFrame.from_dict(summary, orient='index')
+    summary_df['rows/s'] = summary_df['rows'] / summary_df['seconds']
+    summary_df['files/s'] = summary_df['files'] / summary_df['seconds']
+    log.info('Insert hq summary:\n{}'.format(summary_df))
+    return summary_df
 
 
 # ----------hq数据更新后更新index数据------------------
-def build_weighted_index(hq_df, weight='volume'):
+def build_weighted_index(hq_df, weight='volume', start=None):
     """
-    对行情数据求加权指数
+    对行情数据求加权指数，价格乘以权重和其他数值字段在一个矩阵中按日期一次求和
     :param hq_df: pd.MultiIndex(datetime symbol)
     :param weight: str 权重指标 'volume', 'openInt'
+    :param start: datetime 只计算该日期之后的指数，None 计算全部日期
     :return: hq_df 剔除了symbol字段或者索引
     """
-    df = hq_df.copy()
-    df = df.dropna()
+    df = hq_df.dropna()
+    if start is not None:
+        df = df[df.index.get_level_values(0) > start]
 
     columns = ['open', 'high', 'low', 'close']
 
-    for column in columns:
-        df[column] = df[column] * df[weight]
+    numeric_df = df.select_dtypes('number')
+    values = numeric_df.to_numpy(dtype='float64')
+    price_loc = [numeric_df.columns.get_loc(column) for column in columns]
+    weight_loc = numeric_df.columns.get_loc(weight)
+    values[:, price_loc] *= values[:, [weight_loc]]
+
+    sum_df = pd.DataFrame(values, index=df.index.get_level_values(0), columns=numeric_df.columns)
+    sum_df = sum_df.groupby(level=0).sum()
+    sum_df[columns] = sum_df[columns].to_numpy() / sum_df[[weight]].to_numpy()
+
+    # 成交量、持仓量等整数字段保持原来的类型
+    int_columns = numeric_df.columns[[x.kind in 'iu' for x in numeric_df.dtypes]]
+    return sum_df.astype({column: numeric_df[column].dtype for column in int_columns})
+
+
+def rank_contracts(hq_df):
+    """
+    按持仓量对同一天的交易合约排序，取排名前三的合约，一次计算所有交易日的主力合约、交割月合约和远月合约
+    持仓量相同的合约保持原来的顺序，结果与逐日 sort_values 的结果相同
+    :param hq_df: pd.DataFrame MultiIndex(datetime symbol), 包含 openInt 列
+    :return: pd.DataFrame index=datetime columns=['domain', 'near', 'next']
+            domain  持仓量最大的合约
+            near    前三名中最先交割的合约
+            next    前三名中在主力合约后交割的合约，没有时使用主力合约
+    """
+    oi_df = hq_df['openInt'].reset_index()
+    oi_df['position'] = np.arange(len(oi_df))
+    oi_df.sort_values(['datetime', 'openInt', 'position'], ascending=[True, False, True],
+                      na_position='last', inplace=True)
+
+    # 预防合约小于3的情况,避免出现交割月和主力合约重合，主力合约和下月合约重合
+    oi_df['rank'] = oi_df.groupby('datetime', sort=False).cumcount()
+    oi_df = oi_df[oi_df['rank'] < 3]
+    top_df = oi_df.set_index(['datetime', 'rank'])['symbol'].unstack().reindex(columns=range(3))
+
+    first, second, third = top_df[0], top_df[1], top_df[2]
+
+    near = first.where(~(second < first), second)
+    near = near.where(~(third < near), third)
+
+    contract_df = pd.DataFrame({'domain': first,
+                                'near': near,
+                                'next': np.where(second > first, second, np.where(third > first, third, first))},
+                               index=top_df.index, columns=['domain', 'near', 'next'])
+    contract_df.columns.name = None
+    return contract_df
+
+
+def build_code_index(code, db=conn):
+    """
+    编制单个品种的指数数据，各品种之间相互独立
+    :param code: 品种代码
+    :param db: quote 数据库，子进程需要传入自己建立的连接
+    :return: str 'success' 插入新数据 'updated' 数据已经是最新 'failure' 插入失败
+    """
+    index_cursor = db['index']
+    hq_cursor = db['future']
+
+    # 获取指数数据最近的主力合约和加权指数记录，主力合约的判断依据是前一天的持仓量
+    last_dates = {}
+    for suffix in ['88', '00', '11']:
+        doc = index_cursor.find_one({'symbol': code + suffix}, projection={'_id': 0, 'datetime': 1},
+                                    sort=[('datetime', DESCENDING)])
+        last_dates[suffix] = doc['datetime'] if doc else None
+
+    if all(last_dates.values()):
+        # 只读取最早一个未更新指数之后的行情
+        filter_dict = {'code': code, 'datetime': {'$gte': min(last_dates.values())}}
+        # 已经改名交易品种['GN', 'WS', 'WT', 'RO', 'ER', 'ME', 'TC']
+        #       老合约     新合约      老合约最后交易日
+        # 甲醇   ME/50吨   MA/10吨       2015-5-15
+        # 动力煤 TC/200吨  ZC/100吨      2016-4-8
+        # 强筋小麦 WS/10吨  WH/20吨      2013-05-23
+        # 硬白小麦 WT/10吨  PM/50吨      2012-11-22
+        # 早籼稻  ER/10吨   RI/20吨      2013-5-23
+        # 绿豆    GN                    2010-3-23
+        # 菜籽油   RO/5吨   OI/10吨      2013-5-15
+        # if code in ['GN', 'WS', 'WT', 'RO', 'ER', 'ME', 'TC']:
+        #     print('{} is the {} last trading day.'.format(last_doc['datetime'].strftime('%Y-%m-%d'), code))
+        #     continue
+        # else:
+        #     print("Build {} future index from {}".format(code, last_doc['datetime']))
+    else:  # 测试指定日期
+        # filter_dict = {'code': code, 'datetime': {'$lte': datetime(2003, 1, 1)}}
+        filter_dict = {'code': code}
+        print("Build {} future index from trade beginning.".format(code))
+
+    # 从数据库读取所需数据
+    hq = hq_cursor.find(filter_dict, {'_id': 0}).sort([("datetime", ASCENDING)])
+    hq_df = read_cursor(hq)
+    if hq_df.empty:
+        print('{} index data have been updated before!'.format(code))
+        return 'updated'
+
+    hq_df.set_index(['datetime', 'symbol'], inplace=True)
+    # 需要按照索引排序
+
+    date_index = hq_df.index.levels[0]
+    if len(date_index) < 2:  # 新的数据
+        print('{} index data have been updated before!'.format(code))
+        return 'updated'
+
+    index_names = ['domain', 'near', 'next']
+    contract_df = rank_contracts(hq_df)
+
+    pre_contract_df = contract_df.shift(1).dropna()
+    hq_df = hq_df.loc[pre_contract_df.index[0]:]  # 期货指数数据从第二个交易日开始
+
+    # 主力合约指数只需要编制上次更新之后的数据
+    if last_dates['88'] is not None:
+        pre_contract_df = pre_contract_df[pre_contract_df.index > last_dates['88']]
+    pre_no_index_df = pre_contract_df.reset_index()
+
+    frames = []
+
+    index_symbol = [code + x for x in ['00', '11', '88', '77', '99']]
+    multi_index_names = ['datetime', 'symbol']
+    # 主力，交割，远月合约数据
+    for name, symbol in zip(index_names, index_symbol[-3:]):
+        if pre_contract_df.empty:
+            break
+
+        multi_index = pd.MultiIndex.from_frame(
+            pre_no_index_df[['datetime', name]], names=multi_index_names)
+        index_diff = multi_index.difference(hq_df.index)
+
+        # 头一天还有交割仓位，第二天合约消失的情况
+        if not index_diff.empty:
+            date_index = index_diff.get_level_values(level=0)
+            pre_contract_df.loc[date_index, name] = contract_df.loc[date_index, name]
+            pre_no_index_df = pre_contract_df.reset_index()
+            multi_index = pd.MultiIndex.from_frame(
+                pre_no_index_df[['datetime', name]], names=multi_index_names)
+            print('{} use {} current day contract'.format(symbol, len(index_diff)))
+
+        index_df = hq_df.loc[multi_index]
+        index_df.reset_index(inplace=True)
+        index_df['contract'] = index_df['symbol']
+        index_df['symbol'] = symbol
+        frames += index_df.to_dict('records')
+
+    # 加权指数，只计算上次更新之后的数据
+    for symbol, suffix, weight_name in zip(index_symbol[:2], ['00', '11'], ['openInt', 'volume']):
+        index_df = build_weighted_index(hq_df, weight=weight_name, start=last_dates[suffix])
+        if index_df.empty:
+            continue
+        index_df.reset_index(inplace=True)
+        index_df['code'] = code
+        index_df['market'] = hq_df.market.iloc[0]
+        index_df['symbol'] = symbol
+        frames += index_df.to_dict('records')
+
+    if len(frames) == 0:
+        print('{} index data have been updated before!'.format(code))
+        return 'updated'
+
+    try:
+        upsert_many(index_cursor, frames, UNIQUE_KEYS['index'])
+        update_symbol_table(frames, db)
+        update_index_latest(list({record['symbol'] for record in frames}), db)
+    except PyMongoError as e:
+        print('{} index data insert failure: {!r}'.format(code, e))
+        return 'failure'
+
+    print('{} index data insert success.'.format(code))
+    return 'success'
+
+
+def _upsert_symbols(cursor, symbol_df):
+    """
+    :param cursor: symbol collection
+    :param symbol_df: pd.DataFrame index=symbol columns=['code', 'market', 'first_date', 'last_date']
+    """
+    requests = []
+    for row in symbol_df.itertuples():
+        requests.append(UpdateOne(
+            {'symbol': row.Index},
+            {'$set': {'code': row.code, 'series': row.Index[-2:], 'market': row.market},
+             '$min': {'first_date': row.first_date.to_pydatetime()},
+             '$max': {'last_date': row.last_date.to_pydatetime()}},
+            upsert=True))
+    if requests:
+        cursor.bulk_write(requests, ordered=False)
+
+
+def update_symbol_table(records, db=conn):
+    """
+    根据新写入的指数数据更新 symbol 维度表：品种代码、指数类型(00 11 77 88 99)、交易所、第一个和最后一个交易日
+    查询某类指数时先从维度表取得 symbol 列表，再用 symbol 索引查询，不需要在 symbol 上用正则表达式扫描
+    :param records: list of dict 指数数据
+    :param db: quote 数据库
+    """
+    df = pd.DataFrame(records, columns=['symbol', 'code', 'market', 'datetime'])
+    symbol_df = df.groupby('symbol').agg(code=('code', 'first'), market=('market', 'first'),
+                                         first_date=('datetime', 'min'), last_date=('datetime', 'max'))
+    _upsert_symbols(db['symbol'], symbol_df)
 
-    df = df.sum(level=0)
 
-    for column in columns:
-        df[column] = df[column] / df[weight]
+def build_symbol_table(db=conn):
+    """
+    从已有的指数数据重新生成 symbol 维度表，只需要在维度表为空时运行一次
+    :param db: quote 数据库
+    :return: int symbol 个数
+    """
+    ensure_unique_index('symbol', db)
+    pipeline = [
+        {'$group': {'_id': '$symbol',
+                    'code': {'$first': '$code'},
+                    'market': {'$first': '$market'},
+                    'first_date': {'$min': '$datetime'},
+                    'last_date': {'$max': '$datetime'}}}
+    ]
+    symbol_df = read_cursor(db['index'].aggregate(pipeline, allowDiskUse=True))
+    if symbol_df.empty:
+        return 0
 
-    return df
+    symbol_df = symbol_df.set_index('_id')
+    _upsert_symbols(db['symbol'], symbol_df)
+    log.info('Build symbol table of {} symbols.'.format(len(symbol_df)))
+    return len(symbol_df)
 
 
-def build_future_index():
+def update_index_latest(symbols, db=conn):
+    """
+    更新 index_latest：每个 symbol 一条记录，保存最新的一根k线和最近 LATEST_WINDOW_DAYS 天的流动性数据
+    最新价格、流动性排名只需要读取这个 collection，不需要对 index 的历史数据排序
+    :param symbols: list of symbol 需要更新的指数
+    :param db: quote 数据库，symbol 维度表需要先更新
+    :return: int 更新的 symbol 个数
+    """
+    last_dates = {doc['symbol']: doc['last_date'] for doc in
+                  db['symbol'].find({'symbol': {'$in': symbols}}, {'_id': 0, 'symbol': 1, 'last_date': 1})}
+    if not last_dates:
+        return 0
+
+    conditions = [{'symbol': symbol, 'datetime': {'$gte': date - timedelta(LATEST_WINDOW_DAYS)}}
+                  for symbol, date in last_dates.items()]
+    hq = db['index'].find({'$or': conditions}, {'_id': 0}).sort([('datetime', ASCENDING)])
+    hq_df = read_cursor(hq)
+    if hq_df.empty:
+        return 0
+
+    recent_fields = [field for field in LATEST_RECENT_FIELDS if field in hq_df.columns]
+    requests = []
+    for symbol, symbol_df in hq_df.groupby('symbol', sort=False):
+        doc = symbol_df.iloc[-1].dropna().to_dict()
+        doc['series'] = symbol[-2:]
+        doc['recent'] = symbol_df[recent_fields].to_dict('records')
+        requests.append(ReplaceOne({'symbol': symbol}, doc, upsert=True))
+
+    db['index_latest'].bulk_write(requests, ordered=False)
+    return len(requests)
+
+
+def _build_code_index_timed(code):
+    """
+    编制单个品种的指数并计时，可以在子进程中运行
+    :return: (code, result, seconds, error)
+    """
+    begin = time.perf_counter()
+    try:
+        # 每个进程使用自己的 MongoClient，主进程中与 conn 共享同一个连接池
+        db = connect_mongo(db='quote', username=DATA_COLLECTOR, password=COLLECTOR_PWD)
+        result, error = build_code_index(code, db), None
+    except Exception as e:
+        log.exception('Build {} future index error.'.format(code))
+        result, error = 'error', repr(e)
+    return code, result, time.perf_counter() - begin, error
+
+
+def build_future_index(workers=BUILD_WORKERS):
     """
     编制指数数据：期货加权指数，主力合约指数，远月主力合约，交割主力合约
     对应的symbol-xx00:持仓量加权，xx11：成交量加权，xx88：主力合约，x99：远月合约，xx77:交割月合约
     按成交量对同一天的交易合约进行排序，取排名前三的交易合约，成交量最大的为主力合约
     最接近当月的合约为交割主力合约，在主力合约后交割的为远月主力合约
-    :return:
+    :param workers: 进程数，大于1时各品种在进程池中并行编制
+    :return: pd.DataFrame index=code columns=['result', 'seconds', 'error'] 每个品种的编制结果和耗时
     """
     # 更新数据库行情数据 独立运行，不在此处更新数据
     # insert_hq_to_mongo()
@@ -666,7 +1082,6 @@ def build_future_index():
     # 连接数据库
     # conn = connect_mongo(db='quote')
 
-    index_cursor = conn['index']
     hq_cursor = conn['future']
 
     # 从 future collection中提取60天内交易的品种
@@ -676,115 +1091,26 @@ def build_future_index():
         print("Don't find any trading code in future collection!")
         return
 
-    # 按品种分别编制指数
-    for code in codes:
-        # 获取指数数据最近的一条主力合约记录，判断依据是前一天的持仓量
-        last_doc = index_cursor.find_one({'symbol': code + '88'}, sort=[('datetime', DESCENDING)])
-
-        if last_doc:
-            filter_dict = {'code': code, 'datetime': {'$gte': last_doc['datetime']}}
-            # 已经改名交易品种['GN', 'WS', 'WT', 'RO', 'ER', 'ME', 'TC']
-            #       老合约     新合约      老合约最后交易日
-            # 甲醇   ME/50吨   MA/10吨       2015-5-15
-            # 动力煤 TC/200吨  ZC/100吨      2016-4-8
-            # 强筋小麦 WS/10吨  WH/20吨      2013-05-23
-            # 硬白小麦 WT/10吨  PM/50吨      2012-11-22
-            # 早籼稻  ER/10吨   RI/20吨      2013-5-23
-            # 绿豆    GN                    2010-3-23
-            # 菜籽油   RO/5吨   OI/10吨      2013-5-15
-            # if code in ['GN', 'WS', 'WT', 'RO', 'ER', 'ME', 'TC']:
-            #     print('{} is the {} last trading day.'.format(last_doc['datetime'].strftime('%Y-%m-%d'), code))
-            #     continue
-            # else:
-            #     print("Build {} future index from {}".format(code, last_doc['datetime']))
-        else:  # 测试指定日期
-            # filter_dict = {'code': code, 'datetime': {'$lte': datetime(2003, 1, 1)}}
-            filter_dict = {'code': code}
-            print("Build {} future index from trade beginning.".format(code))
-
-        # 从数据库读取所需数据
-        hq = hq_cursor.find(filter_dict, {'_id': 0}).sort([("datetime", ASCENDING)])
-        hq_df = pd.DataFrame(list(hq))
-        if hq_df.empty:
-            print('{} index data have been updated before!'.format(code))
-            continue
-
-        hq_df.set_index(['datetime', 'symbol'], inplace=True)
-        # 需要按照索引排序
-
-        date_index = hq_df.index.levels[0]
-        if len(date_index) < 2:  # 新的数据
-            print('{} index data have been updated before!'.format(code))
-            continue
-
-        index_names = ['domain', 'near', 'next']
-        contract_df = pd.DataFrame(index=date_index, columns=index_names)
-
-        for date in date_index:
-            # hq.py:493: PerformanceWarning: indexing past lexsort depth may impact performance.
-            #   s = hq_df.loc[date, 'openInt'].copy()
-            s = hq_df.loc[date, 'openInt'].copy()
-            s.sort_values(ascending=False, inplace=True)
-            s = s[:min(3, len(s))]  # 预防合约小于3的情况,避免出现交割月和主力合约重合，主力合约和下月合约重合
-            domain = s.index[0]
-            contract_df.loc[date, 'domain'] = domain
-            contract_df.loc[date, 'near'] = s.index.min()
-            try:
-                if s.index[1] > domain:
-                    contract_df.loc[date, 'next'] = s.index[1]
-                elif s.index[2] > domain:
-                    contract_df.loc[date, 'next'] = s.index[2]
-                else:
-                    contract_df.loc[date, 'next'] = domain
-            except IndexError:
-                print("{} domain contract is the last contract {}".format(code, domain))
-                contract_df.loc[date, 'next'] = domain
-
-        pre_contract_df = contract_df.shift(1).dropna()
-        # length = len(contract_df)
-        pre_no_index_df = pre_contract_df.reset_index()
-        hq_df = hq_df.loc[pre_no_index_df.datetime[0]:]  # 期货指数数据从第二个交易日开始
-
-        frames = []
-
-        index_symbol = [code + x for x in ['00', '11', '88', '77', '99']]
-        multi_index_names = ['datetime', 'symbol']
-        # 主力，交割，远月合约数据
-        for name, symbol in zip(index_names, index_symbol[-3:]):
+    if conn['symbol'].estimated_document_count() == 0:
+        build_symbol_table()
+    if conn['index_latest'].estimated_document_count() == 0:
+        ensure_unique_index('index_latest')
+        update_index_latest(conn['symbol'].distinct('symbol'))
 
-            multi_index = pd.MultiIndex.from_frame(
-                pre_no_index_df[['datetime', name]], names=multi_index_names)
-            index_diff = multi_index.difference(hq_df.index)
-
-            # 头一天还有交割仓位，第二天合约消失的情况
-            if not index_diff.empty:
-                date_index = index_diff.get_level_values(level=0)
-                pre_contract_df.loc[date_index, name] = contract_df.loc[date_index, name]
-                pre_no_index_df = pre_contract_df.reset_index()
-                multi_index = pd.MultiIndex.from_frame(
-                    pre_no_index_df[['datetime', name]], names=multi_index_names)
-                print('{} use {} current day contract'.format(symbol, len(index_diff)))
-
-            index_df = hq_df.loc[multi_index]
-            index_df.reset_index(inplace=True)
-            index_df['contract'] = index_df['symbol']
-            index_df['symbol'] = symbol
-            frames += index_df.to_dict('records')
-
-        # 加权指数
-        for symbol, weight_name in zip(index_symbol[:2], ['openInt', 'volume']):
-            index_df = build_weighted_index(hq_df, weight=weight_name)
-            index_df.reset_index(inplace=True)
-            index_df['code'] = code
-            index_df['market'] = hq_df.market[0]
-            index_df['symbol'] = symbol
-            frames += index_df.to_dict('records')
-
-        result = index_cursor.insert_many(frames)
-        if result.acknowledged:
-            print('{} index data insert success.'.format(code))
-        else:
-            print('{} index data insert failure.'.format(code))
+    # 按品种分别编制指数
+    begin = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(codes))) as executor:
+            summary = list(executor.map(_build_code_index_timed, codes))
+    else:
+        summary = [_build_code_index_timed(code) for code in codes]
+
+    summary_df = pd.DataFrame(summary, columns=['code', 'result', 'seconds', 'error']).set_index('code')
+    failure_df = summary_df[summary_df['result'].isin(['failure', 'error'])]
+    print('Build {} future index in {:.1f}s, {} failure: {}'.format(
+        len(summary_df), time.perf_counter() - begin, len(failure_df), failure_df.index.to_list()))
+    log.info('Future index build summary:\n{}'.format(summary_df.sort_values('seconds', ascending=False)))
+    return summary_df
 
 
 if __name__ == '__main__':
@@ -64,8 +64,8 @@ def download_shfe_receipt_by_date(date: datetime):
         url_template = "http://www.shfe.com.cn/data/dailydata/{}dailystock.html"
         url = url_template.format(date.strftime('%Y%m%d'))
         try:
-            data = pd.read_html(url, encoding='unicode')[0]
-        except ValueError:
+            data = pd.read_html(get_html_text(url))[0]
+        except (ValueError, TypeError):
             log.warning("{} shfe receipt data is not exist!".format(date.strftime('%Y%m%d')))
             data = pd.DataFrame()
     else:
@@ -96,8 +96,8 @@ def download_dce_receipt_by_date(date: datetime):
 
     try:
         url = url_template.format(date.year, date.month - 1, date.day)
-        data = pd.read_html(url, encoding='unicode')[0]
-    except ValueError:
+        data = pd.read_html(get_html_text(url))[0]
+    except (ValueError, TypeError):
         log.warning("{} dce receipt data is not exist!".format(date.strftime('%Y%m%d')))
         data = pd.DataFrame()
 
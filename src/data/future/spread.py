@@ -5,12 +5,14 @@ import time
 import re
 from datetime import datetime, timedelta
 from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import PyMongoError
 
 from src.data import conn
+from src.data.schema import UNIQUE_KEYS, ensure_unique_index
 from src.data.future.setting import SPREAD_DIR, NAME2CODE_MAP
 from src.data.future.utils import get_download_file_index, get_exist_files, move_data_files
 from log import LogHandler
-from src.util import get_html_tree
+from src.util import get_html_tree, upsert_many
 
 log = LogHandler('future.log')
 
@@ -87,6 +89,7 @@ def insert_spot_to_mongo():
     :return:
     """
     cursor = conn['spot_price']
+    ensure_unique_index('spot_price')
     start = cursor.find_one({}, sort=[("datetime", DESCENDING)])
     if start is None:
         result = download_spot_by_dates()
@@ -120,12 +123,14 @@ def insert_spot_to_mongo():
         spot_df.loc[:, 'code'] = spot_df['code'].transform(lambda x: NAME2CODE_MAP['spread'][x])
         spot_df.loc[:, 'datetime'] = row.Index
 
-        result = cursor.insert_many(spot_df.to_dict('records'))
-        if result:
-            print('{} spot price insert success.'.format(row.filepath.name))
-            move_data_files(row.filepath)
-        else:
-            print('{} spot price insert failure.'.format(row.filepath.name))
+        try:
+            upsert_many(cursor, spot_df.to_dict('records'), UNIQUE_KEYS['spot_price'])
+        except PyMongoError as e:
+            print('{} spot price insert failure: {!r}'.format(row.filepath.name, e))
+            continue
+
+        print('{} spot price insert success.'.format(row.filepath.name))
+        move_data_files(row.filepath)
 
 
 if __name__ == '__main__':
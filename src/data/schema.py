@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+from pymongo import ASCENDING, DESCENDING, DeleteMany, IndexModel
+from pymongo.errors import OperationFailure
+
+from src.data import conn
+from log import LogHandler
+
+log = LogHandler('data.log')
+
+# 每个 collection 中一条记录的唯一键，导入数据时按唯一键 upsert
+UNIQUE_KEYS = {'future': ['market', 'symbol', 'datetime'],
+               'option': ['market', 'symbol', 'datetime'],
+               'index': ['market', 'symbol', 'datetime'],
+               'spot_price': ['code', 'datetime'],
+               'receipt': ['market', 'code', 'datetime'],
+               'symbol': ['symbol'],
+               'index_latest': ['symbol'],
+               'segment_state': ['symbol', 'frequency']}
+
+# 查询使用的索引，唯一索引之外的部分。等值条件在前，排序字段在中间，范围条件在最后，避免内存排序
+INDEXES = {'future': [[('symbol', ASCENDING), ('datetime', ASCENDING)],
+                      [('code', ASCENDING), ('datetime', ASCENDING)],
+                      [('market', ASCENDING), ('datetime', ASCENDING)]],
+           'option': [[('symbol', ASCENDING), ('datetime', ASCENDING)],
+                      [('market', ASCENDING), ('datetime', ASCENDING)]],
+           'index': [[('symbol', ASCENDING), ('datetime', ASCENDING)],
+                     [('code', ASCENDING), ('datetime', ASCENDING)]],
+           'spot_price': [[('datetime', ASCENDING)]],
+           'receipt': [[('market', ASCENDING), ('datetime', ASCENDING)]],
+           'segment': [[('symbol', ASCENDING), ('datetime', ASCENDING), ('frequency', ASCENDING)]],
+           'block': [[('symbol', ASCENDING), ('frequency', ASCENDING), ('enter_date', ASCENDING)],
+                     [('symbol', ASCENDING), ('frequency', ASCENDING), ('start_date', ASCENDING)]],
+           'symbol': [[('series', ASCENDING), ('last_date', ASCENDING)],
+                      [('code', ASCENDING)]]}
+
+# 需要检查执行计划的典型查询 (名称, collection, 查询条件, 排序)，查询条件为 list 时是 aggregate pipeline
+_DATE = datetime(2019, 1, 1)
+CANONICAL_QUERIES = [
+    ('get_price', 'index', {'symbol': {'$in': ['RB88', 'RB99']}, 'datetime': {'$gte': _DATE}},
+     [('datetime', ASCENDING)]),
+    ('get_contract', 'index', {'code': 'RB', 'symbol': 'RB99', 'datetime': {'$gte': _DATE}}, None),
+    ('get_symbols', 'symbol', {'series': {'$in': ['00', '88']}, 'last_date': {'$gte': _DATE}}, None),
+    ('get_contracts', 'future', {'code': 'RB', 'datetime': _DATE}, None),
+    ('get_roll_yield', 'spot_price', {'code': 'RB'}, None),
+    ('insert_hq_to_mongo', 'future', {'market': 'shfe'}, [('datetime', DESCENDING)]),
+    ('insert_spot_to_mongo', 'spot_price', {}, [('datetime', DESCENDING)]),
+    ('insert_receipt_to_mongo', 'receipt', {'market': 'shfe'}, [('datetime', DESCENDING)]),
+    ('build_code_index.last_date', 'index', {'symbol': 'RB88'}, [('datetime', DESCENDING)]),
+    ('build_code_index.hq', 'future', {'code': 'RB', 'datetime': {'$gte': _DATE}}, [('datetime', ASCENDING)]),
+    ('build_base_segments.hq', 'index', {'symbol': 'RB88', 'datetime': {'$gte': _DATE}}, [('datetime', ASCENDING)]),
+    ('build_base_segments.last_doc', 'segment', {'symbol': 'RB88', 'frequency': {'$gte': 6}},
+     [('datetime', DESCENDING)]),
+    ('get_segments', 'segment', {'symbol': 'RB88', 'frequency': {'$gte': 6}, 'datetime': {'$gte': _DATE}},
+     [('datetime', ASCENDING)]),
+    ('build_blocks.last_docs', 'block', {'symbol': 'RB88', 'frequency': 6}, [('enter_date', DESCENDING)]),
+    ('get_blocks', 'block', {'symbol': {'$in': ['RB88', 'CU88']}, 'frequency': 6, 'start_date': {'$gte': _DATE}},
+     [('start_date', ASCENDING)]),
+    ('get_peak_start_date', 'block', [
+        {'$match': {'symbol': {'$in': ['RB88', 'CU88']}, 'frequency': 8, 'sn': 0}},
+        {'$sort': {'start_date': DESCENDING}},
+        {'$group': {'_id': '$symbol', 'start_date': {'$push': '$start_date'}}}], None),
+]
+
+# 执行计划中出现这些阶段说明没有用到合适的索引
+BLOCKING_STAGES = {'COLLSCAN', 'SORT'}
+
+
+def ensure_unique_index(name, db=conn):
+    """
+    建立 collection 的唯一复合索引，索引已经存在时不做任何操作
+    :param name: collection 名称
+    :param db: pymongo Database
+    :return: bool 索引是否存在，已有重复记录时返回 False，需要先运行 remove_duplicates
+    """
+    keys = UNIQUE_KEYS[name]
+    try:
+        db[name].create_index([(key, ASCENDING) for key in keys], unique=True,
+                              name='unique_' + '_'.join(keys))
+    except OperationFailure as e:
+        log.error('{} unique index {} is not created, run remove_duplicates first: {!r}'.format(name, keys, e))
+        return False
+    return True
+
+
+def remove_duplicates(name, db=conn, batch_size=1000):
+    """
+    删除唯一键重复的记录，每组保留最后插入的一条，只需要在建立唯一索引前运行一次
+    :param name: collection 名称
+    :param db: pymongo Database
+    :param batch_size: 每次 bulk_write 删除的组数
+    :return: int 删除的记录数
+    """
+    keys = UNIQUE_KEYS[name]
+    collection = db[name]
+    pipeline = [
+        {'$sort': {'_id': ASCENDING}},
+        {'$group': {'_id': {key: '$' + key for key in keys},
+                    'ids': {'$push': '$_id'},
+                    'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}}
+    ]
+
+    deleted = 0
+    requests = []
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        requests.append(DeleteMany({'_id': {'$in': group['ids'][:-1]}}))
+        if len(requests) >= batch_size:
+            deleted += collection.bulk_write(requests, ordered=False).deleted_count
+            requests = []
+    if requests:
+        deleted += collection.bulk_write(requests, ordered=False).deleted_count
+
+    log.info('{} remove {} duplicate records.'.format(name, deleted))
+    return deleted
+
+
+def ensure_indexes(db=conn):
+    """
+    建立所有 collection 的唯一索引和查询索引，索引已经存在时不做任何操作，启动时调用
+    :param db: pymongo Database
+    :return: dict {collection: [index name]}
+    """
+    for name in UNIQUE_KEYS:
+        ensure_unique_index(name, db)
+
+    result = {}
+    for name, indexes in INDEXES.items():
+        result[name] = db[name].create_indexes([IndexModel(keys) for keys in indexes])
+    return result
+
+
+def _plan_stages(explain, in_plan=False):
+    """
+    递归读取 winningPlan 中所有阶段的名称，兼容 find 和 aggregate 的 explain 结果
+    aggregate 中没有下推到查询层的 $sort 是 pipeline 的一个阶段，在内存中排序，记为 SORT
+    """
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'rejectedPlans':
+                continue
+            if key == 'stages' and isinstance(value, list):
+                for stage in value:
+                    if isinstance(stage, dict) and '$sort' in stage:
+                        yield 'SORT'
+                    else:
+                        yield from _plan_stages(stage, in_plan)
+            elif key == 'stage' and in_plan:
+                yield value
+            else:
+                yield from _plan_stages(value, in_plan or key == 'winningPlan')
+    elif isinstance(explain, list):
+        for value in explain:
+            yield from _plan_stages(value, in_plan)
+
+
+def explain_query(collection, query, sort=None):
+    """
+    :param collection: pymongo Collection
+    :param query: dict 查询条件或者 list aggregate pipeline
+    :param sort: list of (key, direction)
+    :return: list of str 执行计划的阶段名称
+    """
+    if isinstance(query, list):
+        explain = collection.database.command('aggregate', collection.name, pipeline=query, explain=True)
+    else:
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+    return list(_plan_stages(explain))
+
+
+def audit_query_plans(db=conn, raise_error=True):
+    """
+    检查典型查询的执行计划，出现全表扫描或者内存排序时报错
+    :param db: pymongo Database
+    :param raise_error: True 有问题的查询抛出 ValueError，False 只记录日志
+    :return: dict {查询名称: [阶段名称]}
+    """
+    plans = {}
+    failures = []
+    for name, collection, query, sort in CANONICAL_QUERIES:
+        stages = explain_query(db[collection], query, sort)
+        plans[name] = stages
+        blocking = BLOCKING_STAGES.intersection(stages)
+        if blocking:
+            failures.append('{} on {}: {}'.format(name, collection, ', '.join(sorted(blocking))))
+
+    if failures:
+        message = 'Query plans need index:\n' + '\n'.join(failures)
+        if raise_error:
+            raise ValueError(message)
+        log.error(message)
+    else:
+        log.info('{} query plans use index.'.format(len(plans)))
+    return plans
+
+
+def migrate_unique_indexes(db=conn):
+    """
+    一次性迁移：删除已有的重复记录后建立所有唯一索引
+    :param db: pymongo Database
+    :return: dict {collection: 删除的记录数}
+    """
+    result = {}
+    for name in UNIQUE_KEYS:
+        result[name] = remove_duplicates(name, db)
+        ensure_unique_index(name, db)
+    return result
+
+
+if __name__ == '__main__':
+    # print(migrate_unique_indexes())
+    ensure_indexes()
+    print(audit_query_plans())
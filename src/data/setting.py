@@ -22,4 +22,19 @@ TRADE_BEGIN_DATE = {'cffex': [datetime(2010, 4, 30), datetime.today() + timedelt
 
 SRC_DATA_FUTURE = HOME_DIR / 'src/data/future'
 
+# 多线程下载的线程数，重试次数，以及各交易所两次请求之间的最小间隔(秒)
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_INTERVAL = {'cffex': 1.,
+                     'czce': 1.,
+                     'shfe': 1.,
+                     'dce': 2.}
+
+# 行情数据导入数据库时，每次批量写入包含的交易日数
+INSERT_BATCH_DAYS = 60
+
+# index_latest 中保存最近多少天的成交量、成交金额、持仓量，用于计算流动性
+LATEST_WINDOW_DAYS = 30
+LATEST_RECENT_FIELDS = ['datetime', 'volume', 'amount', 'openInt']
+
 DATE_PATTERN = '\d{4}[-/\._]\d{1,2}[-/\._]\d{1,2}|\d{8}'
@@ -1,47 +1,86 @@
 # -*- coding: utf-8 -*-
 
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 
 from log import LogHandler
 
 from src.data.tdx.hq import get_future_day_hq, get_future_min_hq
 from src.data.tdx.basic import get_future_basic
+from src.data.tdx.resample import get_resampled_hq
 
 log = LogHandler('tdx.log')
 
-# TODO 周期转换的处理， 日内的数据由于有夜盘，处理起来较复杂
-# tdx处理是夜盘数据算作下一个交易日，resample函数处理起来会按照时间排序
-# conversion = {'open': 'first', 'high': 'max', 'low': 'min',
-#               'close': 'last', 'openInt' : 'last', 'volume': 'sum',
-#               'comment': 'last'}
+# tdx处理是夜盘数据算作下一个交易日，'30m' 'h' 'w' 由 resample 模块按交易日和交易时段转换
 
-# m30 = df.resample('30min', closed='right', label='right).apply(conversion).dropna()
 
-
-def get_future_hq(code, start=dt.datetime(1970, 1, 1), end=None, freq='d'):
+def get_future_market(code):
     """
-    根据contractid找到对应的market，调用对应的行情函数
+    根据交易品种找到对应的市场
     :param code: IL8 主力合约 IL9 期货指数
-    :param start: 开始时间
-    :param end:   结束时间
-    :param freq: 周期'1m'，'5m'
-    :return:
+    :return: str market，没有找到时返回 None
     """
-    future_basic_info = get_future_basic()
-
-    # 根据交易品种找到对应的市场
     length = len(code)
     if length == 4:
         symbol = code[:2].upper()
     elif length == 3:
         symbol = code[0].upper()
     else:
-        log.warning(code, 'is not listed!')
-    market = future_basic_info.loc[symbol, 'market']
+        log.warning('{} is not listed!'.format(code))
+        return None
+
+    try:
+        return get_future_basic().loc[symbol, 'market']
+    except KeyError:
+        log.warning('{} is not listed!'.format(code))
+        return None
+
+
+def get_future_hq(code, start=dt.datetime(1970, 1, 1), end=None, freq='d', night_session=False):
+    """
+    根据contractid找到对应的market，调用对应的行情函数
+    :param code: IL8 主力合约 IL9 期货指数
+    :param start: 开始时间
+    :param end:   结束时间
+    :param freq: 周期'1m'，'5m'，'30m'，'h'，'d'，'w'
+    :param night_session: 分钟线的夜盘数据是否使用实际的自然时间，默认算作下一个交易日
+    :return:
+    """
+    market = get_future_market(code)
+    if market is None:
+        return None
 
     log.info('freq={}'.format(freq))
 
     if freq == 'd':
         return get_future_day_hq(market=market, code=code, start=start, end=end)
     if freq in ('1m', '5m'):
-        return get_future_min_hq(market=market, code=code, start=start, end=end, freq=freq)
+        return get_future_min_hq(market=market, code=code, start=start, end=end, freq=freq,
+                                 night_session=night_session)
+    if freq in ('30m', 'h', 'w'):
+        return get_resampled_hq(market=market, code=code, freq=freq, start=start, end=end,
+                                night_session=night_session)
+
+
+def get_future_hq_batch(codes, start=dt.datetime(1970, 1, 1), end=None, freq='d', night_session=False, workers=1):
+    """
+    一次读取多个合约同一周期的行情，逐个调用 get_future_hq，只有合约信息在多次调用之间缓存
+    每个行情文件读取时映射，读取完成后立即释放，不保持打开的文件
+    :param codes: list of code, IL8 主力合约 IL9 期货指数
+    :param start: 开始时间
+    :param end:   结束时间
+    :param freq: 周期'1m'，'5m'，'30m'，'h'，'d'，'w'
+    :param night_session: 分钟线的夜盘数据是否使用实际的自然时间
+    :param workers: 读取文件的线程数，1 不使用线程池
+    :return: dict {code: pd.DataFrame}，没有数据的合约值为 None
+    """
+    codes = list(dict.fromkeys(codes))
+
+    def load(code):
+        return get_future_hq(code, start=start, end=end, freq=freq, night_session=night_session)
+
+    if workers > 1 and len(codes) > 1:
+        with ThreadPoolExecutor(max_workers=min(workers, len(codes))) as executor:
+            return dict(zip(codes, executor.map(load, codes)))
+
+    return {code: load(code) for code in codes}
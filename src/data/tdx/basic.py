@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+from functools import lru_cache
 from log import LogHandler
 import pandas as pd
 
@@ -8,7 +9,12 @@ from .setting import tdx_dir
 log = LogHandler(os.path.basename('tdx.basic.log'))
 
 
+@lru_cache(maxsize=1)
 def get_future_basic():
+    """
+    通达信的期货合约信息，只读取一次，返回结果不要修改
+    :return: pd.DataFrame index=code, columns=['category', 'name', 'market']
+    """
     file_name = os.path.join(tdx_dir, 'T0002\hq_cache\code2name.ini')
     df = pd.read_csv(file_name,
                      index_col=0, names=['category', 'name', 'market'], header=None,
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
+import mmap
+import bisect
 import datetime as dt
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 
@@ -18,32 +21,173 @@ def int2date(x):
     return dt.datetime(year, month, day)
 
 
-def _get_future_day_hq(file_handler, count=-1):
-    names = 'datetime', 'open', 'high', 'low', 'close', 'openInt', 'volume', 'comment'
-    offsets = tuple(range(0, 31, 4))
-    formats = 'i4', 'f4', 'f4', 'f4', 'f4', 'i4', 'i4', 'i4'
+def date2int(date):
+    """
+    分钟线文件中日期的存储格式，int2date 的逆运算
+    :param date: datetime
+    :return: int (year - 2004) * 2048 + month * 100 + day
+    """
+    return (date.year - 2004) * 2048 + date.month * 100 + date.day
+
+
+NIGHT_START = 20 * 60  # 夜盘开始的分钟数
+NIGHT_END = 3 * 60  # 凌晨收盘的夜盘结束分钟数
+
+
+def _to_calendar_days(days, time):
+    """
+    夜盘数据的交易日转换为自然日，20点以后为前一个交易日，3点以前为前一个交易日的下一天
+    :param days: np.ndarray datetime64[D] 升序排列的交易日
+    :param time: np.ndarray int 从 0 点开始的分钟数
+    :return: np.ndarray datetime64[D]
+    """
+    if len(days) == 0:
+        return days
+
+    # 文件中前一个交易日，第一个交易日没有前一天的数据时按工作日计算
+    new_day = np.empty(len(days), dtype=bool)
+    new_day[0] = True
+    new_day[1:] = days[1:] != days[:-1]
+    trade_days = days[new_day]
+    prev_days = np.empty_like(trade_days)
+    prev_days[0] = np.busday_offset(trade_days[0], -1, roll='forward')
+    prev_days[1:] = trade_days[:-1]
+    prev_days = prev_days[np.cumsum(new_day) - 1]
+
+    return np.where(time >= NIGHT_START, prev_days,
+                    np.where(time < NIGHT_END, prev_days + np.timedelta64(1, 'D'), days))
+
+
+def decode_min_datetime(date, time, night_session=False):
+    """
+    向量化解析分钟线的日期和时间
+    :param date: np.ndarray 分钟线文件中的日期，(year - 2004) * 2048 + month * 100 + day，为交易日
+    :param time: np.ndarray 分钟线文件中的时间，从 0 点开始的分钟数
+    :param night_session: False 与 int2date 一致，夜盘数据算作下一个交易日
+                          True 夜盘数据转换为实际的自然时间，20点以后为前一个交易日，3点以前为前一个交易日的下一天
+    :return: pd.DatetimeIndex
+    """
+    date = np.asarray(date, dtype=np.int64)
+    time = np.asarray(time, dtype=np.int64)
+
+    year = date // 2048 + 2004
+    month = date % 2048 // 100
+    day = date % 2048 % 100
+    days = ((year - 1970) * 12 + month - 1).astype('M8[M]').astype('M8[D]') + (day - 1).astype('m8[D]')
+
+    if night_session:
+        days = _to_calendar_days(days, time)
+
+    return pd.DatetimeIndex(days.astype('M8[ns]') + time.astype('m8[m]'))
+
+
+def to_calendar_datetime(index):
+    """
+    把夜盘算作下一个交易日的时间索引转换为实际的自然时间
+    :param index: pd.DatetimeIndex 交易日 + 时间，按交易日升序排列
+    :return: pd.DatetimeIndex
+    """
+    days = index.normalize().values.astype('M8[D]')
+    time = ((index.values - index.normalize().values) // np.timedelta64(1, 'm')).astype(np.int64)
+    days = _to_calendar_days(days, time)
+    return pd.DatetimeIndex(days.astype('M8[ns]') + time.astype('m8[m]'), name=index.name)
+
+
+DAY_DTYPE = np.dtype({'names': ('datetime', 'open', 'high', 'low', 'close', 'openInt', 'volume', 'comment'),
+                      'offsets': tuple(range(0, 31, 4)),
+                      'formats': ('i4', 'f4', 'f4', 'f4', 'f4', 'i4', 'i4', 'i4')}, align=True)
+
+MIN_DTYPE = np.dtype({'names': ('date', 'time', 'open', 'high', 'low', 'close', 'openInt', 'volume', 'comment'),
+                      'offsets': (0, 2) + tuple(range(4, 31, 4)),
+                      'formats': ('u2', 'u2', 'f4', 'f4', 'f4', 'f4', 'i4', 'i4', 'i4')}, align=True)
+
+
+@contextmanager
+def _map_hq_file(hq_path, dtype):
+    """
+    只读映射行情文件中完整的记录，退出时释放映射，不长期占用文件，通达信可以随时改写
+    :param hq_path: 行情文件路径
+    :param dtype: 记录的结构类型
+    :return: mmap.mmap，文件中没有完整的记录时为 None
+    """
+    count = os.path.getsize(hq_path) // dtype.itemsize  # 文件正在写入时忽略不完整的记录
+    if count == 0:
+        yield None
+        return
+
+    with open(hq_path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), count * dtype.itemsize, access=mmap.ACCESS_READ)
+    try:
+        yield buffer
+    finally:
+        try:
+            buffer.close()
+        except BufferError:  # 出现异常时 traceback 还引用着数组，映射在数组回收后释放
+            pass
 
-    dt_types = np.dtype({'names': names, 'offsets': offsets, 'formats': formats}, align=True)
-    hq_day_df = pd.DataFrame(np.fromfile(file_handler, dtype=dt_types, count=count))
+
+def _slice_records(buffer, dtype, field, start_key=None, end_key=None, next_day=False):
+    """
+    在按日期排序的 field 字段上二分查找起止位置，复制需要的记录，返回后不再引用映射
+    """
+    records = np.frombuffer(buffer, dtype=dtype)
+    count = len(records)
+    dates = records[field]
+
+    # bisect 每次只访问一个元素，np.searchsorted 会先复制整个字段
+    lo = 0 if start_key is None else bisect.bisect_left(dates, start_key)
+    if lo == count:
+        return None
+    hi = count if end_key is None else bisect.bisect_right(dates, end_key, lo)
+    if next_day and hi < count:
+        hi = bisect.bisect_right(dates, dates[hi], hi)
+
+    return np.array(records[lo:hi])
+
+
+def _read_records(hq_path, dtype, field, start_key=None, end_key=None, next_day=False):
+    """
+    映射行情文件，二分查找起止位置，只读取需要的记录，读取完成后释放映射
+    :param hq_path: 行情文件路径
+    :param dtype: 记录的结构类型
+    :param field: 日期字段
+    :param start_key: 开始日期对应的字段值，None 从第一条记录开始
+    :param end_key: 结束日期对应的字段值，None 到最后一条记录
+    :param next_day: 同时读取 end_key 之后一个交易日的记录，夜盘数据记在下一个交易日
+    :return: np.ndarray 结构数组，文件为空或者 start_key 晚于最后一条记录时返回 None
+    """
+    with _map_hq_file(hq_path, dtype) as buffer:
+        if buffer is None:
+            return None
+        return _slice_records(buffer, dtype, field, start_key, end_key, next_day)
+
+
+def _get_future_day_hq(records):
+    hq_day_df = pd.DataFrame(records)
     hq_day_df.index = pd.to_datetime(hq_day_df['datetime'].astype('str'), errors='coerce')
     hq_day_df.pop('datetime')
     return hq_day_df
 
 
-def _get_future_min_hq(file_handler, count=-1):
-    names = 'date', 'time', 'open', 'high', 'low', 'close', 'openInt', 'volume', 'comment'
-    formats = 'u2', 'u2', 'f4', 'f4', 'f4', 'f4', 'i4', 'i4', 'i4'
-    offsets = (0, 2) + tuple(range(4, 31, 4))
-
-    dt_types = np.dtype({'names': names, 'offsets': offsets, 'formats': formats}, align=True)
-    hq_min_df = pd.DataFrame(np.fromfile(file_handler, dtype=dt_types, count=count))
-
-    hq_min_df.index = hq_min_df.date.transform(int2date) + pd.to_timedelta(hq_min_df.time, unit='m')
+def _get_future_min_hq(records, night_session=False):
+    hq_min_df = pd.DataFrame(records)
+    hq_min_df.index = decode_min_datetime(records['date'], records['time'], night_session=night_session)
     hq_min_df.pop('date')
     hq_min_df.pop('time')
     return hq_min_df
 
 
+def _slice_hq(hq_df, start=None, end=None):
+    """
+    二分查找只能精确到日期，再按时间过滤，夜盘数据的时间不是递增的，不能用 loc 切片
+    """
+    if start:
+        hq_df = hq_df[hq_df.index >= start]
+    if end:
+        hq_df = hq_df[hq_df.index <= end]
+    return hq_df
+
+
 def get_future_day_hq(market, code, start=None, end=None):
     """
     :param market: 交易市场
@@ -60,47 +204,24 @@ def get_future_day_hq(market, code, start=None, end=None):
     if not os.path.exists(hq_path):
         return None
 
-    f = open(hq_path, "rb")
+    start_key = start.year * 10000 + start.month * 100 + start.day if start else None
+    end_key = end.year * 10000 + end.month * 100 + end.day if end else None
 
-    f.seek(0, 0)
-    start_dt = np.fromfile(f, dtype=np.int32, count=1)
-    start_dt = dt.datetime.strptime(start_dt.astype(str)[0], '%Y%m%d')
-
-    f.seek(-32, 2)
-    end_dt = np.fromfile(f, dtype=np.int32, count=1)
-    end_dt = dt.datetime.strptime(end_dt.astype(str)[0], '%Y%m%d')
-
-    if not start:
-        start = dt.datetime(1970, 1, 1)
-
-    if start < start_dt:
-        f.seek(0, 0)
-        return _get_future_day_hq(f)
-    elif start > end_dt:
+    records = _read_records(hq_path, DAY_DTYPE, 'datetime', start_key, end_key)
+    if records is None:
         return None
-    # TODO 根据交易日历计算实际的交易天数
-    delta = (end_dt - start) + dt.timedelta(1)
-    factor = delta.days
-    try:
-        f.seek(-32 * factor, 2)
-    except OSError:
-        f.seek(0, 0)
-        log.info('%s trade recodes are few and factor = %d is too big.', code, factor)
-    hq_day_df = _get_future_day_hq(f)
 
-    if end:
-        return hq_day_df.loc[start: end]
-    else:
-        return hq_day_df.loc[start:]
+    return _slice_hq(_get_future_day_hq(records), start, end)
 
 
-def get_future_min_hq(market, code, start=None, end=None, freq='5m'):
+def get_future_min_hq(market, code, start=None, end=None, freq='5m', night_session=False):
     """
     :param market: 交易市场
     :param code: IL8 主力合约 IL9 期货指数 I1801
     :param start: 开始时间
     :param end:   结束时间
     :param freq: 周期'1m'，'5m'
+    :param night_session: True 夜盘数据使用实际的自然时间，False 夜盘数据算作下一个交易日
     :return: 返回
     """
     tdx_hq_dir = os.path.join(tdx_dir, 'vipdoc', MARKET_DIR[market], PERIOD_DIR[freq])
@@ -110,55 +231,41 @@ def get_future_min_hq(market, code, start=None, end=None, freq='5m'):
     if not os.path.exists(hq_path):
         return None
 
-    f = open(hq_path, "rb")
+    # 文件中的日期为交易日，夜盘数据算作下一个交易日
+    start_key = date2int(start) if start and start.year >= 2004 else None
+    end_key = date2int(end) if end else None
 
-    f.seek(0, 0)
-    start_dt = np.fromfile(f, dtype=np.int16, count=1)
-    start_dt = int2date(start_dt)
+    records = _read_records(hq_path, MIN_DTYPE, 'date', start_key, end_key, next_day=night_session)
+    if records is None:
+        return None
 
-    f.seek(-32, 2)
-    end_dt = np.fromfile(f, dtype=np.int16, count=1)
-    end_dt = int2date(end_dt)
+    return _slice_hq(_get_future_min_hq(records, night_session=night_session), start, end)
 
-    if not start:
-        start = dt.datetime(1970, 1, 1)
 
-    if start < start_dt:
-        f.seek(0, 0)
-        return _get_future_min_hq(f)
-    elif start > end_dt:
-        return None
+if __name__ == '__main__':
+    import time
 
-    k_num = 400  # 每天大多数期货交易的时间   9:00-10:15 10:30-11:30 13:30-15:00 21:00-23:30
-    if freq == '5m':
-        k_num = int(k_num / 5)
+    # 解析一百万条分钟线时间的耗时
+    trade_days = pd.bdate_range('2010-01-04', periods=4000)
+    minutes = np.arange(9 * 60 + 1, 9 * 60 + 251)
+    bars = 1000000
+    bench_date = np.repeat((trade_days.year - 2004) * 2048 + trade_days.month * 100 + trade_days.day,
+                           len(minutes))[:bars].astype(np.uint16)
+    bench_time = np.tile(minutes, len(trade_days))[:bars].astype(np.uint16)
+    bench_df = pd.DataFrame({'date': bench_date, 'time': bench_time})
 
-    # TODO 计算两个日期之间的工作日，需要自己添加交易日历
-    # https://www.cnblogs.com/fangbei/p/9075153.html
-    # https: // pypi.org / project / business_calendar /
-    delta = (end_dt - start)
-    factor = delta.days * k_num
+    begin = time.perf_counter()
+    bench_df.date.transform(int2date) + pd.to_timedelta(bench_df.time, unit='m')
+    print('int2date: {:.3f}s per million bars'.format(time.perf_counter() - begin))
 
-    while start < end_dt:
-        try:
-            f.seek(-32 * factor, 2)
-            end_dt = np.fromfile(f, dtype=np.int16, count=1)
-            f.seek(-32 * factor, 2)  # 数据读取后移位，文件指针要回到原来位置
-            end_dt = int2date(end_dt)
-            factor = factor * 2
-        except OSError:
-            f.seek(0, 0)
-            log.warning('%s trade recodes are few and factor = %d is too big.', code, factor)
-            break
-
-    hq_min_df = _get_future_min_hq(f)
-    if end:
-        return hq_min_df.loc[start: end]
-    else:
-        return hq_min_df.loc[start:]
+    begin = time.perf_counter()
+    decode_min_datetime(bench_date, bench_time)
+    print('decode_min_datetime: {:.3f}s per million bars'.format(time.perf_counter() - begin))
 
+    begin = time.perf_counter()
+    decode_min_datetime(bench_date, bench_time, night_session=True)
+    print('decode_min_datetime night_session: {:.3f}s per million bars'.format(time.perf_counter() - begin))
 
-if __name__ == '__main__':
     start = dt.datetime(2019, 2, 20)
     code = 'srl8'
     df = get_future_min_hq(market='czce', start=start, code=code, freq='5m')
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pandas as pd
+
+from log import LogHandler
+
+from src.data.tdx.setting import SESSIONS, SYMBOL_SESSIONS, RESAMPLE_FREQ, RESAMPLE_CACHE_DIR
+from src.data.tdx.hq import get_future_day_hq, get_future_min_hq, to_calendar_datetime, NIGHT_START
+
+log = LogHandler(os.path.basename('tdx.resample.log'))
+
+CONVERSION = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last',
+              'openInt': 'last', 'volume': 'sum', 'comment': 'last'}
+
+TRADE_DAY_BEGIN = 18 * 60  # 交易日从前一天18点开始计算，夜盘和日盘的时间在交易日内递增
+
+
+def get_sessions(market, code):
+    """
+    :param market: 交易市场
+    :param code: IL8 主力合约 IL9 期货指数 I1801
+    :return: tuple of (开始分钟, 结束分钟)
+    """
+    symbol = code[:2].upper() if len(code) == 4 else code[0].upper()
+    return SYMBOL_SESSIONS.get(symbol, SESSIONS[market])
+
+
+def get_session_minutes(minutes, sessions):
+    """
+    把k线的结束时间转换为夜盘或者日盘开始后的累计交易分钟数，交易时段之外的k线计入相邻的交易时段
+    夜盘和日盘分别计算，各品种夜盘收盘时间不同不影响日盘的分段
+    :param minutes: np.ndarray 从 0 点开始的分钟数
+    :param sessions: tuple of (开始分钟, 结束分钟)
+    :return: (np.ndarray bool 是否为夜盘, np.ndarray int 累计交易分钟数，第一根1分钟k线为1)
+    """
+    begins = (np.array([begin for begin, _ in sessions]) - TRADE_DAY_BEGIN) % 1440
+    ends = (np.array([end for _, end in sessions]) - TRADE_DAY_BEGIN) % 1440
+    night = np.array([begin >= NIGHT_START for begin, _ in sessions])
+    durations = ends - begins
+
+    offsets = np.zeros(len(sessions), dtype=np.int64)
+    for i in range(1, len(sessions)):
+        if night[i] == night[i - 1]:
+            offsets[i] = offsets[i - 1] + durations[i - 1]
+
+    clock = (np.asarray(minutes, dtype=np.int64) - TRADE_DAY_BEGIN) % 1440
+    pos = np.minimum(np.searchsorted(ends, clock, side='left'), len(ends) - 1)
+    return night[pos], offsets[pos] + np.clip(clock - begins[pos], 1, durations[pos])
+
+
+def resample_min_hq(hq_df, freq, sessions):
+    """
+    分钟线转换为 '30m' 'h'，按交易日、夜盘日盘和交易时段分组，一次 groupby 完成聚合
+    :param hq_df: pd.DataFrame get_future_min_hq(night_session=False) 的结果，夜盘算作下一个交易日
+    :param freq: '30m', 'h'
+    :param sessions: tuple of (开始分钟, 结束分钟)
+    :return: pd.DataFrame index 为每个周期最后一根k线的时间，增加 trade_date 列
+    """
+    index = hq_df.index
+    trade_date = index.normalize()
+    minutes = (index - trade_date) // pd.Timedelta(minutes=1)
+    night, elapsed = get_session_minutes(minutes, sessions)
+    bucket = (elapsed - 1) // RESAMPLE_FREQ[freq]
+
+    return _aggregate(hq_df, trade_date, [trade_date.values, ~night, bucket])
+
+
+def resample_day_hq(hq_df, freq='w'):
+    """
+    日线转换为周线，日期为交易日，夜盘已经计入下一个交易日
+    :param hq_df: pd.DataFrame get_future_day_hq 的结果
+    :param freq: 'w'
+    :return: pd.DataFrame index 为每周最后一个交易日，增加 trade_date 列为每周的周一
+    """
+    index = hq_df.index
+    week = index.normalize() - pd.to_timedelta(index.weekday, unit='D')
+    return _aggregate(hq_df, week, [week.values])
+
+
+def _aggregate(hq_df, trade_date, keys):
+    df = hq_df.copy()
+    df['datetime'] = df.index
+    df['trade_date'] = trade_date
+
+    conversion = {column: how for column, how in CONVERSION.items() if column in df.columns}
+    conversion.update({'datetime': 'last', 'trade_date': 'last'})
+
+    resampled = df.groupby(keys, sort=True).agg(conversion)
+    return resampled.set_index('datetime')
+
+
+def _read_cache(path):
+    if not path.exists():
+        return None
+    try:
+        return pd.read_parquet(path)
+    except Exception as e:
+        log.warning('{} cache read error: {!r}'.format(path, e))
+        return None
+
+
+def get_resampled_hq(market, code, freq, start=None, end=None, night_session=False, refresh=False):
+    """
+    读取转换后的周期数据，结果缓存到磁盘，之后只重新计算缓存中最后一个交易日(周)以后的数据
+    :param market: 交易市场
+    :param code: IL8 主力合约 IL9 期货指数 I1801
+    :param freq: '30m', 'h', 'w'
+    :param start: 开始时间
+    :param end:   结束时间
+    :param night_session: 日内周期的夜盘数据是否使用实际的自然时间
+    :param refresh: True 忽略缓存重新计算
+    :return: pd.DataFrame
+    """
+    path = RESAMPLE_CACHE_DIR / market / '{}_{}.parquet'.format(code.upper(), freq)
+
+    cache_df = None if refresh else _read_cache(path)
+    if cache_df is not None and len(cache_df):
+        # 最后一个交易日(周)的数据可能不完整，重新计算
+        last_date = cache_df['trade_date'].iloc[-1]
+        cache_df = cache_df[cache_df['trade_date'] < last_date]
+        base_start = last_date.to_pydatetime()
+    else:
+        cache_df = None
+        base_start = None
+
+    if freq == 'w':
+        base_df = get_future_day_hq(market, code, start=base_start)
+        new_df = None if base_df is None or base_df.empty else resample_day_hq(base_df, freq)
+    else:
+        base_df = get_future_min_hq(market, code, start=base_start, freq='5m')
+        if base_df is None:
+            base_df = get_future_min_hq(market, code, start=base_start, freq='1m')
+        new_df = None if base_df is None or base_df.empty else \
+            resample_min_hq(base_df, freq, get_sessions(market, code))
+
+    frames = [df for df in (cache_df, new_df) if df is not None]
+    if not frames:
+        return None
+    hq_df = pd.concat(frames) if len(frames) > 1 else frames[0]
+
+    if new_df is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        hq_df.to_parquet(path)
+
+    hq_df = hq_df.drop(columns='trade_date')
+    if night_session and freq != 'w':
+        hq_df.index = to_calendar_datetime(hq_df.index)
+
+    if start:
+        hq_df = hq_df[hq_df.index >= start]
+    if end:
+        hq_df = hq_df[hq_df.index <= end]
+    return hq_df
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+from pathlib import Path
+
 tdx_dir = "E:\\TDX\\"
 
 MARKETS = ('cffex',  # 中金所
@@ -32,3 +34,26 @@ PERIOD_EXT = {'d': '.day',  # 日线
               '5m': '.lc5',  # 5分钟
               '1m': '.lc1'
               }
+
+# 各交易所的交易时段 (开始分钟, 结束分钟)，按交易日内的先后排列，夜盘算作下一个交易日
+# 夜盘按最晚的收盘时间设置，品种的实际收盘时间较早时最后一个周期不完整
+SESSIONS = {'shfe': ((21 * 60, 2 * 60 + 30), (9 * 60, 10 * 60 + 15), (10 * 60 + 30, 11 * 60 + 30),
+                     (13 * 60 + 30, 15 * 60)),
+            'dce': ((21 * 60, 23 * 60 + 30), (9 * 60, 10 * 60 + 15), (10 * 60 + 30, 11 * 60 + 30),
+                    (13 * 60 + 30, 15 * 60)),
+            'czce': ((21 * 60, 23 * 60 + 30), (9 * 60, 10 * 60 + 15), (10 * 60 + 30, 11 * 60 + 30),
+                     (13 * 60 + 30, 15 * 60)),
+            'cffex': ((9 * 60 + 15, 11 * 60 + 30), (13 * 60, 15 * 60 + 15)),  # 国债期货
+            }
+
+# 交易时段与所在交易所不同的品种
+SYMBOL_SESSIONS = {'IF': ((9 * 60 + 30, 11 * 60 + 30), (13 * 60, 15 * 60)),  # 股指期货
+                   'IH': ((9 * 60 + 30, 11 * 60 + 30), (13 * 60, 15 * 60)),
+                   'IC': ((9 * 60 + 30, 11 * 60 + 30), (13 * 60, 15 * 60)),
+                   }
+
+# 由分钟线或者日线转换得到的周期，以及每个周期包含的分钟数
+RESAMPLE_FREQ = {'30m': 30, 'h': 60, 'w': None}
+
+# 转换后周期数据的缓存目录
+RESAMPLE_CACHE_DIR = Path(__file__).parents[3] / 'data/interim/tdx'
@@ -5,34 +5,156 @@ block
 This module contains the identification of peaks, segments and blocks.
 """
 from bson.objectid import ObjectId
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateMany
 
 from log import LogHandler
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import scipy.signal as signal
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    from numba import njit
+except ImportError:  # numba 是可选依赖，没有安装时使用纯 python 的状态机
+    njit = None
 
 # TODO 改用动态接口
 # get_history_hq_api(code, start=None, end=None, freq='d')
 from src.features import conn
 from src.data.tdx import get_future_hq
-from src.util import connect_mongo
+from src.util import connect_mongo, read_cursor
 from src.api.cons import FREQ
+from src.api import get_symbols
+from src.setting import DATA_ANALYST, ANALYST_PWD, BUILD_WORKERS, BLOCK_CACHE_DIR
 
 get_history_hq_api = get_future_hq
 
 log = LogHandler('features.log')
 
 
+# TsBlock 磁盘缓存的格式版本，peaks、segments、blocks 的计算方法改变时加 1，旧版本的缓存不再使用
+CACHE_VERSION = 1
+_CACHE_META_KEY = b'block_cache'
+
+
+def _cache_path(code, freq, kind):
+    return BLOCK_CACHE_DIR / code.upper() / '{}_{}.parquet'.format(kind, freq)
+
+
+def _read_block_cache(code, freq, kind):
+    """
+    读取缓存，版本号和计算时行情的最后时间保存在 parquet 文件的元数据中
+    :return: (pd.DataFrame, datetime) 没有可用的缓存时返回 (None, None)
+    """
+    path = _cache_path(code, freq, kind)
+    if not path.exists():
+        return None, None
+
+    try:
+        table = pq.read_table(path)
+        meta = json.loads(table.schema.metadata[_CACHE_META_KEY])
+    except Exception as e:
+        log.warning('{} cache read error: {!r}'.format(path, e))
+        return None, None
+
+    if meta.get('version') != CACHE_VERSION:
+        return None, None
+    return table.to_pandas(), datetime.fromisoformat(meta['last_bar'])
+
+
+def _write_block_cache(code, freq, kind, df, last_bar):
+    path = _cache_path(code, freq, kind)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    table = pa.Table.from_pandas(df)
+    meta = dict(table.schema.metadata or {})
+    meta[_CACHE_META_KEY] = json.dumps({'version': CACHE_VERSION, 'last_bar': last_bar.isoformat()})
+
+    tmp_path = path.with_suffix('.tmp')
+    pq.write_table(table.replace_schema_metadata(meta), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _slice_by_date(df, start=None, end=None, column='datetime'):
+    if df.empty:
+        return df
+    if start:
+        df = df[df[column] >= start]
+    if end:
+        df = df[df[column] <= end]
+    return df
+
+
 class TsBlock:
 
-    def __init__(self, code):
+    def __init__(self, code, cache=True):
+        """
+        :param code: 交易代码
+        :param cache: 是否使用磁盘缓存，缓存的行情最后时间与当前一致时直接读取，否则重新计算后写入
+        """
         self.code = code
+        self.cache = cache
         self.__peaks = dict.fromkeys(FREQ, pd.DataFrame())
         self.__segments = dict.fromkeys(FREQ, pd.DataFrame())
         self.__blocks = dict.fromkeys(FREQ, pd.DataFrame())
-        # 从数据库读取数据
+        # 各周期计算时使用的行情最后时间
+        self.__last_bar = dict.fromkeys(FREQ)
+
+    def _cached(self, kind, freq, build):
+        """
+        缓存的行情最后时间与当前一致时直接读取缓存，否则调用 build 重新计算并写入缓存
+        """
+        last_bar = self.__last_bar[freq]
+        if not self.cache or last_bar is None:
+            return build()
+
+        cache_df, cache_bar = _read_block_cache(self.code, freq, kind)
+        if cache_df is not None and cache_bar == last_bar:
+            return cache_df
+
+        df = build()
+        _write_block_cache(self.code, freq, kind, df, last_bar)
+        return df
+
+    def _get_hq_peaks(self, freq):
+        """
+        行情的极值点只与相邻的k线有关，只读取缓存中行情最后时间之前的一个极值点以后的行情，
+        重新计算之后的极值点追加到缓存
+        :return: pd.DataFrame, columns=['datetime', 'peak', 'type']
+        """
+        cache_df, last_bar = _read_block_cache(self.code, freq, 'peaks') if self.cache else (None, None)
+
+        start = None
+        if cache_df is not None:
+            dates = cache_df.loc[cache_df['datetime'] < last_bar, 'datetime']
+            start = dates.iloc[-1].to_pydatetime() if len(dates) else None
+
+        hq_df = get_history_hq(self.code, start_date=start, freq=freq)
+        if hq_df is None or hq_df.empty:
+            self.__last_bar[freq] = last_bar
+            return pd.DataFrame() if cache_df is None else cache_df
+
+        new_bar = hq_df['datetime'].iloc[-1].to_pydatetime()
+        self.__last_bar[freq] = new_bar
+        if cache_df is not None and new_bar == last_bar:
+            return cache_df
+
+        peak_df = get_peaks_from_hq(hq_df)
+        if start is not None:
+            # start 是窗口的第一根k线，没有左侧k线，其极值点使用缓存中的结果
+            peak_df = pd.concat([cache_df[cache_df['datetime'] <= start],
+                                 peak_df[peak_df['datetime'] > start]], ignore_index=True)
+
+        if self.cache:
+            _write_block_cache(self.code, freq, 'peaks', peak_df, new_bar)
+        return peak_df
 
     def get_peaks(self, start=None, end=None, freq='d'):
         """
@@ -40,30 +162,22 @@ class TsBlock:
         :param start: datetime
         :param end: datetime
         :param freq: ('5m', '30m', 'd', 'w')
-        :return: [pd.DataFrame/Series, pd.DataFrame/Series]
+        :return: pd.DataFrame, columns=['datetime', 'peak', 'type']
         """
 
         temp_peak = self.__peaks[freq]
 
         if temp_peak.empty:
             if freq in ('5m', 'd'):
-                temp_df = get_history_hq(self.code, start_date=start, end_date=end, freq=freq)
-                hq_df = temp_df[['high', 'low']]
-                temp_peak = get_peaks_from_hq(hq_df)
+                temp_peak = self._get_hq_peaks(freq)
             else:
-                index = FREQ.index(freq) - 1
-                peak_df = self.get_segments(start=start, end=end, freq=FREQ[index])
-                temp_peak = get_peaks_from_segments(peak_df)
+                low_freq = FREQ[FREQ.index(freq) - 1]
+                segment_df = self.get_segments(freq=low_freq)
+                self.__last_bar[freq] = self.__last_bar[low_freq]
+                temp_peak = self._cached('peaks', freq, lambda: get_peaks_from_segments(segment_df))
             self.__peaks[freq] = temp_peak
-            return temp_peak
-        elif start and end:
-            return temp_peak[start:end]
-        elif start:
-            return temp_peak[start:]
-        elif end:
-            return temp_peak[:end]
-        else:
-            return temp_peak
+
+        return _slice_by_date(temp_peak, start, end)
 
     def get_segments(self, start=None, end=None, freq='d'):
         """
@@ -71,25 +185,16 @@ class TsBlock:
         :param start: datetime
         :param end: datetime
         :param freq: ('5m', '30m', 'd', 'w')
-        :return: [pd.Series, pd.Series]
+        :return: pd.DataFrame, columns=['datetime', 'peak', 'type']
         """
         segment_df = self.__segments[freq]
 
         if segment_df.empty:
-            peak_df = self.get_peaks(start=start, end=end, freq=freq)
-            segment_df = get_segments_from_peaks(peak_df)
+            peak_df = self.get_peaks(freq=freq)
+            segment_df = self._cached('segments', freq, lambda: get_segments_from_peaks(peak_df))
             self.__segments[freq] = segment_df
-            segment_df.to_excel("segment_" + freq + ".xlsx")
-            return segment_df
-        else:
-            if start and end:
-                return segment_df[start:end]
-            elif start:
-                return segment_df[start:]
-            elif end:
-                return segment_df[:end]
-            else:
-                return segment_df
+
+        return _slice_by_date(segment_df, start, end)
 
     def get_blocks(self, start=None, end=None, freq='d'):
         """
@@ -97,31 +202,22 @@ class TsBlock:
         :param start: datetime
         :param end: datetime
         :param freq: ('5m', '30m', 'd', 'w')
-        :return: pd.Dataframe   columns=['end_date', 'block_high', 'block_low', 'block_highest', 'block_lowest',
-                                         'segment_num', 'block_flag', 'block_type', 'top_bottom_flag']
+        :return: pd.Dataframe   columns=['enter_date', 'start_date', 'block_high', 'block_low', 'block_highest',
+                                         'block_lowest', 'segment_num', 'type', 'relation', 'sn']
         """
 
         temp_block = self.__blocks[freq]
 
         if temp_block.empty:
-            segment_df = self.get_segments(start=start, end=end, freq=freq)
-            temp_block = identify_blocks(segment_df)
-            temp_block = identify_blocks_relation(temp_block)
+            segment_df = self.get_segments(freq=freq)
+            temp_block = self._cached('blocks', freq,
+                                      lambda: identify_blocks_relation(identify_blocks(segment_df)))
             self.__blocks[freq] = temp_block
-            return temp_block
-        # TODO 增加读取和写入存盘文件操作
-        else:
-            if start and end:
-                return temp_block[start:end]
-            elif start:
-                return temp_block[start:]
-            elif end:
-                return temp_block[0]
-            else:
-                return temp_block
+
+        return _slice_by_date(temp_block, start, end, column='enter_date')
 
     def get_current_status(self, start=None, end=None, freq='d'):
-        temp_block_df = self.get_blocks(start=start, end=start, freq=freq)
+        temp_block_df = self.get_blocks(start=start, end=end, freq=freq)
         try:
             dt = temp_block_df.loc[temp_block_df['sn'] == 0].tail(2).index[0]
             return temp_block_df.loc[dt:]
@@ -149,71 +245,138 @@ def identify_blocks_relation(block_df: pd.DataFrame):
         temp_df['relation'] = np.nan
         temp_df['sn'] = 0
 
-    type_index = temp_df.columns.get_loc('type')
-    relation_index = temp_df.columns.get_loc('relation')
-    sn_index = temp_df.columns.get_loc('sn')
-
-    prev_high = temp_df.block_high[0]
-    prev_highest = temp_df.block_highest[0]
-    prev_low = temp_df.block_low[0]
-    prev_lowest = temp_df.block_lowest[0]
-    prev_segment_num = temp_df.segment_num[0]
-
-    block_index = temp_df.iloc[0, sn_index]
-    block_type = block_relation = np.nan
-
-    last_index = len(temp_df) - 1
-
-    for row in temp_df[1:].itertuples():
-        index = row.Index
-        segment_num = row.segment_num
-        current_high = row.block_high
-        current_highest = row.block_highest
-        current_low = row.block_low
-        current_lowest = row.block_lowest
-
-        if current_low > prev_high:
-            block_type = 'up'
-        elif current_high < prev_low:
-            block_type = 'down'
-        else:
-            log.info('Wrong identification of block!')
+    if len(temp_df) < 2:
+        return temp_df
+
+    high = temp_df['block_high'].to_numpy()
+    highest = temp_df['block_highest'].to_numpy()
+    low = temp_df['block_low'].to_numpy()
+    lowest = temp_df['block_lowest'].to_numpy()
+    segment_num = temp_df['segment_num'].to_numpy()
+
+    # 当前 block 与前一个 block 比较，第一个 block 保持原值
+    current_high, prev_high = high[1:], high[:-1]
+    current_highest, prev_highest = highest[1:], highest[:-1]
+    current_low, prev_low = low[1:], low[:-1]
+    current_lowest, prev_lowest = lowest[1:], lowest[:-1]
+
+    block_type = np.select([current_low > prev_high, current_high < prev_low],
+                           ['up', 'down'], default='')
+
+    higher = (current_highest >= prev_highest) & (current_lowest >= prev_lowest)
+    lower = (current_highest <= prev_highest) & (current_lowest <= prev_lowest)
+    block_relation = np.select([higher & (prev_highest > current_lowest),
+                                higher,
+                                lower & (current_highest > prev_lowest),
+                                lower,
+                                (current_highest >= prev_highest) & (current_lowest <= prev_lowest),
+                                (current_highest <= prev_highest) & (current_lowest >= prev_lowest)],
+                               ['overlap', 'up', 'overlap', 'down', 'include', 'included'], default='')
+
+    wrong_num = np.count_nonzero(block_type == '') + np.count_nonzero(block_relation == '')
+    if wrong_num:
+        log.info('Wrong identification of block! {} times'.format(wrong_num))
+
+    # 无法识别时沿用上一个 block 的结果
+    type_values = temp_df['type'].to_numpy(dtype=object).copy()
+    relation_values = temp_df['relation'].to_numpy(dtype=object).copy()
+    type_values[1:] = pd.Series(block_type).replace('', np.nan).ffill().to_numpy(dtype=object)
+    relation_values[1:] = pd.Series(block_relation).replace('', np.nan).ffill().to_numpy(dtype=object)
+    temp_df['type'] = type_values
+    temp_df['relation'] = relation_values
+
+    # segment_num = 3 的不认为是一个震荡区间，前一个 block 超过3段时计数加1
+    length = len(temp_df)
+    positions = np.arange(length)
+    increments = np.zeros(length, dtype=np.int64)
+    increments[1:] = segment_num[:-1] > 3
+    counts = np.cumsum(increments)
+
+    # 最后一个block不能确认是top或者bottom,segment_num < 4的情况要计算在内
+    resets = (segment_num % 2 == 0) & (positions != length - 1)
+    resets[0] = False
+    last_reset = np.maximum.accumulate(np.where(resets, positions, -1))
+
+    sn = temp_df['sn'].iloc[0] + counts
+    reset_counts = counts[np.maximum(last_reset, 0)]
+    sn = np.where(last_reset >= 0, counts - reset_counts, sn)
+    temp_df['sn'] = sn
 
-        if current_highest >= prev_highest and current_lowest >= prev_lowest:
-            if prev_highest > current_lowest:
-                block_relation = 'overlap'
-            else:
-                block_relation = 'up'
-        elif current_highest <= prev_highest and current_lowest <= prev_lowest:
-            if current_highest > prev_lowest:
-                block_relation = 'overlap'
+    return temp_df
+
+
+def _identify_blocks_kernel(peaks, is_high):
+    """
+    block 识别的状态机，只对数组进行操作，结果写入预先分配的数组
+    :param peaks: np.ndarray float64 极值点的值
+    :param is_high: np.ndarray bool 极值点是否为高点
+    :return: (np.ndarray int64 shape=(n, 3), np.ndarray float64 shape=(n, 4))
+            [enter_pos, start_pos, segment_num], [block_high, block_low, block_highest, block_lowest]
+    """
+    length = len(peaks)
+    positions = np.empty((length, 3), dtype=np.int64)
+    values = np.empty((length, 4), dtype=np.float64)
+
+    # init current block 第一个segment假设为enter segment
+    block_high = block_highest = current_high = current_highest = max(peaks[1], peaks[2])
+    block_low = block_lowest = current_low = current_lowest = min(peaks[1], peaks[2])
+
+    enter_pos = 0
+    start_pos = 1
+    segment_num = 2
+    n = 0
+
+    for i in range(3, length):
+        peak = peaks[i]
+        if is_high[i]:  # 顶
+            if peak < block_low:  # 第三类卖点，新的中枢开始
+                positions[n, 0], positions[n, 1], positions[n, 2] = enter_pos, start_pos, segment_num
+                values[n, 0], values[n, 1], values[n, 2], values[n, 3] = \
+                    block_high, block_low, block_highest, block_lowest
+                n += 1
+
+                enter_pos = i - 2
+                start_pos = i - 1
+                segment_num = 1
+                assert not is_high[i - 1]
+                block_high = block_highest = current_high = current_highest = peak
+                block_low = block_lowest = current_low = current_lowest = peaks[i - 1]
             else:
-                block_relation = 'down'
-        elif current_highest >= prev_highest and current_lowest <= prev_lowest:
-            block_relation = 'include'
-        elif current_highest <= prev_highest and current_lowest >= prev_lowest:
-            block_relation = 'included'
+                block_low = current_low
+                current_high = min(block_high, peak)
+                block_lowest = current_lowest
+                current_highest = max(block_highest, peak)
         else:
-            log.info('Wrong identification of block!')
+            if peak > block_high:  # 第三类买点，新的中枢开始
+                positions[n, 0], positions[n, 1], positions[n, 2] = enter_pos, start_pos, segment_num
+                values[n, 0], values[n, 1], values[n, 2], values[n, 3] = \
+                    block_high, block_low, block_highest, block_lowest
+                n += 1
+
+                enter_pos = i - 2
+                start_pos = i - 1
+                segment_num = 1
+                assert is_high[i - 1]
+                block_high = block_highest = current_high = current_highest = peaks[i - 1]
+                block_low = block_lowest = current_low = current_lowest = peak
+            else:
+                block_high = current_high
+                current_low = max(block_low, peak)
+                block_highest = current_highest
+                current_lowest = min(block_lowest, peak)
 
-        temp_df.iloc[index, type_index] = block_type
-        temp_df.iloc[index, relation_index] = block_relation
+        segment_num = segment_num + 1
 
-        if prev_segment_num > 3:  # segment_num = 3 的不认为是一个震荡区间
-            block_index = block_index + 1
+    # record last block
+    positions[n, 0], positions[n, 1], positions[n, 2] = enter_pos, start_pos, segment_num
+    values[n, 0], values[n, 1], values[n, 2], values[n, 3] = block_high, block_low, block_highest, block_lowest
+    n += 1
 
-        # 最后一个block不能确认是top或者bottom,segment_num < 4的情况要计算在内
-        if segment_num % 2 == 0 and index != last_index:
-            block_index = 0
+    return positions[:n], values[:n]
 
-        temp_df.iloc[index, sn_index] = block_index
-        prev_segment_num = segment_num
-        prev_high = current_high
-        prev_highest = current_highest
-        prev_low = current_low
-        prev_lowest = current_lowest
 
-    return temp_df
+if njit is not None:
+    _identify_blocks_kernel = njit(cache=True)(_identify_blocks_kernel)
 
 
 def identify_blocks(segment_df: pd.DataFrame):
@@ -236,67 +399,27 @@ def identify_blocks(segment_df: pd.DataFrame):
     assert len(segment_df) > 2
     segment_df = sort_one_candle_peaks(segment_df, invert=False)
 
-    # init current block 第一个segment假设为enter segment
-    block_high = block_highest = current_high = current_highest = segment_df.peak.iloc[1:3].max()
-    block_low = block_lowest = current_low = current_lowest = segment_df.peak.iloc[1:3].min()
+    peaks = segment_df['peak'].to_numpy(dtype=np.float64)
+    is_high = (segment_df['type'] == 'high').to_numpy()
+    if njit is None:  # 纯 python 循环访问 list 比逐个访问 ndarray 元素快
+        peaks, is_high = peaks.tolist(), is_high.tolist()
 
-    enter_date = segment_df.datetime.iloc[0]
-    start_date = segment_df.datetime.iloc[1]
-    segment_num = 2
+    try:
+        positions, values = _identify_blocks_kernel(peaks, is_high)
+    except AssertionError:
+        log.error('Segments of {} are not alternate high and low!'.format(segment_df['datetime'].iloc[0]))
+        raise
 
-    # 初始化block表
+    dates = segment_df['datetime'].to_numpy()
     columns = ['enter_date', 'start_date', 'block_high', 'block_low',
                'block_highest', 'block_lowest', 'segment_num']
-    df = pd.DataFrame(columns=columns)
-
-    for row in segment_df[3:].itertuples():
-        index = row.Index
-        if row.type == 'high':  # 顶
-            if row.peak < block_low:  # 第三类卖点，新的中枢开始
-                # 代码有5行冗余
-                insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low,
-                                            block_highest, block_lowest, segment_num]], columns=columns)
-                df = df.append(insert_row, ignore_index=True)
-
-                enter_date = segment_df.datetime.iloc[index - 2]
-                start_date = segment_df.datetime.iloc[index - 1]
-                segment_num = 1
-                block_high = block_highest = current_high = current_highest = row.peak
-                if segment_df.type.iloc[index - 1] != 'low':
-                    print('stop at {}, type is {}, prior type is '.format(row.datetime,
-                                                                          row.type, segment_df.type.iloc[index - 1]))
-                    # TODO 测试代码
-                assert segment_df.type.iloc[index - 1] == 'low'
-                block_low = block_lowest = current_low = current_lowest = segment_df.peak.iloc[index - 1]
-            else:
-                block_low = current_low
-                current_high = min(block_high, row.peak)
-                block_lowest = current_lowest
-                current_highest = max(block_highest, row.peak)
-        else:
-            if row.peak > block_high:  # 第三类买点，新的中枢开始
-                insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low,
-                                            block_highest, block_lowest, segment_num]], columns=columns)
-                df = df.append(insert_row, ignore_index=True)
-
-                enter_date = segment_df.datetime.iloc[index - 2]
-                start_date = segment_df.datetime.iloc[index - 1]
-                segment_num = 1
-                assert segment_df.type.iloc[index - 1] == 'high'
-                block_high = block_highest = current_high = current_highest = segment_df.peak.iloc[index - 1]
-                block_low = block_lowest = current_low = current_lowest = row.peak
-            else:
-                block_high = current_high
-                current_low = max(block_low, row.peak)
-                block_highest = current_highest
-                current_lowest = min(block_lowest, row.peak)
-
-        segment_num = segment_num + 1
-
-    # record last block
-    insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low, block_highest,
-                                block_lowest, segment_num]], columns=columns)
-    df = df.append(insert_row, ignore_index=True)
+    df = pd.DataFrame({'enter_date': dates[positions[:, 0]],
+                       'start_date': dates[positions[:, 1]],
+                       'block_high': values[:, 0],
+                       'block_low': values[:, 1],
+                       'block_highest': values[:, 2],
+                       'block_lowest': values[:, 3],
+                       'segment_num': positions[:, 2]}, columns=columns)
     return df
 
 
@@ -336,6 +459,27 @@ def sort_one_candle_peaks(peak_df, invert=True):
     return df
 
 
+def _valid_peaks(peaks, is_high, is_low):
+    """
+    和前后极值点比较，高点不低于前一个点且高于后一个点，低点不高于前一个点且低于后一个点
+    没有比较的情况假设是合理的极值点，相等的情况保留后一个点
+    :param peaks: np.ndarray float64
+    :param is_high: np.ndarray bool
+    :param is_low: np.ndarray bool
+    :return: np.ndarray bool 合理的极值点
+    """
+    length = len(peaks)
+    left_high = np.ones(length, dtype=bool)
+    right_high = np.ones(length, dtype=bool)
+    left_low = np.ones(length, dtype=bool)
+    right_low = np.ones(length, dtype=bool)
+    left_high[1:] = peaks[1:] >= peaks[:-1]
+    right_high[:-1] = peaks[:-1] > peaks[1:]
+    left_low[1:] = peaks[1:] <= peaks[:-1]
+    right_low[:-1] = peaks[:-1] < peaks[1:]
+    return (is_high & left_high & right_high) | (is_low & left_low & right_low)
+
+
 def remove_fake_peaks(peak_df):
     """
     删除比相邻极点高的低点和比相邻极点低的高点，包括了高点/低点连续出现的情况
@@ -346,32 +490,23 @@ def remove_fake_peaks(peak_df):
     # 检测输入类型
     assert isinstance(peak_df, pd.DataFrame)
 
-    df = peak_df.copy()  # 不对输入数据进行操作，有可能改变原始数据
-    len_before = len(df)
-    len_after = len_before - 1  # 为了循环能执行至少一次
-
-    while len_after < len_before:
-        diff_left = df.peak.diff()
-        diff_right = df.peak.diff(-1)
-
-        # 和前一个极值点点比较，没有比较的情况假设是合理的极值点
-        diff_left.iloc[0] = -1 if df.type.iloc[0] == 'low' else 1
-        diff_right.iloc[-1] = -1 if df.type.iloc[-1] == 'low' else 1
+    # 每一轮对剩下的点整体向量化比较，直到没有点被删除，只压缩数组，不再重建 DataFrame
+    positions = np.arange(len(peak_df))
+    peaks = peak_df['peak'].to_numpy(dtype=np.float64)
+    is_high = (peak_df['type'] == 'high').to_numpy()
+    is_low = (peak_df['type'] == 'low').to_numpy()
 
-        h_flag = np.logical_and(np.logical_and(diff_left >= 0, diff_right > 0),
-                                df.type == 'high')
-        r_flag = np.logical_and(np.logical_and(diff_left <= 0, diff_right < 0),
-                                df.type == 'low')
+    keep = _valid_peaks(peaks, is_high, is_low)
+    while not keep.all():
+        positions = positions[keep]
+        peaks = peaks[keep]
+        is_high = is_high[keep]
+        is_low = is_low[keep]
+        keep = _valid_peaks(peaks, is_high, is_low)
 
-        # # 相等的情况保留后一个点
-        flag = np.logical_or(h_flag, r_flag)
-
-        df = df[flag.values]
-
-        len_before = len_after
-        len_after = len(df)
-
-    return df
+    alive = np.zeros(len(peak_df), dtype=bool)
+    alive[positions] = True
+    return peak_df[alive]
 
 
 def get_segments_from_peaks(peak_df):
@@ -413,7 +548,7 @@ def get_peaks_from_segments(segment_df):
     high_df = high_df.iloc[signal.argrelextrema(high_df.peak.values, np.greater_equal)]
     low_df = low_df.iloc[signal.argrelextrema(-low_df.peak.values, np.greater_equal)]
 
-    peak_df = high_df.append(low_df).sort_index()
+    peak_df = pd.concat([high_df, low_df]).sort_index()
 
     # 添加被错误删除的点，即两个端点之间还有更高的高点和更低的低点
 
@@ -429,7 +564,7 @@ def get_peaks_from_segments(segment_df):
     b4 = np.logical_and(np.logical_and(f_compare < 0, y.type == 'high'), segment_df.type == 'high')
     bflag = np.logical_or(np.logical_or(b1, b2), np.logical_or(b3, b4))
 
-    peak_df = peak_df.append(segment_df[bflag.values]).sort_index()
+    peak_df = pd.concat([peak_df, segment_df[bflag.values]]).sort_index()
     peak_df.reset_index(drop=True, inplace=True)
     return peak_df
 
@@ -459,7 +594,8 @@ def get_peaks_from_hq(hq_df):
     high_df = high_df.iloc[signal.argrelextrema(high_df.peak.values, np.greater_equal)]
     low_df = low_df.iloc[signal.argrelextrema(-low_df.peak.values, np.greater_equal)]
 
-    peak_df = high_df.append(low_df).sort_index()
+    # 同一根k线的高点和低点按 high、low 的顺序排列，追加计算时与全量计算的结果一致
+    peak_df = pd.concat([high_df, low_df]).sort_index(kind='mergesort')
     peak_df.reset_index(drop=True, inplace=True)
     # peak_df.to_excel('peak_ww.xlsx')
 
@@ -473,54 +609,132 @@ def get_history_hq(code, start_date=None, end_date=None, freq='d'):
     :param start_date: datetime
     :param end_date: datetime
     :param freq: '5m', '30m', 'd', 'w'
-    :return: pd.DataFrame columns=['high', 'low', 'serial_number]
+    :return: pd.DataFrame columns=['datetime', 'high', 'low']，索引从0-N
     """
     if get_history_hq_api:
         temp_hq_df = get_history_hq_api(code=code, start=start_date, end=end_date, freq=freq)
-        return temp_hq_df[['high', 'low']]
+        if temp_hq_df is None:
+            return None
+        return temp_hq_df[['high', 'low']].rename_axis('datetime').reset_index()
     else:  # only for test
         return None
 
 
 # --------------------------往数据库插入数据-------------------------------------
-def build_base_segments(symbol, frequency, instrument='index'):
+def _segment_key(segment):
     """
-    对行情数据进行分段处理
-    :param symbol: 交易代码
-    :param frequency: 频率值，从0-9，从tick到year
-    :param instrument: 交易品种类型 future option stock bond convertible index
-    :return: True 还需要后续处理，不需要后续处理
+    段的排序键，同一根k线上的高点和低点按 type 排序，不依赖数据库中相同 datetime 的记录顺序
     """
+    return segment['datetime'], segment['type']
+
 
+def _init_segment_state(symbol, frequency):
+    """
+    没有保存分段状态时从数据库中已有的段生成，起点是按 (datetime, type) 排序的倒数第二个段
+    :return: dict segment_state 的记录，bars 为空，需要从起点读取行情
+    """
     segment_cursor = conn['segment']
-    inst_cursor = conn[instrument]
 
     # 读取高一级别极值点作为处理的起点
     filter_dict = {'symbol': symbol, 'frequency': {'$gte': frequency}}
-    last_doc = segment_cursor.find_one(filter_dict, sort=[('datetime', DESCENDING)], skip=1)
+    last_doc = segment_cursor.find_one(filter_dict, sort=[('datetime', DESCENDING), ('type', DESCENDING)], skip=1)
 
+    state = {'symbol': symbol, 'frequency': frequency, 'anchor': None, 'last_bar': None, 'bars': [], 'segments': []}
     filter_dict = {'symbol': symbol}
     if last_doc is None:
-        # filter_dict['datetime'] = {'$lte': datetime(2005, 10, 7)}
         log.info("Build {} future segment from trade beginning.".format(symbol))
     else:
-        update = last_doc['datetime']
-        # filter_dict['datetime'] = {'$gte': update, '$lte': datetime(2009, 2, 24)}
-        filter_dict['datetime'] = {'$gte': update}
-        log.info("Build {} future segment from {}".format(symbol, update))
+        state['anchor'] = {'datetime': last_doc['datetime'], 'type': last_doc['type']}
+        filter_dict['datetime'] = {'$gte': last_doc['datetime']}
+        log.info("Build {} future segment from {}".format(symbol, last_doc['datetime']))
+
+    projection = {'_id': 1, 'datetime': 1, 'type': 1}
+    origin_segment = segment_cursor.find(filter_dict, projection=projection,
+                                         sort=[('datetime', ASCENDING), ('type', ASCENDING)])
+    state['segments'] = list(origin_segment)
+    return state
+
+
+def _read_new_bars(symbol, instrument, state):
+    """
+    从分段状态中最后一根k线开始读取行情，最后一根k线可能被重新下载或者重新计算指数改写，
+    没有处理过的品种从起点开始读取
+    """
+    filter_dict = {'symbol': symbol}
+    if state['last_bar'] is not None:
+        filter_dict['datetime'] = {'$gte': state['last_bar']}
+    elif state['anchor'] is not None:
+        filter_dict['datetime'] = {'$gte': state['anchor']['datetime']}
 
-    # 从数据库读取所需数据
     projection = {'_id': 0, 'datetime': 1, 'high': 1, 'low': 1}
+    hq = conn[instrument].find(filter_dict, projection=projection).sort([("datetime", ASCENDING)])
+    return read_cursor(hq, projection=projection)
 
-    hq = inst_cursor.find(filter_dict, projection=projection).sort([("datetime", ASCENDING)])
-    hq_df = pd.DataFrame(list(hq))
-    if hq_df.empty:
+
+def _save_segment_state(state, hq_df, segments):
+    """
+    只保留倒数第二个段之后的k线和段，下次更新从这里开始计算，之前的段不会再变化
+    :param hq_df: pd.DataFrame 起点之后的全部k线
+    :param segments: list of dict {'_id', 'datetime', 'type'} 起点之后的全部段，按 (datetime, type) 升序排列
+    """
+    state_cursor = conn['segment_state']
+    key = {'symbol': state['symbol'], 'frequency': state['frequency']}
+    if len(segments) < 2 and state['anchor'] is not None:
+        # 起点之后的段被撤销，新的起点在状态之外，下次从数据库中已有的段重新生成状态
+        state_cursor.delete_one(key)
+        return
+
+    if len(segments) >= 2:
+        anchor = segments[-2]
+        state['anchor'] = {'datetime': anchor['datetime'], 'type': anchor['type']}
+        hq_df = hq_df[hq_df['datetime'] >= anchor['datetime']]
+        segments = [segment for segment in segments if segment['datetime'] >= anchor['datetime']]
+
+    state['bars'] = hq_df.to_dict('records')
+    state['segments'] = segments
+    state_cursor.replace_one(key, state, upsert=True)
+
+
+def build_base_segments(symbol, frequency, instrument='index', refresh=False):
+    """
+    对行情数据进行分段处理，segment_state 保存每个品种的分段状态：倒数第二个段之后的k线和段
+    每次只从数据库读取最后一根k线和新的k线，和状态中的k线一起计算，只删除被撤销的段和插入新确认的段
+    :param symbol: 交易代码
+    :param frequency: 频率值，从0-9，从tick到year
+    :param instrument: 交易品种类型 future option stock bond convertible index
+    :param refresh: True 忽略保存的状态，从数据库中已有的段重新生成
+    :return: True 还需要后续处理，不需要后续处理
+    """
+    segment_cursor = conn['segment']
+
+    state = None if refresh else conn['segment_state'].find_one(
+        {'symbol': symbol, 'frequency': frequency}, projection={'_id': 0})
+    if state is None:
+        state = _init_segment_state(symbol, frequency)
+
+    # 从数据库读取所需数据
+    new_df = _read_new_bars(symbol, instrument, state)
+    if new_df.empty:
         log.debug('{} hq data:{} is empty!'.format(symbol, FREQ[frequency]))
         return False
+    last_bar = new_df['datetime'].iloc[-1]
+
     # 剔除掉成交价格为0的数据
-    hq_df = hq_df[hq_df['low'] > 1e-10]
+    new_df = new_df[new_df['low'] > 1e-10]
+    bars_df = pd.DataFrame(state['bars'], columns=new_df.columns)
+    if state['last_bar'] is not None:
+        # 重新读取的最后一根k线替换状态中的k线，没有新的k线并且最后一根k线没有改写时不需要计算
+        replaced = (bars_df['datetime'] >= state['last_bar']).to_numpy(dtype=bool)
+        if last_bar <= state['last_bar'] and bars_df[replaced].to_dict('records') == new_df.to_dict('records'):
+            log.debug('{} hq data:{} is not updated.'.format(symbol, FREQ[frequency]))
+            return False
+        bars_df = bars_df[~replaced]
+    state['last_bar'] = last_bar
+    hq_df = pd.concat([bars_df, new_df], ignore_index=True)
+    segments = state['segments']
     if hq_df.empty:
         log.debug('{} hq data:{} is empty!'.format(symbol, FREQ[frequency]))
+        _save_segment_state(state, hq_df, segments)
         return False
 
     # hq_df 需要按 datetime 升序排列, 返回的序列索引0-N
@@ -528,14 +742,16 @@ def build_base_segments(symbol, frequency, instrument='index'):
 
     if peak_df.empty:
         log.debug('{} peak:{} data is empty.'.format(symbol, FREQ[frequency]))
+        _save_segment_state(state, hq_df, segments)
         return False
 
     # 同一根k线出现极值点的情况
-    if last_doc is None or peak_df.datetime[1] != peak_df.datetime[0]:
+    anchor = state['anchor']
+    if anchor is None or len(peak_df) < 2 or peak_df.datetime[1] != peak_df.datetime[0]:
         log.debug('Do not judge first two peak recorders')
     else:
         log.debug('Two peak of {} in one day {}.'.format(symbol, peak_df.datetime[0]))
-        if peak_df.type[0] == last_doc['type']:
+        if peak_df.type[0] == anchor['type']:
             peak_df.drop(1, inplace=True)
         else:
             peak_df.drop(0, inplace=True)
@@ -543,161 +759,186 @@ def build_base_segments(symbol, frequency, instrument='index'):
     segment_df = get_segments_from_peaks(peak_df)
     if segment_df.empty:
         log.debug('{} segment:{} data is empty.'.format(symbol, FREQ[frequency]))
+        _save_segment_state(state, hq_df, segments)
         return False
 
-    segment_df['symbol'] = symbol
-    segment_df['frequency'] = frequency
+    # 和状态中起点之后的段比较，只处理被撤销的段和新确认的段
+    keys = {(segment['datetime'], segment['type']) for segment in segments}
+    new_keys = set(zip(segment_df['datetime'].map(pd.Timestamp.to_pydatetime), segment_df['type']))
 
-    origin_segment = segment_cursor.find(filter_dict, sort=[('datetime', ASCENDING)])
-    origin_segment_df = pd.DataFrame(list(origin_segment))
-
-    # 没有记录直接插入数据
-    if origin_segment_df.empty:
-        result = segment_cursor.insert_many(segment_df.to_dict('records'))
-
-        if result.acknowledged:
-            log.debug('{} segment:{} data insert success.'.format(symbol, FREQ[frequency]))
-            return True  # 形成新的segment，需要后续进行处理block
-        else:
-            log.warning('{} segment:{} data insert failure.'.format(symbol, FREQ[frequency]))
-            return False
-
-    index = ['datetime', 'type']
-    df1 = segment_df.set_index(index).sort_index()
-    df2 = origin_segment_df.set_index(index).sort_index()
-
-    rm_index = df2.index.difference(df1.index)
-
-    if rm_index.empty:
+    rm_ids = [segment['_id'] for segment in segments if (segment['datetime'], segment['type']) not in new_keys]
+    if not rm_ids:
         log.debug('Do not delete any historical {} segment:{} data .'.format(symbol, FREQ[frequency]))
     else:
-        log.debug('Delete {} historical {} segment:{} data .'.format(len(rm_index), symbol, FREQ[frequency]))
-
-        # if len(in_index) != len(segment_df) - 1:
-        #     pass
         # 删除未确定数据
-        result = segment_cursor.delete_many({'_id': {'$in': df2.loc[rm_index, '_id'].to_list()}})
+        result = segment_cursor.delete_many({'_id': {'$in': rm_ids}})
 
         if result.acknowledged:
-            log.debug('{} segment:{} data delete {} success.'.format(symbol, FREQ[frequency], len(rm_index)))
+            log.debug('{} segment:{} data delete {} success.'.format(symbol, FREQ[frequency], len(rm_ids)))
         else:
-            log.warning('{} segment:{} data delete {} failure.'.format(symbol, FREQ[frequency], len(rm_index)))
+            log.warning('{} segment:{} data delete {} failure.'.format(symbol, FREQ[frequency], len(rm_ids)))
             return False
+        rm_ids = set(rm_ids)
+        segments = [segment for segment in segments if segment['_id'] not in rm_ids]
 
-    in_index = df1.index.difference(df2.index)
-    segment_df = df1.loc[in_index].reset_index()
+    in_flag = [(date.to_pydatetime(), peak_type) not in keys
+               for date, peak_type in zip(segment_df['datetime'], segment_df['type'])]
+    segment_df = segment_df[in_flag]
     if segment_df.empty:
         log.debug('Do not build any  {} segment:{} data .'.format(symbol, FREQ[frequency]))
+        _save_segment_state(state, hq_df, segments)
         return False
 
+    segment_df = segment_df.assign(symbol=symbol, frequency=frequency)
     result = segment_cursor.insert_many(segment_df.to_dict('records'))
 
     if result.acknowledged:
         log.debug('{} segment:{} data insert {} success.'.format(symbol, FREQ[frequency], len(segment_df)))
-        return True
     else:
         log.warning('{} segment:{} data insert {} failure.'.format(symbol, FREQ[frequency], len(segment_df)))
         return False
 
+    segments += [{'_id': _id, 'datetime': date.to_pydatetime(), 'type': peak_type} for _id, date, peak_type in
+                 zip(result.inserted_ids, segment_df['datetime'], segment_df['type'])]
+    segments.sort(key=_segment_key)
+    _save_segment_state(state, hq_df, segments)
+    return True  # 形成新的segment，需要后续进行处理block
+
 
-def build_high_level_segments(symbol, frequency):
+def _promote_segments(segment_df, frequency, partial=False):
     """
-    对低级别段进行处理得到高级别段
-    :param symbol: 交易代码
-    :param frequency: 频率值，从0-9，从tick到year
-    :return: True 还需要后续处理，不需要后续处理
+    在内存中计算一个级别的段，直接修改 segment_df['frequency']，不读写数据库
+    :param segment_df: pd.DataFrame index=_id 按 datetime 升序排列
+    :param frequency: 频率值
+    :param partial: segment_df 是否只包含起点之后的段
+    :return: True 有段升级到该级别，None 起点不在 segment_df 中
     """
-    segment_cursor = conn['segment']
-
     # 读取高一级别极值点作为处理的起点
-    filter_dict = {'symbol': symbol, 'frequency': {'$gte': frequency}}
-    last_doc = segment_cursor.find_one(filter_dict, sort=[('datetime', DESCENDING)], skip=2)
-
-    if last_doc is None:
-        log.info("Build {} future segment from trade beginning.".format(symbol))
-    else:
-        update = last_doc['datetime']
-        # filter_dict['datetime'] = {'$gte': update, '$lte': datetime(2012, 9, 7)}
-        filter_dict['datetime'] = {'$gte': update}
-        log.info("Build {} future segment from {}".format(symbol, update))
+    high_df = segment_df[segment_df['frequency'] >= frequency]
+    last_doc = high_df.iloc[-3] if len(high_df) >= 3 else None
+    if last_doc is None and partial:
+        return None
 
-    # 从数据库读取所需数据
-    filter_dict['frequency'] = {'$gte': frequency - 1}
-    low_segment = segment_cursor.find(filter_dict).sort([("datetime", ASCENDING)])
-    low_segment_df = pd.DataFrame(list(low_segment))
+    mask = segment_df['frequency'] >= frequency - 1
+    if last_doc is not None:
+        mask = mask & (segment_df['datetime'] >= last_doc['datetime'])
+    low_segment_df = segment_df[mask].reset_index(drop=True)
     if low_segment_df.empty:
-        log.debug('{} segment data:{} is empty!'.format(symbol, FREQ[frequency]))
         return False
 
     peak_df = get_peaks_from_segments(low_segment_df)
-
     if peak_df.empty:
-        log.debug('{} peak:{} data is empty.'.format(symbol, FREQ[frequency]))
         return False
 
-    if last_doc is None or peak_df.datetime[1] != peak_df.datetime[0]:
+    if last_doc is None or len(peak_df) < 2 or peak_df.datetime[1] != peak_df.datetime[0]:
         log.debug('Do not judge first two peak recorders')
     else:
-        log.debug('Two peak of {} in one day {}.'.format(symbol, peak_df.datetime[0]))
         if peak_df.type[0] == last_doc['type']:
             peak_df.drop(1, inplace=True)
         else:
             peak_df.drop(0, inplace=True)
 
-    segment_df = get_segments_from_peaks(peak_df)
-    if segment_df.empty:
-        log.debug('{} segment:{} data is empty.'.format(symbol, FREQ[frequency]))
+    result_df = get_segments_from_peaks(peak_df)
+    if result_df.empty:
         return False
 
-    origin_segment_df = low_segment_df[low_segment_df['frequency'] == frequency]
+    origin_ids = low_segment_df.loc[low_segment_df['frequency'] == frequency, '_id']
 
     # 没有记录直接更新数据
-    if origin_segment_df.empty:
-        result = segment_cursor.update_many({'_id': {'$in': segment_df['_id'].to_list()}},
-                                            {'$set': {'frequency': frequency}})
-
-        if result.acknowledged:
-            log.debug('{} segment:{} data update {} success.'.format(symbol, FREQ[frequency], len(segment_df)))
-            return True  # 形成新的segment，需要后续进行处理block
-        else:
-            log.warning('{} segment:{} data update failure.'.format(symbol, FREQ[frequency]))
-            return False
-
-    segment_df.set_index('_id', inplace=True)
-    origin_segment_df.set_index('_id', inplace=True)
+    if origin_ids.empty:
+        segment_df.loc[result_df['_id'].to_list(), 'frequency'] = frequency
+        return True
 
-    down_index = origin_segment_df.index.difference(segment_df.index)
+    down_ids = origin_ids[~origin_ids.isin(result_df['_id'])]
+    segment_df.loc[down_ids.to_list(), 'frequency'] = frequency - 1
 
-    if down_index.empty:
-        log.debug('Do not degrade any historical {} segment:{} data .'.format(symbol, FREQ[frequency]))
-    else:
-        log.debug('Degrade {} historical {} segment:{} data .'.format(len(down_index), symbol, FREQ[frequency]))
+    up_ids = result_df.loc[result_df['frequency'] < frequency, '_id']
+    segment_df.loc[up_ids.to_list(), 'frequency'] = frequency
+    return not up_ids.empty
 
-        result = segment_cursor.update_many({'_id': {'$in': down_index.to_list()}},
-                                            {'$set': {'frequency': frequency - 1}})
 
-        if result.acknowledged:
-            log.debug('{} segment:{} data degrade {} success.'.format(symbol, FREQ[frequency], len(down_index)))
-        else:
-            log.warning('{} segment:{} data degrade {} failure.'.format(symbol, FREQ[frequency], len(down_index)))
-            return False
-
-    segment_df = segment_df[segment_df['frequency'] < frequency]
-    up_index = segment_df.index
+def _promote_levels(segment_df, frequency, max_frequency, partial=False, seconds=None):
+    """
+    从 frequency 开始逐级计算，某一级别没有段升级时，更高级别的输入没有变化，不再计算
+    :param seconds: dict 传入时累加每个级别的计算耗时 {frequency: seconds}
+    :return: list of frequency 有新段形成的级别，None 起点不在 segment_df 中
+    """
+    levels = []
+    for level in range(frequency, max_frequency + 1):
+        begin = time.perf_counter()
+        flag = _promote_segments(segment_df, level, partial)
+        if seconds is not None:
+            seconds[level] = seconds.get(level, 0.) + time.perf_counter() - begin
+        if flag is None:
+            return None
+        if not flag:
+            break
+        levels.append(level)
+    return levels
+
+
+def _read_level_segments(symbol, frequency, start=None):
+    filter_dict = {'symbol': symbol, 'frequency': {'$gte': frequency - 1}}
+    if start is not None:
+        filter_dict['datetime'] = {'$gte': start}
+    segments = conn['segment'].find(filter_dict).sort([("datetime", ASCENDING)])
+    segment_df = read_cursor(segments)
+    if not segment_df.empty:
+        segment_df.index = pd.Index(segment_df['_id'].to_list(), name='_id')
+    return segment_df
+
+
+def build_high_level_segments(symbol, frequency=6, max_frequency=9, seconds=None):
+    """
+    对低级别段进行处理得到 frequency 到 max_frequency 各级别的段
+    一次读取需要的段，在内存中逐级计算，只把变化的 frequency 用一次 bulk_write 写回数据库
+    某一级别没有段升级时，更高级别的输入没有变化，不再计算
+    :param symbol: 交易代码
+    :param frequency: 频率值，从0-9，从tick到year，开始计算的级别
+    :param max_frequency: 最高计算的级别
+    :param seconds: dict 传入时记录每个级别在内存中的计算耗时 {frequency: seconds}，不包括读写数据库
+    :return: list of frequency 有新段形成的级别，需要后续处理 block
+    """
+    segment_cursor = conn['segment']
 
-    if up_index.empty:
-        log.debug('Do not upgrade any historical {} segment:{} data .'.format(symbol, FREQ[frequency]))
-        return False
+    # 最高级别的起点最早，从这里开始读取就包括了所有级别需要的段
+    last_doc = segment_cursor.find_one({'symbol': symbol, 'frequency': {'$gte': max_frequency}},
+                                       sort=[('datetime', DESCENDING)], skip=2)
+    start = None if last_doc is None else last_doc['datetime']
+    if start is None:
+        log.info("Build {} future segment from trade beginning.".format(symbol))
+    else:
+        log.info("Build {} future segment from {}".format(symbol, start))
 
-    result = segment_cursor.update_many({'_id': {'$in': up_index.to_list()}},
-                                        {'$set': {'frequency': frequency}})
+    segment_df = _read_level_segments(symbol, frequency, start)
+    if segment_df.empty:
+        log.debug('{} segment data:{} is empty!'.format(symbol, FREQ[frequency]))
+        return []
+    origin_frequency = segment_df['frequency'].copy()
+
+    levels = _promote_levels(segment_df, frequency, max_frequency, partial=start is not None, seconds=seconds)
+    if levels is None:
+        # 低级别的处理使高级别段减少，起点在读取的数据之前，读取全部数据重新计算
+        log.info('Rebuild {} high level segment from trade beginning.'.format(symbol))
+        segment_df = _read_level_segments(symbol, frequency)
+        origin_frequency = segment_df['frequency'].copy()
+        levels = _promote_levels(segment_df, frequency, max_frequency, seconds=seconds)
+
+    changed = segment_df['frequency'] != origin_frequency
+    if not changed.any():
+        log.debug('Do not change any historical {} segment:{} data .'.format(symbol, FREQ[frequency]))
+        return levels
+
+    requests = [UpdateMany({'_id': {'$in': ids.index.to_list()}}, {'$set': {'frequency': int(value)}})
+                for value, ids in segment_df.loc[changed, 'frequency'].groupby(segment_df.loc[changed, 'frequency'])]
+    result = segment_cursor.bulk_write(requests, ordered=False)
 
     if result.acknowledged:
-        log.debug('{} segment:{} data upgrade {} success.'.format(symbol, FREQ[frequency], len(up_index)))
-        return True
+        log.debug('{} segment:{} data update {} success.'.format(symbol, levels, changed.sum()))
+        return levels
     else:
-        log.debug('{} segment:{} data upgrade {} failure.'.format(symbol, FREQ[frequency], len(up_index)))
-        return False
+        log.warning('{} segment:{} data update {} failure.'.format(symbol, levels, changed.sum()))
+        return []
 
 
 def build_blocks(symbol, frequency):
@@ -715,7 +956,7 @@ def build_blocks(symbol, frequency):
     last_2_docs = block_cursor.find(filter_dict, sort=[('enter_date', -1)], limit=2)
 
     #  只有一个记录或者没有记录要从头开始取数据
-    last_2_docs_df = pd.DataFrame(list(last_2_docs))
+    last_2_docs_df = read_cursor(last_2_docs)
     filter_dict['frequency'] = {'$gte': frequency}
     if last_2_docs_df.empty or len(last_2_docs_df) == 1:
         # filter_dict['datetime'] = {'$lte': datetime(2000, 5, 31)}
@@ -726,7 +967,7 @@ def build_blocks(symbol, frequency):
         log.info("Build {} block from {}".format(symbol, update))
 
     segments = segment_cursor.find(filter_dict, sort=[('datetime', 1)])
-    segment_df = pd.DataFrame(list(segments))
+    segment_df = read_cursor(segments)
     if segment_df.empty or len(segment_df) < 3:
         log.debug('{} segment data:{} is not enough!'.format(symbol, FREQ[frequency]))
         return False
@@ -782,36 +1023,94 @@ def build_blocks(symbol, frequency):
         return False
 
 
-def build_all_blocks():
+def _init_block_worker():
+    """
+    子进程使用自己的 MongoClient，fork 之后不能使用父进程的连接池
+    """
+    global conn
+    conn = connect_mongo(db='quote', username=DATA_ANALYST, password=ANALYST_PWD)
+
+
+def build_symbol_blocks(symbol, refresh=False):
+    """
+    单个品种从日线开始逐级处理：低级别形成新的段才处理高级别的段和 block，没有变化的级别跳过
+    各品种之间相互独立，可以在子进程中运行
+    :param symbol: 交易代码
+    :param refresh: True 忽略保存的分段状态，从数据库中已有的段重新生成
+    :return: list of (symbol, frequency, step, result, seconds, error) 每一步的结果和耗时，
+        高级别的段每个级别记录一次计算耗时，一次读写数据库的耗时记在 segments_io
+    """
+    records = []
+
+    def run(step, frequency, func):
+        begin = time.perf_counter()
+        try:
+            result, error = func(symbol, frequency), None
+        except Exception as e:
+            log.exception('Build {} {}:{} error.'.format(symbol, step, FREQ[frequency]))
+            result, error = None, repr(e)
+        records.append((symbol, frequency, step, result, time.perf_counter() - begin, error))
+        return result
+
+    # 从日线频率开始[ 5, 6, 7] 只处理日线 周线 月线数据,这里的频率只是级别分类，不代表字面意义
+    frequency = 5
+    # 是否形成新的段，形成新的段对block更新，有新的block，计算block之间的关系
+    #              同时判断高级别段是否形成
+    level_seconds = {}
+    if run('base_segments', frequency, partial(build_base_segments, refresh=refresh)):
+        # 各级别的段一次读取、一次写回，读写数据库的耗时记为 segments_io，每个级别的计算耗时分别记录
+        levels = run('segments_io', frequency + 1, partial(build_high_level_segments, seconds=level_seconds)) or []
+        io_record = records.pop()
+        records.append(io_record[:4] + (io_record[4] - sum(level_seconds.values()),) + io_record[5:])
+        for level, seconds in sorted(level_seconds.items()):
+            records.append((symbol, level, 'segments', level in levels, seconds, None))
+
+        # 有新段形成的级别再处理 block
+        for level in levels:
+            run('blocks', level, build_blocks)
+
+    # 低级别没有变化，高级别的输入没有变化
+    for level in range(frequency + 1, 10):
+        if level not in level_seconds:
+            records.append((symbol, level, 'segments', 'skipped', 0., None))
+    return records
+
+
+def build_all_blocks(workers=BUILD_WORKERS, refresh=False):
+    """
+    各品种的级别依次处理，品种之间在进程池中并行，总耗时取决于最慢的品种
+    :param workers: 进程数
+    :param refresh: True 忽略保存的分段状态，从数据库中已有的段重新生成
+    :return: pd.DataFrame columns=['symbol', 'frequency', 'step', 'result', 'seconds', 'error'] 每一步的结果和耗时
+    """
     # 更新指数数据
     # build_future_index()
 
     # 先从指数分析，期货只分析XX00指数合约和XX88连续合约
-    # Connect to MongoDB
-    # conn = connect_mongo('quote')
-    # segment_cursor = conn['segment']
-    index_cursor = conn['index']
-
-    filter_dict = {'symbol': {'$regex': '(8|0){2}$'}, 'datetime': {"$gt": datetime.today() - timedelta(360)}}
-    symbols = index_cursor.distinct('symbol', filter_dict)
+    symbols = get_symbols(series=['00', '88'], active_since=datetime.today() - timedelta(360))
 
     if not isinstance(symbols, list) or len(symbols) == 0:
-        print("Don't find any trading symbols in index collection!")
+        print("Don't find any trading symbols in symbol table!")
         return
 
-    for symbol in symbols:
-        # 从日线频率开始[ 5, 6, 7] 只处理日线 周线 月线数据,这里的频率只是级别分类，不代表字面意义
-        frequency = 5
-        # 是否形成新的段，形成新的段对block更新，有新的block，计算block之间的关系
-        #              同时判断高级别段是否形成
-        bflag = build_base_segments(symbol, frequency)
-        frequency += 1
-        while bflag and frequency < 10:
-            bflag = build_high_level_segments(symbol, frequency)
-            # frequency += 1
-            if bflag:
-                build_blocks(symbol, frequency)
-                frequency += 1
+    begin = time.perf_counter()
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(symbols)), initializer=_init_block_worker) as executor:
+            results = list(executor.map(partial(build_symbol_blocks, refresh=refresh), symbols))
+    else:
+        results = [build_symbol_blocks(symbol, refresh=refresh) for symbol in symbols]
+    elapsed = time.perf_counter() - begin
+
+    summary_df = pd.DataFrame([record for records in results for record in records],
+                              columns=['symbol', 'frequency', 'step', 'result', 'seconds', 'error'])
+    symbol_seconds = summary_df.groupby('symbol')['seconds'].sum().sort_values(ascending=False)
+    failure = summary_df.loc[summary_df['error'].notna(), 'symbol'].unique().tolist()
+    print('Build blocks of {} symbols in {:.1f}s, sum {:.1f}s, slowest {} {:.1f}s, {} failure: {}'.format(
+        len(symbols), elapsed, symbol_seconds.sum(), symbol_seconds.index[0], symbol_seconds.iloc[0],
+        len(failure), failure))
+    level_df = summary_df.pivot_table(index='symbol', columns=['frequency', 'step'], values='seconds', aggfunc='sum')
+    log.info('Block build seconds by level:\n{}'.format(level_df.loc[symbol_seconds.index]))
+    return summary_df
 
 
 if __name__ == "__main__":
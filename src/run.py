@@ -1,9 +1,14 @@
+from src.data import conn
 from src.data.future.hq import insert_hq_to_mongo, build_future_index
 from src.data.future.spread import insert_spot_to_mongo
 from src.features import build_all_blocks
+from src.data.schema import ensure_indexes
+from src.util import sync_all_history
 
 if __name__ == '__main__':
+    ensure_indexes()
     # insert_hq_to_mongo()
     # build_future_index()
     # insert_spot_to_mongo()
+    sync_all_history(conn)
     build_all_blocks()
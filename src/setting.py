@@ -12,3 +12,16 @@ DATA_COLLECTOR = os.environ.get('DATA_COLLECTOR')
 COLLECTOR_PWD = os.environ.get('COLLECTOR_PWD')
 DATA_ANALYST = os.environ.get('DATA_ANALYST')
 ANALYST_PWD = os.environ.get('ANALYST_PWD')
+
+# 每个 MongoClient 连接池的最大连接数和连接超时(毫秒)
+MONGODB_POOL_SIZE = int(os.environ.get('MONGODB_POOL_SIZE', 100))
+MONGODB_TIMEOUT = int(os.environ.get('MONGODB_TIMEOUT', 30000))
+
+# 编制指数、计算block等按品种并行处理时的进程数
+BUILD_WORKERS = int(os.environ.get('BUILD_WORKERS', os.cpu_count() or 1))
+
+# 本地保存的历史行情目录，按 instrument/symbol/year 分区的 parquet 文件
+HISTORY_DIR = Path(os.environ.get('HISTORY_DIR', str(basedir / 'data/processed/history')))
+
+# TsBlock 计算的 peaks、segments、blocks 缓存目录，按 code/kind_freq 保存为 parquet 文件
+BLOCK_CACHE_DIR = Path(os.environ.get('BLOCK_CACHE_DIR', str(basedir / 'data/interim/block')))
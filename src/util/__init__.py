@@ -2,3 +2,5 @@
 from src.util.crawler import *
 from src.util.utils import *
 from src.util.db import *
+from src.util.downloader import *
+from src.util.store import *
@@ -1,67 +1,169 @@
 # -*- coding: utf-8 -*-
+import time
+import threading
+from urllib.parse import urlparse
+
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from lxml import etree
 from log import LogHandler
 
 log = LogHandler('util.crawler.log')
 
+# requests 只能解压 gzip 和 deflate，不声明 br 避免服务器返回无法解码的 brotli 数据
 HEADERS = {'Connection': 'keep-alive',
            'Cache-Control': 'max-age=0',
            'Upgrade-Insecure-Requests': '1',
            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_3) AppleWebKit/537.36 (KHTML, like Gecko)',
            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-           'Accept-Encoding': 'gzip, deflate, br',
+           'Accept-Encoding': 'gzip, deflate',
            'Accept-Language': 'zh-CN,zh;q=0.8',
            }
 
 
-def get_html_text(url, headers=HEADERS, encoding=None):
-    try:
-        response = requests.get(url, headers=headers, timeout=30)
+class Crawler:
+    """
+    爬虫客户端，每个主机共享一个 requests.Session，复用 keep-alive 连接，
+    GET 请求的连接错误和 5xx 错误按 backoff 自动重试，并统计每个主机的请求耗时
+    """
+
+    def __init__(self, headers=HEADERS, timeout=30, retries=0, backoff=0.5, pool_size=10):
+        """
+        :param headers: 默认请求头
+        :param timeout: 请求超时秒数
+        :param retries: GET 请求连接错误或者服务器错误的重试次数，由 download_concurrently 重试时为 0
+        :param backoff: 重试等待时间因子，第n次重试等待 backoff * 2 ** (n - 1) 秒
+        :param pool_size: 每个主机连接池的最大连接数，不小于下载线程数
+        """
+        self.headers = headers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.__sessions = {}
+        self.__stats = {}
+        self.__lock = threading.Lock()
+
+    def __get_session(self, host):
+        with self.__lock:
+            session = self.__sessions.get(host)
+            if session is None:
+                retry = Retry(total=self.retries, backoff_factor=self.backoff,
+                              status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset(['GET']),
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.headers.update(self.headers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.__sessions[host] = session
+                self.__stats[host] = {'requests': 0, 'errors': 0, 'seconds': 0., 'max_seconds': 0.}
+        return session
+
+    def __record(self, host, seconds, error):
+        with self.__lock:
+            stat = self.__stats[host]
+            stat['requests'] += 1
+            stat['errors'] += int(error)
+            stat['seconds'] += seconds
+            stat['max_seconds'] = max(stat['max_seconds'], seconds)
+
+    def request(self, method, url, headers=None, encoding=None, **kwargs):
+        """
+        发送请求并设置返回文本的编码
+        :param method: 'GET' 'POST'
+        :param url:
+        :param headers: 与默认请求头不同时才需要传入
+        :param encoding: None 使用 apparent_encoding
+        :return: requests.Response
+        """
+        host = urlparse(url).netloc
+        session = self.__get_session(host)
+        if headers == self.headers:
+            headers = None
+
+        begin = time.monotonic()
+        error = True
+        try:
+            response = session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+            error = not response.ok
+        finally:
+            self.__record(host, time.monotonic() - begin, error)
+
         response.raise_for_status()
         if encoding is None:
             response.encoding = response.apparent_encoding
         else:
             response.encoding = encoding
+        return response
+
+    def get_stats(self):
+        """
+        每个主机的请求统计
+        :return: pd.DataFrame index=host, columns=['requests', 'errors', 'seconds', 'max_seconds', 'mean_seconds']
+        """
+        with self.__lock:
+            stats_df = pd.DataFrame.from_dict(self.__stats, orient='index')
+        if not stats_df.empty:
+            stats_df['mean_seconds'] = stats_df['seconds'] / stats_df['requests']
+        return stats_df
+
+    def close(self):
+        with self.__lock:
+            for session in self.__sessions.values():
+                session.close()
+            self.__sessions.clear()
+
+
+# 直接调用 get_html_text 等函数的请求使用的客户端，GET 请求自动重试
+crawler = Crawler(retries=3)
+
+
+def get_html_text(url, headers=HEADERS, encoding=None, client=None):
+    """
+    :param client: Crawler，None 使用自动重试的 crawler
+    """
+    try:
+        response = (client or crawler).request('GET', url, headers=headers, encoding=encoding)
         return response.text
-    except:
-        log.info('{} is {}'.format(url, response.status_code))
-        return response.status_code
+    except requests.HTTPError as e:
+        log.info('{} is {}'.format(url, e.response.status_code))
+        return e.response.status_code
+    except requests.RequestException as e:
+        log.info('{} is {!r}'.format(url, e))
+        return None
 
 
-def get_html_tree(url, headers=HEADERS, encoding=None):
+def get_html_tree(url, headers=HEADERS, encoding=None, client=None):
     """
     获取html树
     :param url:
     :param headers:
     :param encoding:
+    :param client: Crawler，None 使用自动重试的 crawler
     :return:
     """
     try:
-        response = requests.get(url=url, headers=headers, timeout=30)
-        response.raise_for_status()
-        if encoding is None:
-            response.encoding = response.apparent_encoding
-        else:
-            response.encoding = encoding
+        response = (client or crawler).request('GET', url, headers=headers, encoding=encoding)
         return etree.HTML(response.text)
-    except:
-        log.info('{} is {}'.format(url, response.status_code))
-        return response.status_code
+    except requests.HTTPError as e:
+        log.info('{} is {}'.format(url, e.response.status_code))
+        return e.response.status_code
+    except requests.RequestException as e:
+        log.info('{} is {!r}'.format(url, e))
+        return None
 
 
-def get_post_text(url, data=None, headers=HEADERS, encoding=None):
+def get_post_text(url, data=None, headers=HEADERS, encoding=None, client=None):
 
     try:
-        response = requests.post(url=url, data=data, headers=headers, timeout=30)
-        response.raise_for_status()
-        if encoding is None:
-            response.encoding = response.apparent_encoding
-        else:
-            response.encoding = encoding
+        response = (client or crawler).request('POST', url, headers=headers, encoding=encoding, data=data)
         return response.text
-    except:
-        log.info('{} is {}'.format(url, response.status_code))
-        return response.status_code
-
-
+    except requests.HTTPError as e:
+        log.info('{} is {}'.format(url, e.response.status_code))
+        return e.response.status_code
+    except requests.RequestException as e:
+        log.info('{} is {!r}'.format(url, e))
+        return None
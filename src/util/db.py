@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from itertools import islice
+
 import pandas as pd
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
-from src.setting import MONGODB_URI, MONGODB_PORT, DATA_COLLECTOR, COLLECTOR_PWD, DATA_ANALYST, ANALYST_PWD
+from src.setting import MONGODB_URI, MONGODB_PORT, DATA_COLLECTOR, COLLECTOR_PWD, DATA_ANALYST, ANALYST_PWD, \
+    MONGODB_POOL_SIZE, MONGODB_TIMEOUT
 from log import LogHandler
 
 log = LogHandler('data.log')
@@ -10,17 +16,136 @@ log = LogHandler('data.log')
 # client = MongoClient("mongodb+srv://unistar:<password>@cluster0-y9smy.mongodb.net/test?retryWrites=true")
 # api = client.test
 
+# 进程内共享的 MongoClient，key=(host, port, username, db)
+_clients = {}
+_clients_pid = os.getpid()
+_clients_lock = threading.Lock()
+
+
+def _reset_mongo_clients():
+    """
+    fork 之后子进程不能使用父进程的连接池，丢弃继承的 MongoClient，由子进程重新建立
+    """
+    global _clients_pid, _clients_lock
+    _clients.clear()
+    _clients_pid = os.getpid()
+    _clients_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_mongo_clients)
+
+
+def get_mongo_client(db, username=DATA_COLLECTOR, password=COLLECTOR_PWD, host=MONGODB_URI, port=MONGODB_PORT,
+                     pool_size=MONGODB_POOL_SIZE, timeout=MONGODB_TIMEOUT):
+    """
+    返回进程内共享的 MongoClient，相同 (host, port, username, db) 只建立一个连接池
+    :param pool_size: 连接池的最大连接数
+    :param timeout: 连接和选择服务器的超时(毫秒)
+    :return: MongoClient
+    """
+    if _clients_pid != os.getpid():  # 不支持 register_at_fork 的平台
+        _reset_mongo_clients()
+
+    port = int(port) if port else None
+    key = (host, port, username, db)
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            options = {'maxPoolSize': pool_size,
+                       'connectTimeoutMS': timeout,
+                       'serverSelectionTimeoutMS': timeout,
+                       'connect': False}  # 第一次操作时才连接，fork 前建立的 client 不会打开 socket
+            if username and password:
+                mongo_uri = 'mongodb://{}:{}@{}:{}/{}'.format(username, password, host, port, db)
+                client = MongoClient(mongo_uri, **options)
+            else:
+                client = MongoClient(host, port, **options)
+            _clients[key] = client
+
+    return client
+
 
 def connect_mongo(db, username=DATA_COLLECTOR, password=COLLECTOR_PWD, host=MONGODB_URI, port=MONGODB_PORT):
     """ A util for making a connection to mongo """
 
-    if username and password:
-        mongo_uri = 'mongodb://{}:{}@{}:{}/{}'.format(username, password, host, port, db)
-        conn = MongoClient(mongo_uri)
-    else:
-        conn = MongoClient(host, port)
-
-    return conn[db]
+    return get_mongo_client(db, username=username, password=password, host=host, port=port)[db]
+
+
+def get_mongo_stats(ping=True):
+    """
+    当前进程中共享的 MongoClient 状态
+    :param ping: 是否 ping 服务器，检查连接是否正常
+    :return: pd.DataFrame columns=['host', 'port', 'username', 'db', 'pool_size', 'alive', 'ping_ms']
+    """
+    with _clients_lock:
+        items = list(_clients.items())
+
+    stats = []
+    for (host, port, username, db), client in items:
+        alive, ping_ms = None, None
+        if ping:
+            begin = time.monotonic()
+            try:
+                client[db].command('ping')
+                alive = True
+                ping_ms = (time.monotonic() - begin) * 1000
+            except Exception as e:
+                alive = False
+                log.warning('Ping mongo {}:{}/{} failure: {!r}'.format(host, port, db, e))
+        stats.append([host, port, username, db, client.options.pool_options.max_pool_size, alive, ping_ms])
+
+    return pd.DataFrame(stats, columns=['host', 'port', 'username', 'db', 'pool_size', 'alive', 'ping_ms'])
+
+
+def close_mongo():
+    """ 关闭当前进程中所有共享的 MongoClient """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def read_cursor(cursor, projection=None, dtypes=None, batch_size=10000):
+    """
+    分批读取 cursor，每批文档直接转换为列数据，不再生成全部文档的 list，
+    峰值内存约为最终 DataFrame 的两倍加一批文档，而不是全部文档的 dict 加 DataFrame
+    :param cursor: pymongo Cursor 或者 aggregate 返回的 CommandCursor
+    :param projection: 查询使用的 projection，包含字段时只返回这些字段，没有数据时也保留列名
+    :param dtypes: dict {column: dtype} 每批数据转换的类型，如 {'volume': 'int64', 'close': 'float32'}
+    :param batch_size: 每批读取的文档数量
+    :return: pd.DataFrame
+    """
+    columns = None
+    if projection:
+        columns = [k for k, v in projection.items() if v and k != '_id']
+        if projection.get('_id', 1) and columns:
+            columns.insert(0, '_id')
+        columns = columns or None
+
+    if dtypes and columns:
+        dtypes = {k: v for k, v in dtypes.items() if k in columns}
+
+    if hasattr(cursor, 'batch_size'):
+        cursor = cursor.batch_size(batch_size)
+
+    frames = []
+    while True:
+        batch = list(islice(cursor, batch_size))
+        if not batch:
+            break
+        df = pd.DataFrame.from_records(batch, columns=columns)
+        del batch
+        if dtypes:
+            df = df.astype({k: v for k, v in dtypes.items() if k in df.columns})
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    elif len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True, sort=False)
 
 
 def read_mongo(database, collection, query={}, host=MONGODB_URI, port=MONGODB_PORT,
@@ -34,15 +159,35 @@ def read_mongo(database, collection, query={}, host=MONGODB_URI, port=MONGODB_PO
     cursor = db[collection].find(query)
 
     # Expand the cursor and construct the DataFrame
-    df = pd.DataFrame(list(cursor))
+    df = read_cursor(cursor)
 
     # Delete the _id
-    if no_id:
+    if no_id and '_id' in df.columns:
         del df['_id']
 
     return df
 
 
+def upsert_many(collection, records, keys, batch_size=5000):
+    """
+    按唯一键批量 upsert，已经存在且相同的记录不会修改，重复导入同一批数据没有副作用
+    :param collection: pymongo Collection
+    :param records: list of dict
+    :param keys: list of str 唯一键字段，与 collection 的唯一索引一致
+    :param batch_size: 每次 bulk_write 的操作数
+    :return: dict {'upserted': n, 'modified': n, 'matched': n}
+    """
+    counts = {'upserted': 0, 'modified': 0, 'matched': 0}
+    for i in range(0, len(records), batch_size):
+        requests = [UpdateOne({key: record[key] for key in keys}, {'$set': record}, upsert=True)
+                    for record in records[i:i + batch_size]]
+        result = collection.bulk_write(requests, ordered=False)
+        counts['upserted'] += result.upserted_count
+        counts['modified'] += result.modified_count
+        counts['matched'] += result.matched_count
+    return counts
+
+
 def to_mongo(database, collection, data: dict, host=MONGODB_URI, port=MONGODB_PORT,
              username=DATA_COLLECTOR, password=COLLECTOR_PWD):
     """ Read from Mongo and Store into DataFrame """
@@ -63,3 +208,21 @@ def to_mongo(database, collection, data: dict, host=MONGODB_URI, port=MONGODB_PO
         result = cursor.insert_many(data)
 
     return result.acknowledged
+
+
+if __name__ == '__main__':
+    import tracemalloc
+
+    # 对比 pd.DataFrame(list(cursor)) 和 read_cursor 的速度和峰值内存
+    quote = connect_mongo(db='quote', username=DATA_ANALYST, password=ANALYST_PWD)
+    for name in ['future', 'index']:
+        for label, func in (('DataFrame(list(cursor))', lambda c: pd.DataFrame(list(c))),
+                            ('read_cursor', read_cursor)):
+            tracemalloc.start()
+            begin = time.perf_counter()
+            df = func(quote[name].find({}, {'_id': 0}))
+            seconds = time.perf_counter() - begin
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+            print('{:<8}{:<24}{:>10} rows {:8.2f}s peak {:8.1f}MB frame {:8.1f}MB'.format(
+                name, label, len(df), seconds, peak, df.memory_usage(deep=True).sum() / 2 ** 20))
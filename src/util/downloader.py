@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from log import LogHandler
+
+log = LogHandler('util.downloader.log')
+
+# 下载函数返回 NO_DATA 说明请求成功但是没有数据，例如节假日，不需要重试
+NO_DATA = 'no_data'
+
+
+class RateLimiter:
+    """
+    按分组(交易所)限制请求频率，同一分组两次请求开始的间隔不小于设定的秒数
+    """
+
+    def __init__(self, intervals=None, default=0.):
+        """
+        :param intervals: dict {key: seconds} 每个分组的最小请求间隔
+        :param default: 没有设定分组的默认间隔
+        """
+        self.intervals = intervals or {}
+        self.default = default
+        self.__next_time = {}
+        self.__lock = threading.Lock()
+
+    def wait(self, key):
+        interval = self.intervals.get(key, self.default)
+        with self.__lock:
+            now = time.monotonic()
+            start = max(now, self.__next_time.get(key, now))
+            self.__next_time[key] = start + interval
+
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _run_task(limiter, key, name, func, args, retries, backoff):
+    """
+    执行单个下载任务，失败后按指数退避重试，没有数据时不重试
+    :return: (key, name, True 下载成功 NO_DATA 没有数据 False 下载失败, 尝试次数)
+    """
+    for attempt in range(retries + 1):
+        limiter.wait(key)
+        try:
+            result = func(*args)
+            if result is NO_DATA:
+                return key, name, NO_DATA, attempt + 1
+            if result:
+                return key, name, True, attempt + 1
+        except Exception as e:
+            log.warning('{} {} download error: {!r}'.format(key, name, e))
+
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+    return key, name, False, retries + 1
+
+
+def download_concurrently(tasks, intervals=None, workers=8, retries=3, backoff=1., report_every=50):
+    """
+    多线程下载，同一分组按 intervals 限速，下载失败后退避重试
+    :param tasks: list of (key, name, func, args)
+            key     限速分组，一般为交易所代码
+            name    任务名称，用于日志输出
+            func    下载函数，返回 True 表示下载成功，NO_DATA 表示没有数据，其他值表示失败需要重试
+            args    下载函数的参数 tuple
+    :param intervals: dict {key: seconds} 同一分组两次请求的最小间隔
+    :param workers: 线程数
+    :param retries: 失败后的重试次数
+    :param backoff: 第一次重试前等待的秒数，之后成倍增加
+    :param report_every: 每完成多少个任务输出一次进度
+    :return: dict {key: {'total': n, 'success': n, 'no_data': n, 'failure': [name], 'seconds': t}}
+    """
+    tasks = list(tasks)
+    total = len(tasks)
+    limiter = RateLimiter(intervals)
+
+    stats = {}
+    for key, name, _, _ in tasks:
+        stat = stats.setdefault(key, {'total': 0, 'success': 0, 'no_data': 0, 'failure': [], 'seconds': 0.})
+        stat['total'] += 1
+
+    if total == 0:
+        return stats
+
+    begin = time.monotonic()
+    with ThreadPoolExecutor(max_workers=min(workers, total)) as executor:
+        futures = [executor.submit(_run_task, limiter, key, name, func, args, retries, backoff)
+                   for key, name, func, args in tasks]
+
+        for done, future in enumerate(as_completed(futures), 1):
+            key, name, result, attempts = future.result()
+            stat = stats[key]
+            stat['seconds'] = time.monotonic() - begin
+            if result is NO_DATA:
+                stat['no_data'] += 1
+            elif result:
+                stat['success'] += 1
+            else:
+                stat['failure'].append(name)
+                log.warning('{} {} is not downloaded after {} attempts!'.format(key, name, attempts))
+
+            if done % report_every == 0 or done == total:
+                elapsed = time.monotonic() - begin
+                print('{} downloaded {}/{} files, {:.2f} files/s'.format(
+                    datetime.now().strftime('%H:%M:%S'), done, total, done / elapsed if elapsed else 0.))
+
+    for key, stat in stats.items():
+        rate = stat['success'] / stat['seconds'] if stat['seconds'] else 0.
+        log.info('{} download {}/{} files, {} without data in {:.1f}s, {:.2f} files/s'.format(
+            key, stat['success'], stat['total'], stat['no_data'], stat['seconds'], rate))
+
+    return stats
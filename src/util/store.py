@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pymongo import ASCENDING
+
+from src.setting import HISTORY_DIR
+from src.util.db import read_cursor
+from log import LogHandler
+
+log = LogHandler('util.store.log')
+
+# 每同步多少个 symbol 保存一次同步状态
+SAVE_STATE_EVERY = 100
+
+# 同步到本地的行情类型
+HISTORY_INSTRUMENTS = ['index', 'future', 'option']
+
+# symbol 和 year 由目录名表示，读取时作为分区字段
+PARTITION_FIELDS = [pa.field('symbol', pa.string()), pa.field('year', pa.int32())]
+
+
+def _state_path(instrument):
+    return HISTORY_DIR / instrument / '_synced.json'
+
+
+def get_synced_dates(instrument):
+    """
+    本地行情的同步截止时间，截止时间之前的数据都在本地，之后的数据需要从 Mongo 读取
+    :param instrument: 'future', 'option', 'index'
+    :return: dict {symbol: datetime}，没有本地数据时为空
+    """
+    path = _state_path(instrument)
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        state = json.load(f)
+    return {symbol: datetime.fromisoformat(value) for symbol, value in state.items()}
+
+
+def _save_synced_dates(instrument, synced):
+    path = _state_path(instrument)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('_synced.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump({symbol: date.isoformat() for symbol, date in synced.items()}, f)
+    os.replace(tmp_path, path)
+
+
+def _schema_path(instrument):
+    return HISTORY_DIR / instrument / '_common_metadata'
+
+
+def _load_schema(instrument):
+    """
+    同步时保存的所有文件合并后的 schema，读取时不需要打开每个文件
+    :return: pa.Schema，没有保存时为 None
+    """
+    path = _schema_path(instrument)
+    if not path.exists():
+        return None
+    return pq.read_schema(path)
+
+
+def _save_schema(instrument, schema):
+    path = _schema_path(instrument)
+    tmp_path = path.with_name('_common_metadata.tmp')
+    pq.write_metadata(schema, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _merge_schemas(schemas):
+    """
+    只有部分 symbol 才有的列不会丢失，全部为空值的列使用其他文件的类型，
+    同一列在不同文件中为 int64 和 float64 时使用 float64
+    """
+    try:
+        schema = pa.unify_schemas(schemas, promote_options='permissive')
+    except TypeError:  # pyarrow 14 之前没有 promote_options 参数
+        schema = pa.unify_schemas(schemas)
+    return schema.remove_metadata()
+
+
+def _write_partitions(instrument, symbol, hq_df):
+    """
+    按年写入 instrument/symbol=xx/year=xxxx/part.parquet，symbol 和 year 由目录名表示
+    整数列保存为 int64，浮点数列保存为 float64，与 Mongo 读取的类型一致
+    :return: list of pa.Schema 写入文件的 schema
+    """
+    hq_df = hq_df.drop(columns=['symbol'], errors='ignore')
+    for column in hq_df.columns:
+        if pd.api.types.is_bool_dtype(hq_df[column]):
+            continue
+        if pd.api.types.is_integer_dtype(hq_df[column]):
+            hq_df[column] = hq_df[column].astype('int64')
+        elif pd.api.types.is_float_dtype(hq_df[column]):
+            hq_df[column] = hq_df[column].astype('float64')
+
+    schemas = []
+    symbol_dir = HISTORY_DIR / instrument / 'symbol={}'.format(symbol)
+    for year, year_df in hq_df.groupby(hq_df['datetime'].dt.year):
+        year_dir = symbol_dir / 'year={}'.format(year)
+        year_dir.mkdir(parents=True, exist_ok=True)
+        path = year_dir / 'part.parquet'
+
+        if path.exists():  # 上次同步中断时可能已经写入部分数据
+            year_df = pd.concat([pd.read_parquet(path), year_df], ignore_index=True)
+            year_df = year_df.drop_duplicates(subset='datetime', keep='last')
+
+        tmp_path = year_dir / '.part.parquet.tmp'
+        year_df.sort_values('datetime').to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        schemas.append(pq.read_schema(path))
+    return schemas
+
+
+def sync_history(db, instrument, symbols=None, cutoff=None):
+    """
+    把 Mongo 中 cutoff 之前不再变化的行情同步到本地，按 instrument/symbol/year 分区保存为 parquet
+    :param db: pymongo.database.Database
+    :param instrument: 'future', 'option', 'index'
+    :param symbols: list of symbol，None 同步所有 symbol
+    :param cutoff: datetime 默认为当月第一天
+    :return: int 新同步的记录数
+    """
+    if cutoff is None:
+        today = datetime.today()
+        cutoff = datetime(today.year, today.month, 1)
+
+    collection = db[instrument]
+    if symbols is None:
+        symbols = collection.distinct('symbol')
+
+    synced = get_synced_dates(instrument)
+    schema = _load_schema(instrument)
+    schemas = [schema] if schema is not None else [pa.schema(PARTITION_FIELDS)]
+    total = 0
+    for num, symbol in enumerate(symbols, 1):
+        begin = synced.get(symbol)
+        if begin is not None and begin >= cutoff:
+            continue
+
+        filter_dict = {'symbol': symbol, 'datetime': {'$lt': cutoff}}
+        if begin is not None:
+            filter_dict['datetime']['$gte'] = begin
+
+        hq = collection.find(filter_dict, {'_id': 0}).sort('datetime', ASCENDING)
+        hq_df = read_cursor(hq)
+        if not hq_df.empty:
+            schemas.extend(_write_partitions(instrument, symbol, hq_df))
+            total += len(hq_df)
+
+        synced[symbol] = cutoff
+        if num % SAVE_STATE_EVERY == 0:
+            # 先保存 schema，同步状态中的文件都能按 schema 读取
+            schemas = [_merge_schemas(schemas)]
+            _save_schema(instrument, schemas[0])
+            _save_synced_dates(instrument, synced)
+
+    if (HISTORY_DIR / instrument).exists():
+        _save_schema(instrument, _merge_schemas(schemas))
+    _save_synced_dates(instrument, synced)
+    log.info('{} history synced {} records of {} symbols before {}'.format(
+        instrument, total, len(symbols), cutoff))
+    return total
+
+
+def _unify_schema(dataset):
+    """
+    合并所有文件的 schema，需要打开每个文件，只在没有保存 schema 时使用
+    """
+    return _merge_schemas([dataset.schema] + [fragment.physical_schema for fragment in dataset.get_fragments()])
+
+
+def read_history(instrument, symbols=None, start=None, end=None, columns=None):
+    """
+    读取本地行情，symbol、year 按目录过滤，datetime 条件下推到 parquet 文件
+    :param instrument: 'future', 'option', 'index'
+    :param symbols: list of symbol，None 读取所有 symbol
+    :param start: 开始时间
+    :param end: 结束时间
+    :param columns: list of column，None 读取所有列
+    :return: pd.DataFrame，没有本地数据时返回 None
+    """
+    path = HISTORY_DIR / instrument
+    if not path.exists():
+        return None
+
+    schema = _load_schema(instrument)
+    if schema is None:  # 之前同步的数据没有保存 schema
+        schema = _unify_schema(ds.dataset(str(path), format='parquet', partitioning='hive'))
+    dataset = ds.dataset(str(path), format='parquet', partitioning='hive', schema=schema)
+    names = [name for name in dataset.schema.names if name != 'year']
+    if columns is not None:
+        columns = [name for name in dict.fromkeys(['datetime', 'symbol'] + list(columns)) if name in names]
+    else:
+        columns = names
+
+    expression = None
+    conditions = []
+    if symbols is not None:
+        conditions.append(ds.field('symbol').isin(list(symbols)))
+    if start is not None:
+        conditions.append(ds.field('year') >= start.year)
+        conditions.append(ds.field('datetime') >= pd.Timestamp(start))
+    if end is not None:
+        conditions.append(ds.field('year') <= end.year)
+        conditions.append(ds.field('datetime') <= pd.Timestamp(end))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def sync_all_history(db, instruments=None, cutoff=None):
+    """
+    同步各类行情的本地历史数据，每天更新 Mongo 之后运行
+    :param db: pymongo.database.Database
+    :param instruments: list of instrument，默认为 HISTORY_INSTRUMENTS
+    :param cutoff: datetime 默认为当月第一天
+    :return: dict {instrument: 新同步的记录数}
+    """
+    return {instrument: sync_history(db, instrument, cutoff=cutoff)
+            for instrument in instruments or HISTORY_INSTRUMENTS}
+
+
+if __name__ == '__main__':
+    from src.data import conn
+    print(sync_all_history(conn))
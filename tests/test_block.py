@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.signal as signal
+
+from src.data.tdx import hq
+from src.data.tdx.setting import tdx_dir
+from src.features.block import block
+
+
+# --------------------------之前逐行处理的实现，作为对照-------------------------------------
+def identify_blocks_loop(segment_df):
+    """
+    identify_blocks 改为数组状态机之前的实现，df.append 等价于 pd.concat
+    """
+    segment_df = block.sort_one_candle_peaks(segment_df, invert=False)
+
+    block_high = block_highest = current_high = current_highest = segment_df.peak.iloc[1:3].max()
+    block_low = block_lowest = current_low = current_lowest = segment_df.peak.iloc[1:3].min()
+
+    enter_date = segment_df.datetime.iloc[0]
+    start_date = segment_df.datetime.iloc[1]
+    segment_num = 2
+
+    columns = ['enter_date', 'start_date', 'block_high', 'block_low',
+               'block_highest', 'block_lowest', 'segment_num']
+    df = pd.DataFrame(columns=columns)
+
+    for row in segment_df[3:].itertuples():
+        index = row.Index
+        if row.type == 'high':
+            if row.peak < block_low:
+                insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low,
+                                            block_highest, block_lowest, segment_num]], columns=columns)
+                df = pd.concat([df, insert_row], ignore_index=True)
+
+                enter_date = segment_df.datetime.iloc[index - 2]
+                start_date = segment_df.datetime.iloc[index - 1]
+                segment_num = 1
+                block_high = block_highest = current_high = current_highest = row.peak
+                block_low = block_lowest = current_low = current_lowest = segment_df.peak.iloc[index - 1]
+            else:
+                block_low = current_low
+                current_high = min(block_high, row.peak)
+                block_lowest = current_lowest
+                current_highest = max(block_highest, row.peak)
+        else:
+            if row.peak > block_high:
+                insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low,
+                                            block_highest, block_lowest, segment_num]], columns=columns)
+                df = pd.concat([df, insert_row], ignore_index=True)
+
+                enter_date = segment_df.datetime.iloc[index - 2]
+                start_date = segment_df.datetime.iloc[index - 1]
+                segment_num = 1
+                block_high = block_highest = current_high = current_highest = segment_df.peak.iloc[index - 1]
+                block_low = block_lowest = current_low = current_lowest = row.peak
+            else:
+                block_high = current_high
+                current_low = max(block_low, row.peak)
+                block_highest = current_highest
+                current_lowest = min(block_lowest, row.peak)
+
+        segment_num = segment_num + 1
+
+    insert_row = pd.DataFrame([[enter_date, start_date, block_high, block_low, block_highest,
+                                block_lowest, segment_num]], columns=columns)
+    return pd.concat([df, insert_row], ignore_index=True)
+
+
+def identify_blocks_relation_loop(block_df):
+    """
+    identify_blocks_relation 向量化之前逐行 iloc 赋值的实现
+    """
+    temp_df = block_df.copy()
+
+    if 'type' not in temp_df.columns:
+        temp_df['type'] = np.nan
+        temp_df['relation'] = np.nan
+        temp_df['sn'] = 0
+    temp_df['type'] = temp_df['type'].astype(object)
+    temp_df['relation'] = temp_df['relation'].astype(object)
+
+    type_index = temp_df.columns.get_loc('type')
+    relation_index = temp_df.columns.get_loc('relation')
+    sn_index = temp_df.columns.get_loc('sn')
+
+    prev_high = temp_df.block_high[0]
+    prev_highest = temp_df.block_highest[0]
+    prev_low = temp_df.block_low[0]
+    prev_lowest = temp_df.block_lowest[0]
+    prev_segment_num = temp_df.segment_num[0]
+
+    block_index = temp_df.iloc[0, sn_index]
+    block_type = block_relation = np.nan
+
+    last_index = len(temp_df) - 1
+
+    for row in temp_df[1:].itertuples():
+        index = row.Index
+        segment_num = row.segment_num
+        current_high = row.block_high
+        current_highest = row.block_highest
+        current_low = row.block_low
+        current_lowest = row.block_lowest
+
+        if current_low > prev_high:
+            block_type = 'up'
+        elif current_high < prev_low:
+            block_type = 'down'
+
+        if current_highest >= prev_highest and current_lowest >= prev_lowest:
+            block_relation = 'overlap' if prev_highest > current_lowest else 'up'
+        elif current_highest <= prev_highest and current_lowest <= prev_lowest:
+            block_relation = 'overlap' if current_highest > prev_lowest else 'down'
+        elif current_highest >= prev_highest and current_lowest <= prev_lowest:
+            block_relation = 'include'
+        elif current_highest <= prev_highest and current_lowest >= prev_lowest:
+            block_relation = 'included'
+
+        temp_df.iloc[index, type_index] = block_type
+        temp_df.iloc[index, relation_index] = block_relation
+
+        if prev_segment_num > 3:
+            block_index = block_index + 1
+
+        if segment_num % 2 == 0 and index != last_index:
+            block_index = 0
+
+        temp_df.iloc[index, sn_index] = block_index
+        prev_segment_num = segment_num
+        prev_high = current_high
+        prev_highest = current_highest
+        prev_low = current_low
+        prev_lowest = current_lowest
+
+    return temp_df
+
+
+def _remove_fake_peaks_pass(df):
+    """
+    remove_fake_peaks 改写之前 while 循环中的一次全量比较
+    """
+    diff_left = df.peak.diff()
+    diff_right = df.peak.diff(-1)
+
+    diff_left.iloc[0] = -1 if df.type.iloc[0] == 'low' else 1
+    diff_right.iloc[-1] = -1 if df.type.iloc[-1] == 'low' else 1
+
+    h_flag = np.logical_and(np.logical_and(diff_left >= 0, diff_right > 0), df.type == 'high')
+    r_flag = np.logical_and(np.logical_and(diff_left <= 0, diff_right < 0), df.type == 'low')
+    return df[np.logical_or(h_flag, r_flag).values]
+
+
+def remove_fake_peaks_loop(peak_df):
+    """
+    之前的实现，len_after 初始化为 len_before - 1，某次只删除一个点时就会停止
+    """
+    df = peak_df.copy()
+    len_before = len(df)
+    len_after = len_before - 1
+
+    while len_after < len_before:
+        df = _remove_fake_peaks_pass(df)
+        len_before = len_after
+        len_after = len(df)
+    return df
+
+
+def remove_fake_peaks_fixed_point(peak_df):
+    """
+    重复全量比较直到没有点被删除
+    """
+    df = peak_df.copy()
+    while len(df):
+        result = _remove_fake_peaks_pass(df)
+        if len(result) == len(df):
+            break
+        df = result
+    return df
+
+
+# --------------------------测试数据-------------------------------------
+def make_segments(seed, length):
+    """
+    高低点交替出现的段，偶数 seed 的极值取整，有大量相等的值
+    """
+    rng = np.random.default_rng(seed)
+    first_high = bool(rng.integers(2))
+    is_high = (np.arange(length) % 2 == 0) == first_high
+    moves = np.abs(rng.normal(0, 1, length)) + 0.01
+    peaks = 100 + np.cumsum(np.where(is_high, moves, -moves))
+    if seed % 2 == 0:
+        peaks = np.round(peaks)
+    return pd.DataFrame({'datetime': pd.date_range('2010-01-01', periods=length, freq='5min'),
+                         'peak': peaks,
+                         'type': np.where(is_high, 'high', 'low')})
+
+
+def make_peaks(rng, length):
+    """
+    高低点不一定交替，值有相等的情况，索引不是 RangeIndex
+    """
+    return pd.DataFrame({'datetime': pd.date_range('2010-01-01', periods=length, freq='min'),
+                         'peak': rng.integers(0, 8, length).astype(float) + np.where(rng.random(length) < 0.5, 0, 0.5),
+                         'type': np.where(rng.random(length) < 0.5, 'high', 'low')},
+                        index=rng.permutation(length) * 3)
+
+
+@pytest.fixture(params=['python', 'numba'])
+def kernel(request, monkeypatch):
+    """
+    分别使用 numba 编译的状态机和纯 python 的状态机
+    """
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+        assert block.njit is not None
+    else:
+        py_func = getattr(block._identify_blocks_kernel, 'py_func', block._identify_blocks_kernel)
+        monkeypatch.setattr(block, '_identify_blocks_kernel', py_func)
+        monkeypatch.setattr(block, 'njit', None)
+    return request.param
+
+
+# --------------------------与之前实现的结果比较-------------------------------------
+@pytest.mark.parametrize('seed', range(50))
+def test_identify_blocks_same_as_loop(kernel, seed):
+    segment_df = make_segments(seed, 200 + seed * 20)
+
+    expected = identify_blocks_loop(segment_df)
+    result = block.identify_blocks(segment_df)
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_identify_blocks_relation_same_as_loop(kernel, seed):
+    block_df = block.identify_blocks(make_segments(seed, 200 + seed * 20))
+
+    expected = identify_blocks_relation_loop(block_df)
+    result = block.identify_blocks_relation(block_df)
+
+    for column in ('type', 'relation', 'sn'):
+        pd.testing.assert_series_equal(result[column], expected[column], check_dtype=False)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_remove_fake_peaks_fixed_point(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(10):
+        peak_df = make_peaks(rng, int(rng.integers(1, 60)))
+
+        expected = remove_fake_peaks_fixed_point(peak_df)
+        result = block.remove_fake_peaks(peak_df)
+
+        pd.testing.assert_frame_equal(result, expected)
+        # 结果是不动点，再处理一次不会删除任何点
+        if len(result):
+            pd.testing.assert_frame_equal(block.remove_fake_peaks(result), result)
+
+
+def test_remove_fake_peaks_continue_after_single_removal():
+    # 第一次只删除一个点，之前的实现在这里停止，第二次还能删除一个点
+    peak_df = pd.DataFrame({'peak': [3., 5., 3., 4., 4., 5.],
+                            'type': ['low', 'high', 'low', 'high', 'low', 'high']})
+
+    assert remove_fake_peaks_loop(peak_df)['peak'].tolist() == [3., 5., 3., 4., 5.]
+    assert block.remove_fake_peaks(peak_df)['peak'].tolist() == [3., 5., 3., 5.]
+
+
+# --------------------------性能-------------------------------------
+def _timeit(func, *args):
+    begin = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - begin
+
+
+def test_identify_blocks_benchmark(kernel, record_property):
+    # 5 分钟线十几年的历史有超过 10 万个段
+    segment_df = make_segments(1, 120000)
+    block.identify_blocks(segment_df.iloc[:100])  # numba 编译不计入时间
+    _, seconds = _timeit(block.identify_blocks, segment_df)
+
+    small_df = segment_df.iloc[:5000].copy()
+    expected, loop_seconds = _timeit(identify_blocks_loop, small_df)
+    result, small_seconds = _timeit(block.identify_blocks, small_df)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    record_property('identify_blocks_120k_seconds', seconds)
+    record_property('identify_blocks_loop_5k_seconds', loop_seconds)
+    print('identify_blocks {}: 120000 segments {:.3f}s, 5000 segments {:.3f}s, loop {:.3f}s'.format(
+        kernel, seconds, small_seconds, loop_seconds))
+    assert small_seconds < loop_seconds
+
+
+def tdx_1m_peaks():
+    """
+    通达信 1 分钟线的高低点，与 get_peaks_from_hq 相同，同一根 k 线的高点排在低点前面
+    文件路径由环境变量 TDX_1M_FILE 指定，默认为螺纹钢指数
+    """
+    path = os.environ.get('TDX_1M_FILE', os.path.join(tdx_dir, 'vipdoc', 'ds', 'minline', '30#RBL9.lc1'))
+    if not os.path.exists(path):
+        pytest.skip('TDX 1m file not found: {}'.format(path))
+
+    records = hq._read_records(path, hq.MIN_DTYPE, 'date')
+    high = records['high'].astype(np.float64)
+    low = records['low'].astype(np.float64)
+    high_index = signal.argrelextrema(high, np.greater_equal)[0]
+    low_index = signal.argrelextrema(-low, np.greater_equal)[0]
+    peak_df = pd.DataFrame({'bar': np.concatenate([high_index, low_index]),
+                            'peak': np.concatenate([high[high_index], low[low_index]]),
+                            'type': ['high'] * len(high_index) + ['low'] * len(low_index)})
+    return peak_df.sort_values('bar', kind='mergesort').reset_index(drop=True)
+
+
+def random_walk_peaks(length=1000000):
+    # 高低点随机出现，有大量相等的值
+    rng = np.random.default_rng(0)
+    prices = np.round(3000 + np.cumsum(rng.normal(0, 1, length)))
+    is_high = rng.random(length) < 0.5
+    return pd.DataFrame({'peak': prices + np.where(is_high, 1, -1), 'type': np.where(is_high, 'high', 'low')})
+
+
+def alternating_walk_peaks(length=1000000):
+    rng = np.random.default_rng(1)
+    is_high = np.arange(length) % 2 == 0
+    prices = np.round(3000 + np.cumsum(rng.normal(0, 1, length)) + np.where(is_high, 2, -2))
+    return pd.DataFrame({'peak': prices, 'type': np.where(is_high, 'high', 'low')})
+
+
+def noisy_sine_peaks(length=1000000):
+    rng = np.random.default_rng(2)
+    is_high = np.arange(length) % 2 == 0
+    prices = 3000 + 50 * np.sin(np.arange(length) / 500) + rng.normal(0, 3, length) + np.where(is_high, 1, -1)
+    return pd.DataFrame({'peak': prices, 'type': np.where(is_high, 'high', 'low')})
+
+
+def staircase_peaks(length=1000000):
+    # 没有需要删除的点，只比较一次
+    is_high = np.arange(length) % 2 == 0
+    prices = np.arange(length) // 2 + np.where(is_high, 0.5, 0)
+    return pd.DataFrame({'peak': prices.astype(float), 'type': np.where(is_high, 'high', 'low')})
+
+
+def _best_of(func, *args, repeat=3):
+    result, best = None, None
+    for _ in range(repeat):
+        result, seconds = _timeit(func, *args)
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+@pytest.mark.parametrize('make_peaks_df', [tdx_1m_peaks, random_walk_peaks, alternating_walk_peaks,
+                                           noisy_sine_peaks, staircase_peaks])
+def test_remove_fake_peaks_benchmark(make_peaks_df, record_property):
+    peak_df = make_peaks_df()
+
+    expected, loop_seconds = _best_of(remove_fake_peaks_fixed_point, peak_df)
+    result, seconds = _best_of(block.remove_fake_peaks, peak_df)
+    pd.testing.assert_frame_equal(result, expected)
+
+    name = make_peaks_df.__name__
+    record_property('{}_seconds'.format(name), seconds)
+    record_property('{}_loop_seconds'.format(name), loop_seconds)
+    print('remove_fake_peaks {}: {} peaks {:.3f}s, loop {:.3f}s'.format(name, len(peak_df), seconds, loop_seconds))
+    assert seconds <= loop_seconds
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from src.util import downloader
+from src.util.downloader import NO_DATA, download_concurrently
+
+
+def test_download_concurrently_retry_only_failure(monkeypatch):
+    monkeypatch.setattr(downloader.time, 'sleep', lambda seconds: None)
+    calls = {}
+
+    def download(name, results):
+        calls[name] = calls.get(name, 0) + 1
+        return results[min(calls[name], len(results)) - 1]
+
+    tasks = [('shfe', 'ok', download, ('ok', [True])),
+             ('shfe', 'holiday', download, ('holiday', [NO_DATA])),
+             ('shfe', 'retry', download, ('retry', [False, None, True])),
+             ('dce', 'failure', download, ('failure', [False]))]
+    stats = download_concurrently(tasks, workers=2, retries=3, report_every=100)
+
+    assert calls == {'ok': 1, 'holiday': 1, 'retry': 3, 'failure': 4}
+    assert stats['shfe']['success'] == 2
+    assert stats['shfe']['no_data'] == 1
+    assert stats['shfe']['failure'] == []
+    assert stats['dce']['failure'] == ['failure']
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.future.hq import rank_contracts
+
+
+def rank_contracts_loop(hq_df):
+    """
+    rank_contracts 之前 build_future_index 中逐日计算的实现，持仓量相同时使用稳定排序
+    """
+    date_index = hq_df.index.get_level_values('datetime').unique()
+    contract_df = pd.DataFrame(index=date_index, columns=['domain', 'near', 'next'])
+
+    for date in date_index:
+        s = hq_df.loc[date, 'openInt'].copy()
+        s.sort_values(ascending=False, inplace=True, kind='mergesort')
+        s = s[:min(3, len(s))]
+        domain = s.index[0]
+        contract_df.loc[date, 'domain'] = domain
+        contract_df.loc[date, 'near'] = s.index.min()
+        try:
+            if s.index[1] > domain:
+                contract_df.loc[date, 'next'] = s.index[1]
+            elif s.index[2] > domain:
+                contract_df.loc[date, 'next'] = s.index[2]
+            else:
+                contract_df.loc[date, 'next'] = domain
+        except IndexError:
+            contract_df.loc[date, 'next'] = domain
+    return contract_df
+
+
+def make_hq(seed, days=10):
+    """
+    每天 1-6 个合约，持仓量取值范围小，有大量相同的持仓量
+    """
+    rng = np.random.default_rng(seed)
+    symbols = ['RB{}'.format(1901 + month) for month in range(12)]
+    frames = []
+    for date in pd.bdate_range('2019-01-01', periods=days):
+        count = int(rng.integers(1, 7))
+        chosen = sorted(rng.choice(symbols, count, replace=False))
+        frames.append(pd.DataFrame({'datetime': date, 'symbol': chosen,
+                                    'openInt': rng.integers(0, 4, count).astype(float) * 1000}))
+    return pd.concat(frames).set_index(['datetime', 'symbol'])
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_rank_contracts_same_as_loop(seed):
+    hq_df = make_hq(seed)
+
+    expected = rank_contracts_loop(hq_df)
+    result = rank_contracts(hq_df)
+
+    pd.testing.assert_frame_equal(result.astype(object), expected.astype(object), check_names=False)
+
+
+def make_cu_history(start='2002-01-07', end='2019-12-31'):
+    """
+    铜期货从 2002 年开始的日线，每天挂牌之后 12 个月的合约，持仓量集中在第 2-3 个月的合约，取整后有相同的持仓量
+    """
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range(start, end)
+    months = np.arange(1, 13)
+    listed = (dates.year.to_numpy()[:, None] * 12 + dates.month.to_numpy()[:, None] - 1) + months[None, :]
+    symbols = ['CU{:02d}{:02d}'.format(x // 12 % 100, x % 12 + 1) for x in listed.ravel()]
+    weight = np.exp(-0.5 * ((months - 2.5) / 1.5) ** 2)
+    open_int = np.round(weight[None, :] * rng.lognormal(11, 0.3, listed.shape), -3)
+    return pd.DataFrame({'datetime': np.repeat(dates, len(months)), 'symbol': symbols,
+                         'openInt': open_int.ravel()}).set_index(['datetime', 'symbol'])
+
+
+def test_rank_contracts_benchmark(record_property):
+    hq_df = make_cu_history()
+    days = hq_df.index.get_level_values('datetime').nunique()
+
+    begin = time.perf_counter()
+    expected = rank_contracts_loop(hq_df)
+    loop_seconds = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    result = rank_contracts(hq_df)
+    seconds = time.perf_counter() - begin
+
+    pd.testing.assert_frame_equal(result.astype(object), expected.astype(object), check_names=False)
+    record_property('rank_contracts_seconds', seconds)
+    record_property('rank_contracts_loop_seconds', loop_seconds)
+    print('rank_contracts: {} days {:.3f}s, loop {:.3f}s'.format(days, seconds, loop_seconds))
+    assert seconds < loop_seconds
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from src.data import schema
+
+# 记录的 explain() 输出，只保留和执行计划相关的字段
+IXSCAN_FIND = {
+    'queryPlanner': {
+        'namespace': 'quote.index',
+        'winningPlan': {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'IXSCAN', 'keyPattern': {'symbol': 1, 'datetime': 1},
+                           'indexName': 'symbol_1_datetime_1', 'direction': 'forward'}},
+        'rejectedPlans': [
+            {'stage': 'SORT', 'sortPattern': {'datetime': 1},
+             'inputStage': {'stage': 'COLLSCAN', 'direction': 'forward'}}]},
+    'serverInfo': {'host': 'localhost', 'version': '4.2.0'}}
+
+COLLSCAN_FIND = {
+    'queryPlanner': {
+        'namespace': 'quote.spot_price',
+        'winningPlan': {'stage': 'COLLSCAN', 'filter': {'code': {'$eq': 'RB'}}, 'direction': 'forward'},
+        'rejectedPlans': []}}
+
+SORT_FIND = {
+    'queryPlanner': {
+        'namespace': 'quote.future',
+        'winningPlan': {
+            'stage': 'SORT', 'sortPattern': {'datetime': -1},
+            'inputStage': {
+                'stage': 'SORT_KEY_GENERATOR',
+                'inputStage': {
+                    'stage': 'FETCH',
+                    'inputStage': {'stage': 'IXSCAN', 'keyPattern': {'market': 1, 'symbol': 1, 'datetime': 1},
+                                   'indexName': 'unique_market_symbol_datetime'}}}},
+        'rejectedPlans': []}}
+
+# aggregate 的 explain 结果，执行计划在 $cursor 阶段中
+COLLSCAN_AGGREGATE = {
+    'stages': [
+        {'$cursor': {'queryPlanner': {
+            'namespace': 'quote.block',
+            'winningPlan': {'stage': 'COLLSCAN', 'direction': 'forward'},
+            'rejectedPlans': []}}},
+        {'$sort': {'sortKey': {'start_date': -1}}},
+        {'$group': {'_id': '$symbol', 'start_date': {'$push': '$start_date'}}}],
+    'ok': 1.0}
+
+# $sort 已经下推到查询层，没有单独的 $sort 阶段，command 中回显的 pipeline 不计入
+IXSCAN_AGGREGATE = {
+    'stages': [
+        {'$cursor': {'queryPlanner': {
+            'namespace': 'quote.block',
+            'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'symbol_1_frequency_1_start_date_1',
+                               'direction': 'backward'}},
+            'rejectedPlans': [{'stage': 'COLLSCAN'}]}}},
+        {'$group': {'_id': '$symbol', 'start_date': {'$push': '$start_date'}}}],
+    'command': {'aggregate': 'block', 'pipeline': [{'$sort': {'start_date': -1}}]},
+    'ok': 1.0}
+
+# 使用了索引，但是 $sort 没有下推，在内存中排序
+UNPUSHED_SORT_AGGREGATE = {
+    'stages': [
+        {'$cursor': {'queryPlanner': {
+            'namespace': 'quote.block',
+            'winningPlan': {
+                'stage': 'FETCH',
+                'inputStage': {'stage': 'IXSCAN', 'indexName': 'symbol_1_frequency_1',
+                               'direction': 'forward'}},
+            'rejectedPlans': []}}},
+        {'$sort': {'sortKey': {'start_date': -1}}},
+        {'$group': {'_id': '$symbol', 'start_date': {'$push': '$start_date'}}}],
+    'ok': 1.0}
+
+
+@pytest.mark.parametrize('explain, stages', [
+    (IXSCAN_FIND, ['FETCH', 'IXSCAN']),
+    (COLLSCAN_FIND, ['COLLSCAN']),
+    (SORT_FIND, ['SORT', 'SORT_KEY_GENERATOR', 'FETCH', 'IXSCAN']),
+    (COLLSCAN_AGGREGATE, ['COLLSCAN', 'SORT']),
+    (IXSCAN_AGGREGATE, ['FETCH', 'IXSCAN']),
+    (UNPUSHED_SORT_AGGREGATE, ['FETCH', 'IXSCAN', 'SORT']),
+])
+def test_plan_stages(explain, stages):
+    # rejectedPlans 中的阶段不计入
+    assert list(schema._plan_stages(explain)) == stages
+
+
+class FakeCursor:
+
+    def __init__(self, explain):
+        self._explain = explain
+
+    def sort(self, sort):
+        return self
+
+    def explain(self):
+        return self._explain
+
+
+class FakeDatabase:
+    """
+    按 collection 名称返回记录的 explain() 输出
+    """
+
+    def __init__(self, explains):
+        self.explains = explains
+
+    def __getitem__(self, name):
+        return FakeCollection(self, name)
+
+    def command(self, command, name, pipeline=None, explain=False):
+        return self.explains[name]
+
+
+class FakeCollection:
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def find(self, query):
+        return FakeCursor(self.database.explains[self.name])
+
+
+def _explains(**override):
+    names = {collection for _, collection, _, _ in schema.CANONICAL_QUERIES}
+    explains = dict.fromkeys(names, IXSCAN_FIND)
+    explains['block'] = IXSCAN_AGGREGATE
+    explains.update(override)
+    return explains
+
+
+def test_audit_query_plans_use_index():
+    plans = schema.audit_query_plans(FakeDatabase(_explains()))
+    assert set(plans) == {name for name, _, _, _ in schema.CANONICAL_QUERIES}
+
+
+def test_audit_query_plans_raise_on_collscan_and_sort():
+    db = FakeDatabase(_explains(spot_price=COLLSCAN_FIND, future=SORT_FIND, block=COLLSCAN_AGGREGATE))
+    with pytest.raises(ValueError) as e:
+        schema.audit_query_plans(db)
+
+    message = str(e.value)
+    assert 'get_roll_yield on spot_price: COLLSCAN' in message
+    assert 'insert_hq_to_mongo on future: SORT' in message
+    assert 'get_peak_start_date on block: COLLSCAN, SORT' in message
+    assert 'get_price' not in message
+
+
+def test_audit_query_plans_without_raise():
+    db = FakeDatabase(_explains(spot_price=COLLSCAN_FIND))
+    plans = schema.audit_query_plans(db, raise_error=False)
+    assert plans['get_roll_yield'] == ['COLLSCAN']
+
+
+def test_audit_query_plans_raise_on_unpushed_sort():
+    db = FakeDatabase(_explains(block=UNPUSHED_SORT_AGGREGATE))
+    with pytest.raises(ValueError) as e:
+        schema.audit_query_plans(db)
+    assert 'get_peak_start_date on block: SORT' in str(e.value)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import copy
+import itertools
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.features.block import block
+
+
+# --------------------------内存中的 Mongo collection-------------------------------------
+def _match(doc, filter_dict):
+    for key, condition in filter_dict.items():
+        value = doc.get(key)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == '$in' and value not in operand:
+                    return False
+                if op == '$gte' and not value >= operand or op == '$gt' and not value > operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _sorted(docs, sort):
+    docs = list(docs)
+    for key, direction in reversed(sort or []):
+        docs.sort(key=lambda doc: doc[key], reverse=direction < 0)
+    return docs
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    fields = [k for k, v in projection.items() if v and k != '_id']
+    if not fields:
+        return {k: v for k, v in doc.items() if projection.get(k, 1)}
+    result = {k: doc[k] for k in fields if k in doc}
+    if projection.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    return result
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.iterator = None
+
+    def sort(self, sort):
+        self.docs = _sorted(self.docs, sort)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = iter(self.docs)
+        return next(self.iterator)
+
+
+class Result:
+
+    def __init__(self, inserted_ids=None):
+        self.acknowledged = True
+        self.inserted_ids = inserted_ids
+
+
+class FakeCollection:
+    """
+    排序键相同的记录以随机的顺序返回，和 MongoDB 一样不保证顺序
+    """
+    ids = itertools.count()
+
+    def __init__(self, docs=None):
+        self.docs = list(docs or [])
+        self.random = random.Random(0)
+
+    def find(self, filter_dict=None, projection=None, sort=None):
+        docs = [doc for doc in self.docs if _match(doc, filter_dict or {})]
+        self.random.shuffle(docs)
+        return FakeCursor([_project(doc, projection) for doc in _sorted(docs, sort)])
+
+    def find_one(self, filter_dict=None, projection=None, sort=None, skip=0):
+        docs = list(self.find(filter_dict, projection, sort))
+        return copy.deepcopy(docs[skip]) if len(docs) > skip else None
+
+    def insert_many(self, docs):
+        inserted_ids = []
+        for doc in docs:
+            doc = dict(doc, _id=next(self.ids))
+            self.docs.append(doc)
+            inserted_ids.append(doc['_id'])
+        return Result(inserted_ids)
+
+    def delete_many(self, filter_dict):
+        self.docs = [doc for doc in self.docs if not _match(doc, filter_dict)]
+        return Result()
+
+    def delete_one(self, filter_dict):
+        self.docs = [doc for doc in self.docs if not _match(doc, filter_dict)]
+
+    def replace_one(self, filter_dict, doc, upsert=False):
+        self.delete_one(filter_dict)
+        self.docs.append(copy.deepcopy(doc))
+
+
+# --------------------------测试数据-------------------------------------
+def make_bars(seed, length=400):
+    """
+    日线随机游走，偶数 seed 取整，同一根k线的高点和低点经常同时是极值点
+    """
+    rng = np.random.default_rng(seed)
+    close = 3000 + np.cumsum(rng.normal(0, 20, length))
+    high = close + np.abs(rng.normal(0, 15, length))
+    low = close - np.abs(rng.normal(0, 15, length))
+    if seed % 2 == 0:
+        high, low = np.round(high, -1), np.round(low, -1)
+    dates = pd.bdate_range('2010-01-04', periods=length)
+    return [{'symbol': 'RB88', 'datetime': date.to_pydatetime(), 'high': float(h), 'low': float(l)}
+            for date, h, l in zip(dates, high, low)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    def new_database(bars=()):
+        db = {'index': FakeCollection(copy.deepcopy(list(bars))), 'segment': FakeCollection(),
+              'segment_state': FakeCollection()}
+        monkeypatch.setattr(block, 'conn', db)
+        return db
+    return new_database
+
+
+def _segments(db):
+    return sorted((pd.Timestamp(doc['datetime']), doc['type']) for doc in db['segment'].docs)
+
+
+def _chunks(seed, length):
+    rng = np.random.default_rng(seed)
+    sizes = []
+    while sum(sizes) < length:
+        sizes.append(int(rng.integers(1, 30)))
+    return sizes
+
+
+def replay(database, bars, sizes, refresh, rewrite_at=None):
+    """
+    按 sizes 分批写入k线，每批之后更新一次分段
+    :param refresh: True 每次从数据库中已有的段重新生成状态，从起点重新读取全部k线，即之前每次全量扫描的计算方法
+    :param rewrite_at: 写入这一批之后改写最后一根k线的最高价，再更新一次
+    """
+    db = database()
+    begin = 0
+    for num, size in enumerate(sizes):
+        db['index'].docs.extend(copy.deepcopy(bars[begin:begin + size]))
+        begin += size
+        block.build_base_segments('RB88', 5, refresh=refresh)
+        if num == rewrite_at:
+            db['index'].docs[-1]['high'] = max(bar['high'] for bar in bars) + 100
+            block.build_base_segments('RB88', 5, refresh=refresh)
+    return _segments(db)
+
+
+# --------------------------增量计算与每次全量扫描比较-------------------------------------
+@pytest.mark.parametrize('seed', range(40))
+def test_incremental_same_as_rescan(database, seed):
+    bars = make_bars(seed)
+    sizes = _chunks(seed, len(bars))
+
+    assert replay(database, bars, sizes, refresh=False) == replay(database, bars, sizes, refresh=True)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_rewritten_last_bar(database, seed):
+    # 重新下载或者重新计算指数改写了最后一根k线
+    bars = make_bars(seed)
+    sizes = _chunks(seed, len(bars))
+    rewrite_at = len(sizes) // 2
+
+    expected = replay(database, bars, sizes, refresh=True, rewrite_at=rewrite_at)
+    assert replay(database, bars, sizes, refresh=False, rewrite_at=rewrite_at) == expected
+
+
+def test_no_update(database):
+    db = database(make_bars(0))
+    assert block.build_base_segments('RB88', 5)
+    state = copy.deepcopy(db['segment_state'].docs)
+
+    # 没有新的k线，最后一根k线没有改写
+    assert not block.build_base_segments('RB88', 5)
+    assert db['segment_state'].docs == state
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from src.util import store
+
+
+@pytest.fixture
+def history_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'HISTORY_DIR', tmp_path)
+    return tmp_path
+
+
+def test_read_history_with_different_columns(history_dir):
+    # 文件目录排在前面的 symbol 没有 contract 列，note 列全部为空
+    store._write_partitions('index', 'CU99', pd.DataFrame({
+        'datetime': pd.to_datetime(['2019-01-02', '2019-01-03']),
+        'close': [3400.0, 3410.0],
+        'volume': [100, 200],
+        'openInt': [1000, 1100],
+        'note': [None, None]}))
+    store._write_partitions('index', 'RB88', pd.DataFrame({
+        'datetime': pd.to_datetime(['2019-01-02', '2019-01-03']),
+        'close': [3405.0, 3415.0],
+        'volume': [300, 400],
+        'openInt': [2000, 2100],
+        'note': ['roll', None],
+        'contract': ['RB1905', 'RB1905']}))
+
+    hq_df = store.read_history('index', symbols=['CU99', 'RB88'], start=datetime(2019, 1, 1))
+    hq_df = hq_df.sort_values(['symbol', 'datetime']).reset_index(drop=True)
+
+    assert len(hq_df) == 4
+    assert {'contract', 'note', 'volume', 'openInt'} <= set(hq_df.columns)
+    assert hq_df.loc[hq_df['symbol'] == 'RB88', 'contract'].tolist() == ['RB1905', 'RB1905']
+    assert hq_df.loc[hq_df['symbol'] == 'CU99', 'contract'].isna().all()
+    assert hq_df.loc[hq_df['symbol'] == 'RB88', 'note'].tolist()[0] == 'roll'
+
+
+def test_write_partitions_keep_integer_columns(history_dir):
+    store._write_partitions('future', 'RB1905', pd.DataFrame({
+        'datetime': pd.to_datetime(['2019-01-02']),
+        'close': [3400.0],
+        'volume': [100],
+        'openInt': [1000]}))
+
+    hq_df = store.read_history('future', columns=['close', 'volume', 'openInt'])
+    assert pd.api.types.is_integer_dtype(hq_df['volume'])
+    assert pd.api.types.is_integer_dtype(hq_df['openInt'])
+    assert pd.api.types.is_float_dtype(hq_df['close'])
+
+
+# --------------------------同步和 get_price-------------------------------------
+def _match(doc, filter_dict):
+    """
+    测试用到的 Mongo 查询条件
+    """
+    for key, condition in filter_dict.items():
+        if key == '$or':
+            if not any(_match(doc, x) for x in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = doc.get(key)
+            for op, operand in condition.items():
+                if op == '$in' and value not in operand or op == '$nin' and value in operand:
+                    return False
+                if op == '$gte' and value < operand or op == '$lt' and value >= operand:
+                    return False
+                if op == '$lte' and value > operand:
+                    return False
+        elif doc.get(key) != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=None):
+        return iter(sorted(self.docs, key=lambda x: x['datetime']))
+
+
+class FakeCollection:
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.filters = []
+
+    def distinct(self, key):
+        return sorted({doc[key] for doc in self.docs})
+
+    def find(self, filter_dict, projection=None):
+        self.filters.append(filter_dict)
+        docs = [doc for doc in self.docs if _match(doc, filter_dict)]
+        if projection:
+            fields = [k for k, v in projection.items() if v]
+            if fields:
+                docs = [{k: v for k, v in doc.items() if k in fields} for doc in docs]
+        return FakeCursor(docs)
+
+
+def _hq_docs(symbol, dates, close):
+    return [{'symbol': symbol, 'datetime': date.to_pydatetime(), 'close': close + i, 'volume': 100 + i}
+            for i, date in enumerate(pd.bdate_range(*dates))]
+
+
+def test_sync_history_save_schema(history_dir, monkeypatch):
+    db = {'index': FakeCollection(_hq_docs('CU88', ('2018-12-24', '2019-01-08'), 50000.) +
+                                  [dict(doc, contract='RB1905') for doc in
+                                   _hq_docs('RB88', ('2018-12-24', '2019-01-08'), 3400.)])}
+    assert store.sync_history(db, 'index', cutoff=datetime(2019, 1, 1)) == 12
+    assert (history_dir / 'index' / '_common_metadata').exists()
+
+    # 读取时使用同步保存的 schema，不再打开每个文件
+    def unify_schema(dataset):
+        raise AssertionError('read footers of all files')
+    monkeypatch.setattr(store, '_unify_schema', unify_schema)
+
+    hq_df = store.read_history('index', symbols=['CU88'])
+    assert len(hq_df) == 6
+    assert 'contract' in hq_df.columns and hq_df['contract'].isna().all()
+    assert pd.api.types.is_integer_dtype(hq_df['volume'])
+
+
+def test_get_price_read_unsynced_symbol_from_mongo(history_dir, monkeypatch):
+    from src.api import common
+
+    # RB88 已经同步到 2019-01-01，CU88 是同步之后新增的 symbol
+    rb_docs = _hq_docs('RB88', ('2018-12-24', '2019-01-08'), 3400.)
+    store.sync_history({'index': FakeCollection(rb_docs)}, 'index', cutoff=datetime(2019, 1, 1))
+    cu_docs = _hq_docs('CU88', ('2018-12-24', '2019-01-08'), 50000.)
+    collection = FakeCollection(rb_docs + cu_docs)
+    monkeypatch.setattr(common, 'conn', {'index': collection})
+
+    hq_df = common.get_price(instrument='index')
+
+    # 本地的数据不再从 Mongo 读取，没有同步的 symbol 读取全部历史
+    assert len(collection.filters) == 1
+    assert len(hq_df) == 24
+    assert not hq_df.duplicated(['symbol', 'datetime']).any()
+    cu_df = hq_df[hq_df['symbol'] == 'CU88']
+    assert cu_df['datetime'].min() == pd.Timestamp('2018-12-24')
+    assert cu_df['close'].tolist() == [doc['close'] for doc in cu_docs]
+    rb_df = hq_df[hq_df['symbol'] == 'RB88']
+    assert rb_df['close'].tolist() == [doc['close'] for doc in rb_docs]
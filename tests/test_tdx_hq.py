@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from src.data.tdx import hq
+
+
+def _write_day_file(path, dates):
+    records = np.zeros(len(dates), dtype=hq.DAY_DTYPE)
+    records['datetime'] = dates
+    records['close'] = np.arange(len(dates))
+    records.tofile(str(path))
+
+
+def test_read_records_by_date(tmp_path):
+    path = tmp_path / 'day.day'
+    _write_day_file(path, [20190102, 20190103, 20190104, 20190107, 20190108])
+
+    records = hq._read_records(path, hq.DAY_DTYPE, 'datetime', 20190103, 20190107)
+    assert records['datetime'].tolist() == [20190103, 20190104, 20190107]
+    assert hq._read_records(path, hq.DAY_DTYPE, 'datetime', 20190109) is None
+
+
+def test_read_records_release_file(tmp_path):
+    path = tmp_path / 'day.day'
+    _write_day_file(path, [20190102, 20190103])
+    assert len(hq._read_records(path, hq.DAY_DTYPE, 'datetime')) == 2
+
+    # 读取后不再占用文件，改写后读取到新的数据
+    _write_day_file(path, [20190102, 20190103, 20190104])
+    assert hq._read_records(path, hq.DAY_DTYPE, 'datetime')['datetime'].tolist() == [20190102, 20190103, 20190104]
+
+    # 不完整的记录被忽略
+    with open(str(path), 'ab') as f:
+        f.write(b'\x00' * 7)
+    assert len(hq._read_records(path, hq.DAY_DTYPE, 'datetime')) == 3
+
+    path.write_bytes(b'')
+    assert hq._read_records(path, hq.DAY_DTYPE, 'datetime') is None